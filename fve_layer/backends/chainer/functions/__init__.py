@@ -0,0 +1,10 @@
+from fve_layer.backends.chainer.functions.accumulate import accumulated_sum
+from fve_layer.backends.chainer.functions.fisher_linear import fisher_linear
+from fve_layer.backends.chainer.functions.normalize import fisher_normalize
+
+
+__all__ = [
+	"accumulated_sum",
+	"fisher_linear",
+	"fisher_normalize",
+]
@@ -0,0 +1,48 @@
+import chainer
+import numpy as np
+
+from chainer import function_node
+from chainer import functions as F
+from chainer.utils import type_check
+
+
+class AccumulatedSum(function_node.FunctionNode):
+	"""
+		Sum over one axis, that is accumulated (and returned) in a
+		different dtype than the input, e.g. float16 storage with float32
+		accumulation. In contrast to F.sum(F.cast(x, dtype)) no casted
+		copy of the (large) input is created.
+	"""
+
+	def __init__(self, axis, dtype):
+		self.axis = axis
+		self.dtype = np.dtype(dtype)
+
+	def check_type_forward(self, in_types):
+		type_check._argname(in_types, ('x',))
+		type_check.expect(
+			in_types[0].dtype.kind == 'f',
+			-self.axis - 1 < in_types[0].ndim,
+			self.axis < in_types[0].ndim,
+		)
+
+	def forward(self, inputs):
+		x, = inputs
+		self._in_shape, self._in_dtype = x.shape, x.dtype
+		ret = x.sum(axis=self.axis, dtype=self.dtype)
+		return chainer.backend.get_array_module(x).asarray(ret),
+
+	def backward(self, indexes, grad_outputs):
+		gy, = grad_outputs
+		gy = F.expand_dims(gy, self.axis)
+		if gy.dtype != self._in_dtype:
+			gy = F.cast(gy, self._in_dtype)
+		return F.broadcast_to(gy, self._in_shape),
+
+
+def accumulated_sum(x, axis, dtype):
+	""" sums x over the axis with an accumulator (and output) of the given dtype """
+	if np.dtype(dtype) == x.dtype:
+		return F.sum(x, axis=axis)
+	y, = AccumulatedSum(axis, dtype).apply((x,))
+	return y
@@ -0,0 +1,238 @@
+import chainer
+import numpy as np
+
+from chainer import backend
+from chainer import function_node
+from chainer.utils import type_check
+
+from fve_layer.common import encoding
+
+
+class FisherLinear(function_node.FunctionNode):
+	"""
+		Linear layer on top of the Fisher vector encoding, that never
+		materializes the (n, S*n_components*in_size) encoding or its
+		gradient. Since the Fisher vector is linear in the statistics
+		S0 = sum_t gamma, S1 = sum_t gamma * x and S2 = sum_t gamma * x**2,
+		the weight matrix is folded with the normalization terms once and
+		the statistics are contracted with it directly. The statistics are
+		computed in chunks of samples, hence the memory overhead is
+		bounded by the chunk size. The backward pass recomputes the
+		statistics of each chunk.
+
+		The features and the means are centered by the mean of the means
+		(see fve_layer.common.encoding.fisher_blocks), the encoding is
+		independent of this reference point, hence it is a constant for
+		the gradients. The contractions of the statistics still cancel for
+		components, that are far apart relative to their variances, hence
+		both passes are computed in encoding.ACCUM_DTYPE (float64) and
+		only the results are cast to the dtype of the inputs.
+
+		Inputs:
+			x:     (n, t, in_size)
+			gamma: (n, t, n_components) (already masked soft assignment)
+			mu:    (in_size, n_components)
+			sig:   (in_size, n_components)
+			w:     (n_components,)
+			W:     (out_size, S*n_components*in_size)
+
+		Double backpropagation is not supported.
+	"""
+
+	def __init__(self, n_selected, statistics=("mu", "sig"), chunk_size=16):
+		self.n_selected = n_selected
+		self.statistics = tuple(statistics)
+		self.chunk_size = max(1, int(chunk_size))
+
+	def check_type_forward(self, in_types):
+		type_check._argname(in_types, ("x", "gamma", "mu", "sig", "w", "W"))
+		x, gamma, mu, sig, w, W = in_types
+
+		type_check.expect(
+			x.dtype.kind == "f",
+			x.ndim == 3,
+			gamma.ndim == 3,
+			mu.ndim == 2,
+			sig.ndim == 2,
+			w.ndim == 1,
+			W.ndim == 2,
+			gamma.shape[0] == x.shape[0],
+			gamma.shape[1] == x.shape[1],
+			gamma.shape[2] == mu.shape[1],
+			mu.shape[0] == x.shape[2],
+			W.shape[1] == len(self.statistics) * mu.shape[0] * mu.shape[1],
+		)
+		for t in (gamma, mu, sig, w, W):
+			type_check.expect(t.dtype == x.dtype)
+
+	def _chunks(self, n):
+		for i0 in range(0, n, self.chunk_size):
+			yield slice(i0, min(i0 + self.chunk_size, n))
+
+	def _weight_terms(self, xp, mu, sig, w, W):
+		""" folds the normalization of the Fisher vector into the weights """
+		D, K = mu.shape
+		S = len(self.statistics)
+		center = mu.mean(axis=1)
+		_mu, _sig = (mu - center[:, None]).T, sig.T
+		W4 = W.reshape(-1, S, K, D)
+
+		terms = dict(center=center, mu=_mu, sig=_sig, w=w, W4=W4)
+		if "mu" in self.statistics:
+			a = 1 / (xp.sqrt(_sig) * xp.sqrt(w)[:, None])
+			Wm = W4[:, self.statistics.index("mu")]
+			A = Wm * a
+			terms.update(a=a, Wm=Wm, A=A, A_mu=(A * _mu).sum(axis=-1))
+
+		if "sig" in self.statistics:
+			b = (1 / xp.sqrt(2 * w))[:, None]
+			Ws = W4[:, self.statistics.index("sig")]
+			B = Ws * (b / _sig)
+			terms.update(b=b, Ws=Ws, B=B, B_mu=B * _mu,
+				B_c=(B * _mu**2).sum(axis=-1) - (Ws * b).sum(axis=-1))
+
+		return terms
+
+	def _stats(self, xp, x, gamma):
+		""" statistics of the centered features x """
+		gamma_T = gamma.transpose(0, 2, 1)
+		S0 = gamma.sum(axis=1)
+		S1 = xp.matmul(gamma_T, x)
+		S2 = xp.matmul(gamma_T, x**2) if "sig" in self.statistics else None
+		return S0, S1, S2
+
+	@staticmethod
+	def _accum_dtype(x):
+		return np.promote_types(x.dtype, encoding.ACCUM_DTYPE)
+
+	def forward(self, inputs):
+		self.retain_inputs(tuple(range(len(inputs))))
+		x, gamma = inputs[:2]
+		xp = backend.get_array_module(x)
+		dtype = self._accum_dtype(x)
+		mu, sig, w, W = [p.astype(dtype) for p in inputs[2:]]
+
+		n = x.shape[0]
+		terms = self._weight_terms(xp, mu, sig, w, W)
+		C = W.shape[0]
+		y = xp.zeros((n, C), dtype=dtype)
+
+		for idx in self._chunks(n):
+			S0, S1, S2 = self._stats(xp, x[idx].astype(dtype) - terms["center"],
+				gamma[idx].astype(dtype))
+			c = S0.shape[0]
+			S1f = S1.reshape(c, -1)
+			_y = y[idx]
+
+			if "mu" in self.statistics:
+				_y += S1f @ terms["A"].reshape(C, -1).T - S0 @ terms["A_mu"].T
+
+			if "sig" in self.statistics:
+				_y += S2.reshape(c, -1) @ terms["B"].reshape(C, -1).T
+				_y -= 2 * S1f @ terms["B_mu"].reshape(C, -1).T
+				_y += S0 @ terms["B_c"].T
+
+		y /= xp.asarray(self.n_selected, dtype=y.dtype)[:, None]
+		return y.astype(x.dtype),
+
+	def backward(self, indexes, grad_outputs):
+		inputs = [v.array for v in self.get_retained_inputs()]
+		x, gamma = inputs[:2]
+		xp = backend.get_array_module(x)
+		dtype = self._accum_dtype(x)
+		mu, sig, w, W = [p.astype(dtype) for p in inputs[2:]]
+		gy = grad_outputs[0].array.astype(dtype)
+
+		n, t, D = x.shape
+		K = mu.shape[1]
+		C = W.shape[0]
+		terms = self._weight_terms(xp, mu, sig, w, W)
+		N = xp.asarray(self.n_selected, dtype=dtype)
+		_mu, _sig = terms["mu"], terms["sig"]
+
+		need_x, need_gamma = 0 in indexes, 1 in indexes
+		need_params = any(i in indexes for i in (2, 3, 4, 5))
+
+		gx = xp.zeros_like(x) if need_x else None
+		ggamma = xp.zeros_like(gamma) if need_gamma else None
+		gmu = xp.zeros_like(_mu)
+		gsig = xp.zeros_like(_sig)
+		gw = xp.zeros_like(w)
+		gW4 = xp.zeros_like(terms["W4"])
+
+		for idx in self._chunks(n):
+			_x = x[idx].astype(dtype) - terms["center"]
+			_gamma, _gy = gamma[idx].astype(dtype), gy[idx]
+			_N = N[idx]
+			c = _x.shape[0]
+			gyN = _gy / _N[:, None]
+
+			# gradients w.r.t. the statistics
+			gS0 = xp.zeros((c, K), dtype=dtype)
+			gS1 = xp.zeros((c, K * D), dtype=dtype)
+			gS2 = None
+			if "mu" in self.statistics:
+				gS1 += gyN @ terms["A"].reshape(C, -1)
+				gS0 -= gyN @ terms["A_mu"]
+
+			if "sig" in self.statistics:
+				gS2 = (gyN @ terms["B"].reshape(C, -1)).reshape(c, K, D)
+				gS1 -= 2 * gyN @ terms["B_mu"].reshape(C, -1)
+				gS0 += gyN @ terms["B_c"]
+			gS1 = gS1.reshape(c, K, D)
+
+			# the terms cancel, hence they are summed before the cast
+			if need_x:
+				_gx = xp.matmul(_gamma, gS1)
+				if gS2 is not None:
+					_gx += 2 * _x * xp.matmul(_gamma, gS2)
+				gx[idx] = _gx
+
+			if need_gamma:
+				_ggamma = xp.matmul(_x, gS1.transpose(0, 2, 1)) + gS0[:, None, :]
+				if gS2 is not None:
+					_ggamma += xp.matmul(_x**2, gS2.transpose(0, 2, 1))
+				ggamma[idx] = _ggamma
+
+			if not need_params:
+				continue
+
+			S0, S1, S2 = self._stats(xp, _x, _gamma)
+			_S0 = S0[..., None]
+			_Nc = _N[:, None, None]
+
+			if "mu" in self.statistics:
+				a = terms["a"]
+				FV = (S1 - _mu * _S0) * a / _Nc
+				G = (_gy @ terms["Wm"].reshape(C, -1)).reshape(c, K, D)
+
+				gW4[:, self.statistics.index("mu")] += (_gy.T @ FV.reshape(c, -1)).reshape(C, K, D)
+				gmu += (G * -_S0 * a / _Nc).sum(axis=0)
+				gsig += (G * -0.5 * FV / _sig).sum(axis=0)
+				gw += (G * FV).sum(axis=(0, 2)) * -0.5 / w
+
+			if "sig" in self.statistics:
+				b = terms["b"]
+				# sum_t gamma * (x - mu)**2 (see encoding.fisher_blocks)
+				Q = S2 - _mu * (2 * S1 - _mu * _S0)
+				FV = (Q / _sig - _S0) * b / _Nc
+				H = (_gy @ terms["Ws"].reshape(C, -1)).reshape(c, K, D)
+
+				gW4[:, self.statistics.index("sig")] += (_gy.T @ FV.reshape(c, -1)).reshape(C, K, D)
+				gmu += (H * b / _Nc * (2 * _mu * _S0 - 2 * S1) / _sig).sum(axis=0)
+				gsig += (H * b / _Nc * -Q / _sig**2).sum(axis=0)
+				gw += (H * FV).sum(axis=(0, 2)) * -0.5 / w
+
+		grads = [gx, ggamma, gmu.T, gsig.T, gw, gW4.reshape(W.shape)]
+		return tuple(None if g is None else chainer.Variable(g.astype(x.dtype, copy=False))
+			for g in grads)
+
+
+def fisher_linear(x, gamma, mu, sig, w, W, n_selected, *,
+	statistics=("mu", "sig"), chunk_size=16):
+	""" computes linear(fisher_vector(x, gamma, mu, sig, w), W) without
+		materializing the Fisher vector (see FisherLinear)
+	"""
+	y, = FisherLinear(n_selected, statistics, chunk_size).apply(
+		(x, gamma, mu, sig, w, W))
+	return y
@@ -0,0 +1,92 @@
+import chainer
+
+from chainer import backend
+from chainer import function_node
+from chainer.utils import type_check
+
+from fve_layer.common import encoding
+
+
+class FisherNormalize(function_node.FunctionNode):
+	"""
+		Improved Fisher vector normalization (signed power, intra- and
+		L2-normalization, see fve_layer.common.encoding.normalize) as a
+		single node of the graph. Only the input and the output are
+		retained, the intermediate results are recomputed in the
+		backward pass.
+
+		The derivative of the signed power normalization is unbounded at
+		zero, hence it is evaluated at max(|z|, power_eps). Blocks with a
+		norm below eps (e.g. of components without any assigned feature)
+		are treated as constant and get a zero gradient.
+		Double backpropagation is not supported.
+	"""
+
+	def __init__(self, in_size, n_components, *, power=None, intra=False, l2=False,
+		eps=1e-12, power_eps=1e-6):
+		self.in_size = in_size
+		self.n_components = n_components
+		self.power = power
+		self.intra = intra
+		self.l2 = l2
+		self.eps = eps
+		self.power_eps = power_eps
+
+	def check_type_forward(self, in_types):
+		type_check._argname(in_types, ("x",))
+		x_type, = in_types
+		type_check.expect(
+			x_type.dtype.kind == "f",
+			x_type.ndim >= 1,
+			x_type.shape[-1] % (self.in_size * self.n_components) == 0,
+		)
+
+	def _normalize(self, x, return_norms=False):
+		return encoding.normalize(x, self.in_size, self.n_components,
+			power=self.power,
+			intra=self.intra,
+			l2=self.l2,
+			eps=self.eps,
+			return_norms=return_norms,
+			xp=backend.get_array_module(x))
+
+	def forward(self, inputs):
+		self.retain_inputs((0,))
+		self.retain_outputs((0,))
+		x, = inputs
+		return self._normalize(x),
+
+	def backward(self, indexes, grad_outputs):
+		x, = self.get_retained_inputs()
+		y, = self.get_retained_outputs()
+		x, y, gy = x.array, y.array, grad_outputs[0].array
+		xp = backend.get_array_module(x)
+
+		_, intra_norms, l2_norm = self._normalize(x, return_norms=True)
+		gx = gy
+
+		if self.l2:
+			# y = z / |z|
+			gx = (gx - y * (gx * y).sum(axis=-1, keepdims=True)) / l2_norm
+			gx = gx * (l2_norm > self.eps)
+			y = y * l2_norm
+
+		if self.intra:
+			# y_k = z_k / |z_k| for every component block k
+			y = encoding._as_blocks(y, self.in_size, self.n_components)
+			gx = encoding._as_blocks(gx, self.in_size, self.n_components)
+			gx = gx - y * (gx * y).sum(axis=(-3, -1), keepdims=True)
+			gx = gx / intra_norms * (intra_norms > self.eps)
+			gx = gx.reshape(x.shape)
+
+		if self.power is not None:
+			_x = xp.maximum(xp.abs(x), self.power_eps)
+			gx = gx * self.power * _x**(self.power - 1)
+
+		return chainer.Variable(gx),
+
+
+def fisher_normalize(x, in_size, n_components, **kwargs):
+	""" see FisherNormalize """
+	y, = FisherNormalize(in_size, n_components, **kwargs).apply((x,))
+	return y
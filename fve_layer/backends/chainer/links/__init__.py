@@ -1,10 +1,16 @@
 from fve_layer.backends.chainer.links.fve import FVELayer
 from fve_layer.backends.chainer.links.fve import FVELayer_noEM
 from fve_layer.backends.chainer.links.gmm import GMMLayer
+from fve_layer.backends.chainer.links.grouped import GroupedFVELayer
+from fve_layer.backends.chainer.links.grouped import GroupedGMMLayer
+from fve_layer.backends.chainer.links.linear import FVELinear
 
 
 __all__ = [
 	"GMMLayer",
 	"FVELayer",
 	"FVELayer_noEM",
+	"FVELinear",
+	"GroupedGMMLayer",
+	"GroupedFVELayer",
 ]
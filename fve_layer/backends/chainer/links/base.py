@@ -1,13 +1,54 @@
 import abc
 import chainer
+import contextlib
 import numpy as np
+import threading
 
 from chainer import initializers
 from chainer import link
 from chainer import functions as F
 from chainer.backends import cuda
+from collections import namedtuple
+from functools import partial
 from functools import wraps
 
+from fve_layer.backends.chainer.functions import accumulated_sum
+from fve_layer.common import autotune
+from fve_layer.common import encoding
+from fve_layer.common import precision as precision_policies
+
+ParamSnapshot = namedtuple("ParamSnapshot", ["mu", "sig", "w", "version", "active"],
+	defaults=(None,))
+
+# contiguous parameters of the active (not pruned) components: idx are
+# their indices and perm maps the concatenation [active, pruned] back
+# to the original order of the components
+ActiveComponents = namedtuple("ActiveComponents", ["idx", "perm", "mu", "sig", "w"])
+
+# thread-local storage for the pinned parameter snapshots
+_PINNED = threading.local()
+
+def _pinned_params():
+	pinned = getattr(_PINNED, "params", None)
+	if pinned is None:
+		pinned = _PINNED.params = dict()
+	return pinned
+
+def consistent_params(method):
+	"""
+		Pins the current parameter snapshot for the duration of the call,
+		hence all nested calls see the same parameters, even if they are
+		updated concurrently by another thread.
+	"""
+
+	@wraps(method)
+	def inner(self, *args, **kwargs):
+		with self.pinned_params():
+			return method(self, *args, **kwargs)
+
+	return inner
+
+
 def promote_x_dtype(method):
 
 	def cast(arr, dtype, xp=np):
@@ -17,6 +58,14 @@ def promote_x_dtype(method):
 	@wraps(method)
 	def inner(self, x, *args, **kwargs):
 		x_dtype = x.dtype
+
+		if self.precision is not None:
+			# mixed precision: the stages cast their (small) intermediates
+			# on their own, only the features are stored in a lower precision
+			storage = self.precision.storage
+			x = x if x_dtype == storage else cast(x, storage, xp=self.xp)
+			return method(self, x, *args, **kwargs)
+
 		interm_dtype = np.promote_types(x_dtype, self.mu.dtype)
 
 		if x_dtype == interm_dtype:
@@ -38,17 +87,44 @@ def promote_x_dtype(method):
 
 class BaseEncodingLayer(link.Link, abc.ABC):
 	_LOG_2PI = np.log(2 * np.pi)
+	COVARIANCE_TYPES = ("diag", "spherical", "tied_diag")
 
 	def __init__(self, in_size, n_components, *,
 		init_mu=None,
 		init_sig=1,
 		eps=1e-2,
 		dtype=chainer.get_dtype(map_mixed16=np.float32),
+		precision=None,
+		covariance_type="diag",
+		autotuner=None,
 		**kwargs):
+		"""
+			autotuner:       if set (True for the shared autotune.default_tuner()
+			                 or an autotune.Autotuner), the implementation of the
+			                 distances is chosen per shape bucket by a benchmark
+			                 (see _log_proba_intern). The expanded matrix
+			                 products are only candidates for the diagonal
+			                 covariances, if the autotuner is approximate.
+			covariance_type: "diag" (a variance per dimension and component),
+			                 "spherical" (a single variance per component) or
+			                 "tied_diag" (diagonal covariance shared by all
+			                 components). sig has the shape
+			                 (in_size, n_components), (1, n_components) or
+			                 (in_size, 1), respectively, and is broadcasted
+			                 to (in_size, n_components) where needed.
+		"""
 		super(BaseEncodingLayer, self).__init__()
 
+		if covariance_type not in self.COVARIANCE_TYPES:
+			raise ValueError(
+				f"Unknown covariance type \"{covariance_type}\"! " + \
+				f"Choose one of: {', '.join(self.COVARIANCE_TYPES)}")
+
 		self.n_components = n_components
 		self.in_size = in_size
+		self.covariance_type = covariance_type
+		self.precision = precision_policies.get_policy(precision)
+		self.autotuner = autotune.default_tuner() if autotuner is True else (autotuner or None)
 
 		with self.init_scope():
 			self.add_persistent("eps", eps)
@@ -65,6 +141,7 @@ class BaseEncodingLayer(link.Link, abc.ABC):
 			('in_size', self.in_size),
 			('n_components', self.n_components),
 			('eps', self.eps),
+			('covariance_type', self.covariance_type),
 		]
 		for spec in specs:
 			yield spec
@@ -73,6 +150,90 @@ class BaseEncodingLayer(link.Link, abc.ABC):
 	def add_params(self, dtype):
 		pass
 
+	@property
+	def sig_shape(self):
+		""" shape of the variances w.r.t. the covariance type """
+		if self.covariance_type == "spherical":
+			return (1, self.n_components)
+		elif self.covariance_type == "tied_diag":
+			return (self.in_size, 1)
+		return (self.in_size, self.n_components)
+
+	def _full_sig(self, sig, n_components=None):
+		""" broadcasts the variances to (in_size, n_components) """
+		shape = (self.in_size, n_components or self.n_components)
+		if sig.shape == shape:
+			return sig
+		if isinstance(sig, chainer.Variable):
+			return F.broadcast_to(sig, shape)
+		return self.xp.broadcast_to(sig, shape)
+
+	def _constrain_sig(self, sig):
+		""" reduces per-dimension variances (in_size, n_components)
+			to the shape of the covariance type by averaging
+		"""
+		if self.covariance_type == "spherical":
+			return sig.mean(axis=0, keepdims=True)
+		elif self.covariance_type == "tied_diag":
+			return sig.mean(axis=1, keepdims=True)
+		return sig
+
+	def param_snapshot(self):
+		""" returns the current parameters as one consistent tuple """
+		return ParamSnapshot(self.mu, self.sig, self.w, None)
+
+	@contextlib.contextmanager
+	def pinned_params(self, params=None):
+		"""
+			Pins a parameter snapshot (by default the current one) for the
+			current thread. Nested calls without explicit parameters keep
+			the already pinned snapshot.
+		"""
+		pinned, key = _pinned_params(), id(self)
+		prev = pinned.get(key)
+
+		if prev is not None and params is None:
+			yield prev
+			return
+
+		pinned[key] = self.param_snapshot() if params is None else params
+		try:
+			yield pinned[key]
+		finally:
+			if prev is None:
+				del pinned[key]
+			else:
+				pinned[key] = prev
+
+	def _current_params(self):
+		""" returns the pinned snapshot or the current parameters """
+		params = _pinned_params().get(id(self))
+		return self.param_snapshot() if params is None else params
+
+	def _compute_params(self):
+		""" parameters of the active components, that are used by all
+			computations (the current parameters, if none was pruned)
+		"""
+		params = self._current_params()
+		return params if params.active is None else params.active
+
+	def _scatter_components(self, x, axis=-1, fill=0):
+		"""
+			Maps the results of the active components (along the axis) to
+			the layout of all components. The pruned components are
+			filled with a constant value.
+		"""
+		active = self._current_params().active
+		if active is None:
+			return x
+
+		axis = axis % x.ndim
+		shape = list(x.shape)
+		shape[axis] = self.n_components - shape[axis]
+		const = self.xp.full(shape, fill, dtype=x.dtype)
+		res = F.concat([x, const], axis=axis)
+		return F.get_item(res, (slice(None),) * axis + (active.perm,))
+
 	def _init_initializers(self, init_mu, init_sig, dtype):
 
 		if init_mu is None:
@@ -99,6 +260,19 @@ class BaseEncodingLayer(link.Link, abc.ABC):
 		self.init_sig(self.sig)
 		self.init_w(self.w)
 
+	def _stage_dtype(self, stage, default):
+		""" dtype of a computation stage w.r.t. the precision policy """
+		if self.precision is None:
+			return np.dtype(default)
+		return self.precision.dtype(stage)
+
+	def _cast(self, x, dtype):
+		return x if x.dtype == dtype else F.cast(x, dtype)
+
+	def _reduce_sum(self, x, axis, stage):
+		""" sum over an axis, that is accumulated in the dtype of the stage """
+		return accumulated_sum(x, axis, self._stage_dtype(stage, x.dtype))
+
 	def _check_input(self, x):
 		assert x.ndim == 3, \
 			"input should have following dimensions: (batch_size, n_features, feature_size)"
@@ -110,15 +284,22 @@ class BaseEncodingLayer(link.Link, abc.ABC):
 
 	def _expand_params(self, x):
 		n, t = self._check_input(x)
-		shape = (n, t, self.in_size, self.n_components)
-		shape2 = (n, t, self.n_components)
+		params = self._compute_params()
+		n_components = params.w.shape[0]
+		shape = (n, t, self.in_size, n_components)
+		shape2 = (n, t, n_components)
 
 		_x = F.broadcast_to(F.expand_dims(x, -1), shape)
 
-		_params = [(self.mu, shape), (self.sig, shape), (self.w, shape2)]
+		w_dtype = self._stage_dtype("logsumexp", x.dtype)
+		_params = [
+			(params.mu, shape, x.dtype),
+			(params.sig, shape, x.dtype),
+			(params.w, shape2, w_dtype)
+		]
 		_ps = []
-		for p, s in _params:
-			_p = F.expand_dims(F.expand_dims(p, 0), 0)
+		for p, s, dtype in _params:
+			_p = F.expand_dims(F.expand_dims(self._cast(p, dtype), 0), 0)
 			# print(p.shape, _p.shape, s, sep=" -> ")
 			_ps.append(F.broadcast_to(_p, s))
 		_mu, _sig, _w = _ps
@@ -128,15 +309,29 @@ class BaseEncodingLayer(link.Link, abc.ABC):
 
 		return _x, _mu, _sig, _w
 
+	@consistent_params
 	@promote_x_dtype
-	def soft_assignment(self, x):
+	def soft_assignment(self, x, **kwargs):
 		""" computes the probability """
-		return F.exp(self.log_soft_assignment(x))
+		return F.exp(self.log_soft_assignment(x, **kwargs))
 
-	def log_soft_assignment(self, x):
+	@consistent_params
+	def log_soft_assignment(self, x, **kwargs):
 		""" computes the log-probability """
+		_log_gamma = self._log_soft_assignment(x, **kwargs)
+		return self._scatter_components(_log_gamma, fill=-np.inf)
+
+	@consistent_params
+	@promote_x_dtype
+	def _soft_assignment(self, x, **kwargs):
+		""" probability of the active components only """
+		return F.exp(self._log_soft_assignment(x, **kwargs))
+
+	@consistent_params
+	def _log_soft_assignment(self, x, **kwargs):
+		""" log-probability of the active components only """
 
-		_log_proba, _w = self.log_proba(x, weighted=False)
+		_log_proba, _w = self._log_proba_intern(x, **kwargs)
 		_log_wu = _log_proba + F.log(_w)
 
 		_log_wu_sum = F.logsumexp(_log_wu, axis=-1)
@@ -145,32 +340,139 @@ class BaseEncodingLayer(link.Link, abc.ABC):
 
 		return _log_wu - _log_wu_sum
 
+	@consistent_params
 	@promote_x_dtype
 	def _dist(self, x, *, return_weights=True):
 		"""
 			computes squared Mahalanobis distance
 			(in our case it is the standartized Euclidean distance)
 		"""
-		_x, _mu, _sig, _w = self._expand_params(x)
+		# the distance terms are computed (not only stored) in the dtype
+		# of the "dist" stage
+		dtype = self._stage_dtype("dist", x.dtype)
+		_x, _mu, _sig, _w = self._expand_params(self._cast(x, dtype))
 
-		_dist = F.sum((_x - _mu)**2 / _sig, axis=2)
+		_dist = self._reduce_sum((_x - _mu)**2 / _sig, axis=2, stage="logsumexp")
 
 		return (_dist, _w) if return_weights else _dist
 
+	@consistent_params
+	@promote_x_dtype
+	def _matmul_dist(self, x, *, return_weights=True):
+		"""
+			computes the same distance as _dist, but expanded into matrix
+			products (x**2 / sig - 2 * x * mu / sig + mu**2 / sig), hence
+			without the (n, t, in_size, n_components) intermediates.
+			The expansion is prone to cancellation, therefore the
+			features and the means are centered by the mean of the means
+			(the distances do not depend on it) and it is computed in
+			the dtype of the "logsumexp" stage.
+
+			For the spherical and tied_diag covariances, the distance is an
+			Euclidean distance of (rescaled) features and means, hence a
+			single matrix product and the squared norms are sufficient.
+		"""
+		n, t = self._check_input(x)
+		dtype = self._stage_dtype("logsumexp", x.dtype)
+		params = self._compute_params()
+		_mu, _sig, _w = [self._cast(p, dtype) for p in (params.mu, params.sig, params.w)]
+		_prec = 1 / _sig
+		n_components = params.w.shape[0]
+
+		_x = F.reshape(self._cast(x, dtype), (n * t, self.in_size))
+		shape = (n * t, n_components)
+
+		center = getattr(_mu, "array", _mu).mean(axis=1)
+		_x = _x - self.xp.broadcast_to(center, _x.shape)
+		_mu = _mu - self.xp.broadcast_to(center[:, None], _mu.shape)
+
+		if self.covariance_type == "diag":
+			_dist = F.matmul(_x**2, _prec) - 2 * F.matmul(_x, _mu * _prec)
+			_dist = _dist + F.broadcast_to(F.sum(_mu**2 * _prec, axis=0), shape)
+
+		else:
+			if self.covariance_type == "tied_diag":
+				# scale the features and the means by the shared std
+				_scale = F.sqrt(_prec)
+				_x = _x * F.broadcast_to(F.transpose(_scale), _x.shape)
+				_mu = _mu * F.broadcast_to(_scale, _mu.shape)
+
+			x_norms = F.broadcast_to(F.sum(_x**2, axis=1, keepdims=True), shape)
+			mu_norms = F.broadcast_to(F.sum(_mu**2, axis=0, keepdims=True), shape)
+			_dist = x_norms - 2 * F.matmul(_x, _mu) + mu_norms
+
+			if self.covariance_type == "spherical":
+				_dist = _dist * F.broadcast_to(_prec, shape)
+
+		_dist = F.reshape(_dist, (n, t, n_components))
+
+		if not return_weights:
+			return _dist
+
+		return _dist, F.broadcast_to(_w, _dist.shape)
+
+	@consistent_params
 	def mahalanobis_dist(self, x):
 		_dist = self._dist(x, return_weights=False)
-		return F.sqrt(_dist)
+		return self._scatter_components(F.sqrt(_dist), fill=np.inf)
+
+	def _dist_impls(self):
+		""" implementations of the squared Mahalanobis distance (n, t, n_components) """
+		return dict(
+			broadcast=partial(self._dist, return_weights=False),
+			matmul=partial(self._matmul_dist, return_weights=False))
+
+	def _approximate_dist_impls(self):
+		""" the implementations, that are less accurate than the default one:
+			the matrix products cancel for the diagonal covariances, but are
+			the default of the shared variances
+		"""
+		return {"matmul"} if self.covariance_type == "diag" else set()
+
+	def _tuned_dist(self, x):
+		""" the distances and the weights computed by the implementation,
+			that the autotuner chose for the shape bucket of x
+		"""
+		n, t = self._check_input(x)
+		params = self._compute_params()
+		dtype = self._stage_dtype("logsumexp", x.dtype)
+		key = (self.covariance_type, autotune.bucket(n * t), self.in_size,
+			params.w.shape[0], np.dtype(x.dtype).name, dtype.name, self.xp.__name__)
+
+		impls = self._dist_impls()
+		with chainer.no_backprop_mode():
+			name = self.autotuner.choose("dist", key, impls, x, xp=self.xp,
+				approximate=self._approximate_dist_impls())
+
+		_dist = impls[name](x)
+		return _dist, F.broadcast_to(self._cast(params.w, dtype), _dist.shape)
 
 	@promote_x_dtype
-	def _log_proba_intern(self, x):
-		_dist, _w = self._dist(x, return_weights=True)
+	def _log_proba_intern(self, x, use_matmul=None):
+		"""
+			use_matmul selects the implementation of the distances. If it
+			is not set, the autotuner (if any) chooses the fastest one,
+			otherwise the matrix products are used for the shared variances.
+		"""
+		if use_matmul is None and self.autotuner is not None:
+			_dist, _w = self._tuned_dist(x)
+
+		else:
+			if use_matmul is None:
+				# the matrix products are the fast path of the shared variances
+				use_matmul = self.covariance_type != "diag"
+			dist = self._matmul_dist if use_matmul else self._dist
+			_dist, _w = dist(x, return_weights=True)
 
 		# normalize with (2*pi)^k and det(sig) = prod(diagonal_sig)
-		log_det = F.sum(F.log(self.sig), axis=0)
+		params = self._compute_params()
+		log_det = F.sum(F.log(self._full_sig(params.sig, params.w.shape[0])), axis=0)
+		log_det = self._cast(log_det, _dist.dtype)
 		_log_proba = -0.5 * (self.in_size * self._LOG_2PI + _dist + log_det)
 
 		return _log_proba, _w
 
+	@consistent_params
 	def log_proba(self, x, weighted=False, *args, **kwargs):
 		""" computes the log-likelihood """
 
@@ -179,9 +481,14 @@ class BaseEncodingLayer(link.Link, abc.ABC):
 		if weighted:
 			_log_wu = _log_proba + F.log(_w)
 			_log_proba = F.logsumexp(_log_wu, axis=-1)
+		else:
+			# the pruned components have a zero likelihood
+			_log_proba = self._scatter_components(_log_proba, fill=-np.inf)
 
+		_w = self._scatter_components(_w, fill=0)
 		return _log_proba, _w
 
+	@consistent_params
 	def proba(self, *args, **kwargs):
 		""" computes the likelihood """
 		_log_proba, _w = self.log_proba(*args, **kwargs)
@@ -190,23 +497,5 @@ class BaseEncodingLayer(link.Link, abc.ABC):
 	def get_mask(self, x, use_mask, visibility_mask=None):
 		if not use_mask: return Ellipsis
 		_feats = x.array if hasattr(x, "array") else x
-		_feat_lens = self.xp.sqrt(self.xp.sum(_feats**2, axis=2))
-
-
-		if visibility_mask is None:
-			_mean_feat_lens = _feat_lens.mean(axis=1, keepdims=True)
-			selected = _feat_lens >= _mean_feat_lens
-
-		else:
-
-			if 0 in visibility_mask.sum(axis=1):
-				raise RuntimeError("Selection mask contains not selected samples!")
-
-			_mean_feat_lens = (_feat_lens * visibility_mask).sum(axis=1, keepdims=True)
-			_n_visible_feats = visibility_mask.sum(axis=1, keepdims=True).astype(chainer.config.dtype)
-			_mean_feat_lens /= _n_visible_feats
-
-			selected = _feat_lens >= _mean_feat_lens
-			selected = self.xp.logical_and(selected, visibility_mask)
-
+		selected = encoding.selection_mask(_feats, visibility_mask, xp=self.xp)
 		return self.xp.where(selected)
@@ -1,23 +1,89 @@
 import abc
 import chainer
+import hashlib
+import numpy as np
 
 from chainer import functions as F
-
+from chainer.backends import cuda
+from functools import partial
+
+from fve_layer.backends.chainer.functions import fisher_linear
+from fve_layer.backends.chainer.functions import fisher_normalize
+from fve_layer.common import cache
+from fve_layer.common import encoding
+from fve_layer.common import kernel
+from fve_layer.common import parallel
+from fve_layer.common import quantization
+from fve_layer.common import sparse
 from fve_layer.backends.chainer.links.gmm import GMMLayer
 from fve_layer.backends.chainer.links.gmm import GMMMixin
 from fve_layer.backends.chainer.links.base import BaseEncodingLayer
+from fve_layer.backends.chainer.links.base import ParamSnapshot
+from fve_layer.backends.chainer.links.base import consistent_params
 from fve_layer.backends.chainer.links.base import promote_x_dtype
 
 
 class FVEMixin(abc.ABC):
+	STATISTICS = ("mu", "sig")
 
-	@promote_x_dtype
-	def encode(self, x, use_mask=False, visibility_mask=None, eps=1e-6):
-		gamma = self.soft_assignment(x)
+	def __init__(self, *args, statistics="both",
+		power=None, intra_norm=False, l2_norm=False, cache_kwargs=None, **kwargs):
+		"""
+			power, intra_norm, l2_norm: normalization of the encoding
+			("improved" Fisher vector: power=0.5 and l2_norm=True)
+			cache_kwargs: if set, the encodings are cached on the disk with
+			              these arguments (see new_cache and encode_cached)
+		"""
+		super(FVEMixin, self).__init__(*args, **kwargs)
+		self.statistics = self._check_statistics(statistics)
+		self.normalization = dict(power=power, intra=intra_norm, l2=l2_norm)
+		self.cache = None if cache_kwargs is None else self.new_cache(**cache_kwargs)
+
+	@classmethod
+	def _check_statistics(cls, statistics):
+		if statistics == "both":
+			statistics = cls.STATISTICS
+
+		elif isinstance(statistics, str):
+			statistics = (statistics,)
+
+		if not statistics or any(s not in cls.STATISTICS for s in statistics):
+			raise ValueError(
+				"\"statistics\" should be either \"both\" or a subset of " + \
+				f"{cls.STATISTICS}, but was {statistics}!"
+			)
+		# keep the order of the output layout stable
+		return tuple(s for s in cls.STATISTICS if s in statistics)
+
+	@property
+	def output_size(self):
+		return len(self.statistics) * self.n_components * self.in_size
+
+	@property
+	def printable_specs(self):
+		yield from super(FVEMixin, self).printable_specs
+		yield ('statistics', self.statistics)
+		yield ('normalization', self.normalization)
+
+	@property
+	def normalized(self):
+		return self.normalization["power"] is not None or \
+			self.normalization["intra"] or self.normalization["l2"]
+
+	def _fisher_contributions(self, x, use_mask=False, visibility_mask=None, eps=1e-6):
+		"""
+			Computes the soft assignment once and returns the contributions
+			of every single feature to the selected statistics, each with
+			the shape (n, t, in_size, n_components), and the selection mask
+			of the features with the shape (n, t, 1, 1). Only the active
+			components are computed (see _scatter_components).
+		"""
+		gamma = self._soft_assignment(x)
 		xp = self.xp
 		_x, *params = self._expand_params(x)
 
-		_gamma = F.expand_dims(gamma, axis=2)
+		# soft assignment may have a higher precision than the features
+		_gamma = F.expand_dims(self._cast(gamma, _x.dtype), axis=2)
 		_mu, _sig, _w = [p for p in params]
 
 		"""
@@ -30,11 +96,11 @@ class FVEMixin(abc.ABC):
 
 		"""
 		# mask out all gammas, that are < eps
-		eps_mask = (_gamma.array >= eps).astype(chainer.config.dtype)
+		eps_mask = (_gamma.array >= eps).astype(_gamma.dtype)
 		_gamma *= eps_mask
 
 		# mask out all weights, that are < eps
-		eps_mask = (_w.array >= eps).astype(chainer.config.dtype)
+		eps_mask = (_w.array >= eps).astype(_w.dtype)
 		_w = _w * eps_mask
 
 		### Here the computations begin
@@ -42,11 +108,61 @@ class FVEMixin(abc.ABC):
 		_x_mu_sig = (_x - _mu) / _std
 
 		mask = self.get_mask(x, use_mask, visibility_mask)
-		selected = xp.zeros(_x_mu_sig.shape, dtype=_x_mu_sig.dtype)
+		selected = xp.zeros(x.shape[:2] + (1, 1), dtype=_x_mu_sig.dtype)
 		selected[mask] = 1
 
-		G_mu = _gamma * _x_mu_sig * selected
-		G_sig = _gamma * (_x_mu_sig**2 - 1) * selected
+		# the skipped statistics are never computed
+		G = dict()
+		if "mu" in self.statistics:
+			G["mu"] = _gamma * _x_mu_sig * selected
+
+		if "sig" in self.statistics:
+			G["sig"] = _gamma * (_x_mu_sig**2 - 1) * selected
+
+		return G, selected
+
+	def _normalize_statistics(self, G, n_selected, normalize=True):
+		"""
+			Normalizes the summed statistics (each of the shape
+			(..., in_size, n_components)) by the number of the selected
+			features (with the shape (...)) and the component weights.
+			Returns the encoding with the shape (..., S*n_components*in_size).
+			If normalize is set, the normalization of the layer
+			(see FVEMixin.__init__) is applied as well.
+		"""
+		_G = next(iter(G.values()))
+		lead_shape = _G.shape[:-2]
+
+		n_selected = n_selected.reshape(lead_shape + (1, 1)).astype(_G.dtype)
+		_w = self._cast(self._compute_params().w, _G.dtype)
+		_w = F.broadcast_to(_w, _G.shape)
+
+		if "mu" in G:
+			G["mu"] = G["mu"] / n_selected / F.sqrt(_w)
+
+		if "sig" in G:
+			G["sig"] = G["sig"] / n_selected / F.sqrt(2 * _w)
+
+		# S * (..., in_size, n_components) -> (..., S, in_size, n_components)
+		# (S is the number of the selected statistics)
+		res = F.stack([G[key] for key in self.statistics], axis=len(lead_shape))
+		# (..., S, in_size, n_components) -> (..., S, n_components, in_size)
+		res = F.swapaxes(res, -1, -2)
+		# zero blocks for the pruned components
+		res = self._scatter_components(res, axis=-2)
+		# (..., S, n_components, in_size) -> (..., S*in_size*n_components)
+		res = F.reshape(res, lead_shape + (-1,))
+
+		if normalize and self.normalized:
+			res = fisher_normalize(res, self.in_size, self.n_components,
+				**self.normalization)
+
+		return self._cast(res, self._stage_dtype("output", res.dtype))
+
+	@consistent_params
+	@promote_x_dtype
+	def encode(self, x, use_mask=False, visibility_mask=None, eps=1e-6, *, normalize=True):
+		G, selected = self._fisher_contributions(x, use_mask, visibility_mask, eps)
 
 		"""
 			Here we are not so sure about the normalization factor.
@@ -69,30 +185,323 @@ class FVEMixin(abc.ABC):
 		# G_mu = F.sum(G_mu, axis=1) / xp.sqrt(selected.sum(axis=1))
 		# G_sig = F.sum(G_sig, axis=1) / xp.sqrt(selected.sum(axis=1))
 		# Version 2:
-		G_mu = F.sum(G_mu, axis=1) / selected.sum(axis=1)
-		G_sig = F.sum(G_sig, axis=1) / selected.sum(axis=1)
-
-		_w = F.broadcast_to(self.w, G_mu.shape)
-		G_mu /= F.sqrt(_w)
-		G_sig /= F.sqrt(2 * _w)
-
-		# 2 * (n, in_size, n_components) -> (n, 2, in_size, n_components)
-		res = F.stack([G_mu, G_sig], axis=1)
-		# (n, 2, in_size, n_components) -> (n, 2, n_components, in_size)
-		res = res.transpose(0, 1, 3, 2)
-		# res = F.stack([G_mu], axis=-1)
-		# (n, 2, n_components, in_size) -> (n, 2*in_size*n_components)
-		res = F.reshape(res, (x.shape[0], -1))
+		G = {key: self._reduce_sum(g, axis=1, stage="stats") for key, g in G.items()}
+		n_selected = selected.sum(axis=(1, 2, 3))
+
+		return self._normalize_statistics(G, n_selected, normalize)
+
+	@consistent_params
+	@promote_x_dtype
+	def encode_regions(self, x, regions, use_mask=False, visibility_mask=None, eps=1e-6, *,
+		normalize=True):
+		"""
+			Pools the Fisher vectors of several regions (e.g. spatial
+			pyramid cells or parts) of the same features. The soft
+			assignment and the contributions of the features are computed
+			only once and reduced per region with one batched matrix product.
+
+			regions: region membership (binary or soft) of the features
+			         with the shape (n, R, t) or (R, t)
+
+			Returns an array with the shape (n, R, S*n_components*in_size).
+			If use_mask is set, the features are selected w.r.t. all
+			features of a sample (not per region).
+		"""
+		n, t = self._check_input(x)
+		G, selected = self._fisher_contributions(x, use_mask, visibility_mask, eps)
+		_G = next(iter(G.values()))
+
+		regions = self.xp.asarray(getattr(regions, "array", regions))
+		if regions.ndim == 2:
+			regions = self.xp.broadcast_to(regions, (n,) + regions.shape)
+
+		assert regions.shape[0] == n and regions.shape[2] == t, \
+			f"Region membership has a wrong shape: {regions.shape}, expected (n={n}, R, t={t})"
+		R = regions.shape[1]
+		# the sums over the features are accumulated in the dtype of the
+		# "stats" stage (see _reduce_sum)
+		stats_dtype = self._stage_dtype("stats", _G.dtype)
+		regions = regions.astype(stats_dtype)
+
+		shape = _G.shape[2:]
+		for key, g in G.items():
+			# (n, R, t) x (n, t, in_size*n_components) -> (n, R, in_size*n_components)
+			g = F.matmul(regions, F.reshape(self._cast(g, stats_dtype), (n, t, -1)))
+			G[key] = F.reshape(g, (n, R) + shape)
+
+		n_selected = (regions * selected.reshape(n, 1, t)).sum(axis=-1)
+		# empty regions result in zero-vectors
+		n_selected = self.xp.maximum(n_selected, 1)
+
+		return self._normalize_statistics(G, n_selected, normalize)
+
+	@consistent_params
+	@promote_x_dtype
+	def encode_linear(self, x, W, b=None, use_mask=False, visibility_mask=None, eps=1e-6, *,
+		chunk_size=16):
+		"""
+			Computes F.linear(self.encode(x, ...), W, b) without storing the
+			encoding or its gradient (see functions.FisherLinear). The soft
+			assignment is computed with matrix products (see _matmul_dist).
+
+			W: weights with the shape (out_size, S*n_components*in_size)
+
+			The logits are linear in the statistics only for the
+			unnormalized encoding, hence the normalization is skipped.
+		"""
+		n, t = self._check_input(x)
+		dtype = self._stage_dtype("stats", x.dtype)
+		xp = self.xp
+
+		gamma = self._cast(self._soft_assignment(x, use_matmul=True), dtype)
+		# mask out all gammas, that are < eps (see _fisher_contributions)
+		gamma = gamma * (gamma.array >= eps).astype(dtype)
+
+		mask = self.get_mask(x, use_mask, visibility_mask)
+		selected = xp.zeros((n, t, 1), dtype=dtype)
+		selected[mask] = 1
+		gamma = gamma * xp.broadcast_to(selected, gamma.shape)
+
+		params = self._compute_params()
+		sig = self._full_sig(params.sig, params.w.shape[0])
+		W = self._gather_components(W)
+		mu, sig, w, W = [self._cast(p, dtype) for p in (params.mu, sig, params.w, W)]
+
+		y = fisher_linear(self._cast(x, dtype), gamma, mu, sig, w, W,
+			selected.sum(axis=(1, 2)),
+			statistics=self.statistics,
+			chunk_size=chunk_size)
+
+		if b is not None:
+			y = F.bias(y, self._cast(b, y.dtype))
+
+		return self._cast(y, self._stage_dtype("output", y.dtype))
+
+	def _gather_components(self, W):
+		""" selects the weights (out_size, S*n_components*in_size) of
+			the active components
+		"""
+		active = self._current_params().active
+		if active is None:
+			return W
+
+		out_size = W.shape[0]
+		S = len(self.statistics)
+		W = F.reshape(W, (out_size, S, self.n_components, self.in_size))
+		W = F.get_item(W, (slice(None), slice(None), active.idx))
+		return F.reshape(W, (out_size, -1))
+
+	def _scatter_encoding(self, fv, active, out=None):
+		""" graph-free equivalent of _scatter_components for the encodings
+			of the active components (n, S*n_active*in_size)
+		"""
+		if active is None:
+			return fv
+
+		n = len(fv)
+		if out is None:
+			out = self.xp.zeros((n, self.output_size), dtype=fv.dtype)
+		blocks = encoding._as_blocks(out, self.in_size, self.n_components)
+		blocks[:] = 0
+		blocks[:, :, active.idx] = encoding._as_blocks(fv, self.in_size, len(active.idx))
+		return out
+
+	def _graph_free_inputs(self, x, use_mask=False, visibility_mask=None):
+		""" returns the arrays of the input, of the parameters of the
+			active components and the selection of the features (or None)
+			for the graph-free encodings
+		"""
+		_x = getattr(x, "array", x)
+		self._check_input(_x)
+		params = self._compute_params()
+		mu, sig, w = [getattr(p, "array", p) for p in (params.mu, params.sig, params.w)]
+		# the graph-free encodings expect the variances of every component
+		sig = self._full_sig(sig, len(w))
+
+		selected = None
+		if use_mask:
+			mask = self.get_mask(_x, use_mask, visibility_mask)
+			selected = self.xp.zeros(_x.shape[:2], dtype=mu.dtype)
+			selected[mask] = 1
+
+		return _x, (mu, sig, w), selected
+
+	def encode_sparse(self, x, use_mask=False, visibility_mask=None, eps=1e-6):
+		"""
+			Block-sparse encoding (see fve_layer.common.sparse): only the
+			blocks of the components with assigned features are computed
+			and stored. No computational graph is created, hence this is
+			meant for inference only.
+		"""
+		with self.pinned_params() as params:
+			_x, (mu, sig, w), selected = self._graph_free_inputs(x, use_mask, visibility_mask)
+
+		res = sparse.encode(_x, mu, sig, w, selected, eps=eps,
+			statistics=self.statistics, xp=self.xp)
+
+		if params.active is not None:
+			res.components = params.active.idx[res.components]
+			res.n_components = self.n_components
+
+		if self.normalized:
+			res = res.normalize(**self.normalization)
+		return res
+
+	def encode_parallel(self, x, use_mask=False, visibility_mask=None, eps=1e-6, *,
+		n_threads=None, batch_chunk=None, t_chunk=None, out=None):
+		"""
+			CPU execution mode of the encoding: the batch (and long feature
+			sequences) are split across a thread pool and the encodings are
+			written into one preallocated output array. No computational
+			graph is created, hence this is meant for inference only.
+		"""
+		assert self.xp is np, \
+			"Parallel encoding is only supported on the CPU!"
+
+		with self.pinned_params() as params:
+			_x, (mu, sig, w), selected = self._graph_free_inputs(x, use_mask, visibility_mask)
+
+		encoder = parallel.get_encoder(n_threads,
+			batch_chunk=batch_chunk, t_chunk=t_chunk)
+		res = encoder(_x, mu, sig, w, selected, eps=eps,
+			out=out if params.active is None else None,
+			statistics=self.statistics)
+		res = self._scatter_encoding(res, params.active, out=out)
+
+		if not self.normalized:
+			return res
+
+		res[:] = encoding.normalize(res, self.in_size, self.n_components,
+			**self.normalization)
 		return res
 
+	def gram_matrix(self, X, Y=None, use_mask=False, eps=1e-6, *,
+		out=None, block_size=256, cache_size=4, n_threads=None):
+		"""
+			Fisher kernel between the samples of X and Y (or X), each with
+			the shape (N, t, in_size), that is computed in blocks with the
+			parallel encoding (see fve_layer.common.kernel.gram_matrix).
+			X and Y may be np.memmap arrays, out may be a file name of
+			the resulting np.memmap.
+		"""
+		def encode(x):
+			return self.encode_parallel(np.asarray(x), use_mask, eps=eps,
+				n_threads=n_threads)
+
+		return kernel.gram_matrix(encode, X, Y,
+			out=out,
+			block_size=block_size,
+			cache_size=cache_size)
+
+	def new_quantizer(self, **kwargs):
+		""" product quantizer matching the layout of the encoding
+			(see fve_layer.common.quantization.ProductQuantizer)
+		"""
+		return quantization.ProductQuantizer(
+			self.in_size, self.n_components, len(self.statistics), **kwargs)
+
+	def new_cache(self, **kwargs):
+		""" disk-backed cache of the encodings
+			(see fve_layer.common.cache.EncodingCache)
+		"""
+		kwargs.setdefault("dtype", self.mu.dtype)
+		return cache.EncodingCache(self.output_size, **kwargs)
+
+	def _param_version(self):
+		""" version of the pinned parameters. Without a versioned snapshot
+			(e.g. parameters trained by backprop), it is a digest of them.
+		"""
+		params = self._current_params()
+		if params.version is not None:
+			return params.version
+
+		digest = hashlib.sha1()
+		for param in params[:3]:
+			digest.update(cuda.to_cpu(getattr(param, "array", param)).tobytes())
+		return digest.hexdigest()
+
+	def _cache_keys(self, ids, use_mask, visibility_mask, eps, normalize):
+		settings = (use_mask, float(eps), bool(normalize))
+		if visibility_mask is None:
+			return [(_id, *settings, None) for _id in ids]
+
+		# the visibility of the features is part of the key
+		masks = cuda.to_cpu(getattr(visibility_mask, "array", visibility_mask))
+		return [(_id, *settings, hashlib.sha1(np.ascontiguousarray(mask)).hexdigest())
+			for _id, mask in zip(ids, masks)]
+
+	def _encoding_input(self, x):
+		""" maps the input of forward to the input of encode """
+		return x
+
+	def _use_cache(self, ids):
+		return ids is not None and self.cache is not None and not chainer.config.train
+
+	@consistent_params
+	def encode_cached(self, ids, x, use_mask=False, visibility_mask=None, eps=1e-6, *,
+		normalize=True):
+		"""
+			Encodes the samples with the given ids (hashable) via the cache
+			of the layer. Only the cache misses are encoded, hence the
+			features x are either an array (n, t, in_size) or a callable,
+			that returns the features of the given ids (e.g. a frozen
+			backbone). The cache is invalidated, if the parameters change.
+
+			The result is a constant, i.e. it is not differentiated.
+		"""
+		assert self.cache is not None, \
+			"Cache is not enabled (see cache_kwargs)!"
+
+		ids = ids.tolist() if hasattr(ids, "tolist") else list(ids)
+		keys = self._cache_keys(ids, use_mask, visibility_mask, eps, normalize)
+		version = self._param_version()
+		hits, res = self.cache.get(keys, version)
+		missing = np.flatnonzero(~hits)
+
+		if len(missing):
+			_x = x([ids[i] for i in missing]) if callable(x) else x[missing]
+			_mask = None if visibility_mask is None else visibility_mask[missing]
+
+			with chainer.no_backprop_mode():
+				fv = self.encode(self._encoding_input(_x), use_mask, _mask, eps,
+					normalize=normalize)
+
+			fv = cuda.to_cpu(fv.array)
+			res[missing] = fv
+			self.cache.put([keys[i] for i in missing], fv, version)
+
+		return chainer.Variable(self.xp.asarray(res))
+
 class FVELayer(FVEMixin, GMMLayer):
 
-	def forward(self, x, use_mask=False, visibility_mask=None):
-		_ = super(FVELayer, self).forward(x, use_mask, visibility_mask)
+	def _encoding_input(self, x):
+		return self.whiten(x)
+
+	def forward(self, x, use_mask=False, visibility_mask=None, ids=None):
+		"""
+			ids: if set (and the cache is enabled), the encodings are
+			     looked up in the cache in the evaluation mode
+		"""
+		if self._use_cache(ids):
+			return self.encode_cached(ids, x, use_mask, visibility_mask)
+		x = super(FVELayer, self).forward(x, use_mask, visibility_mask)
 		return self.encode(x, use_mask, visibility_mask)
 
 class FVELayer_noEM(FVEMixin, GMMMixin, BaseEncodingLayer):
 
+	def __init__(self, *args, recompute=False, recompute_chunk=None, **kwargs):
+		"""
+			recompute:       if set, the backward pass of encode keeps only
+			                 the input and the parameters and recomputes the
+			                 (n, t, in_size, n_components) intermediates
+			                 (see encode_recomputed).
+			recompute_chunk: if set, the features are recomputed in chunks of
+			                 recompute_chunk features (along t).
+		"""
+		super(FVELayer_noEM, self).__init__(*args, **kwargs)
+		self.recompute = recompute
+		self.recompute_chunk = recompute_chunk
+
 	def _init_initializers(self, init_mu, init_sig, dtype):
 		init_sig = self.xp.log(init_sig - self.eps)
 		super(FVELayer_noEM, self)._init_initializers(init_mu, init_sig, dtype)
@@ -107,7 +516,7 @@ class FVELayer_noEM(FVEMixin, GMMMixin, BaseEncodingLayer):
 
 		self._sig = chainer.Parameter(
 			initializer=self.init_sig,
-			shape=(self.in_size, self.n_components),
+			shape=self.sig_shape,
 			name="sig")
 
 		self._w = chainer.Parameter(
@@ -119,7 +528,10 @@ class FVELayer_noEM(FVEMixin, GMMMixin, BaseEncodingLayer):
 
 	@property
 	def w(self):
-		w_sigmoid = F.sigmoid(self._w)
+		return self._normalized_w(self._w)
+
+	def _normalized_w(self, _w):
+		w_sigmoid = F.sigmoid(_w)
 		res =  w_sigmoid / F.sum(w_sigmoid)
 		#self._ws.append(res)
 		return res
@@ -130,15 +542,18 @@ class FVELayer_noEM(FVEMixin, GMMMixin, BaseEncodingLayer):
 
 	@property
 	def sig(self):
-		return self.eps + F.exp(self._sig)
+		return self._positive_sig(self._sig)
+
+	def _positive_sig(self, _sig):
+		return self.eps + F.exp(_sig)
 
 	def init_params(self):
 		pass
 
 	def set_gmm_params(self, gmm):
 
-		gmm.precisions_cholesky_ = self.precisions_chol.array.T
-		gmm.covariances_ = self.sig.array.T
+		gmm.precisions_cholesky_ = self._sk_covariances(self.precisions_chol.array)
+		gmm.covariances_ = self._sk_covariances(self.sig.array)
 		gmm.means_= self.mu.array.T
 		gmm.weights_= self.w.array
 
@@ -146,5 +561,66 @@ class FVELayer_noEM(FVEMixin, GMMMixin, BaseEncodingLayer):
 	def precisions_chol(self):
 		return 1. / F.sqrt(self.sig)
 
-	def forward(self, x, use_mask=False, visibility_mask=None):
+	@consistent_params
+	@promote_x_dtype
+	def encode(self, x, use_mask=False, visibility_mask=None, eps=1e-6, *, normalize=True):
+		if self.recompute and chainer.config.enable_backprop:
+			return self.encode_recomputed(x, use_mask, visibility_mask, eps,
+				normalize=normalize, chunk_size=self.recompute_chunk)
+		return super(FVELayer_noEM, self).encode(x, use_mask, visibility_mask, eps,
+			normalize=normalize)
+
+	@consistent_params
+	@promote_x_dtype
+	def encode_recomputed(self, x, use_mask=False, visibility_mask=None, eps=1e-6, *,
+		normalize=True, chunk_size=None):
+		"""
+			Computes the same encoding as encode, but the summed statistics
+			of every chunk of chunk_size features (default: all features)
+			are computed by F.forget. Hence, only the input and the raw
+			parameters (mu, _sig, _w) are stored for the backward pass and
+			the soft assignment and the contributions of the features are
+			recomputed chunk by chunk. The activation memory is reduced
+			from several (n, t, in_size, n_components) arrays to the
+			(n, S, in_size, n_components) statistics, at the cost of a
+			second forward pass of the encoding during backward. Without
+			chunks, the intermediates of all features are recomputed at
+			once, hence only chunks reduce the peak memory of backward.
+			Double backpropagation is not supported.
+		"""
+		n, t = self._check_input(x)
+		mask = self.get_mask(x, use_mask, visibility_mask)
+		# the selection depends on all features of a sample, not on a chunk
+		selected = self.xp.zeros((n, t, 1, 1), dtype=x.dtype)
+		selected[mask] = 1
+
+		def statistics(_x, mu, _sig, _w, selected):
+			params = ParamSnapshot(mu, self._positive_sig(_sig), self._normalized_w(_w), None)
+			with self.pinned_params(params):
+				G, _ = self._fisher_contributions(_x, eps=eps)
+				return tuple(self._reduce_sum(G[key] * selected, axis=1, stage="stats")
+					for key in self.statistics)
+
+		if not isinstance(x, chainer.Variable):
+			x = chainer.Variable(x, requires_grad=False)
+
+		chunk_size = chunk_size or t
+		G = None
+		for t0 in range(0, t, chunk_size):
+			chunk = slice(t0, t0 + chunk_size)
+			res = F.forget(partial(statistics, selected=selected[:, chunk]),
+				x[:, chunk], self.mu, self._sig, self._w)
+			res = (res,) if isinstance(res, chainer.Variable) else res
+			G = res if G is None else [g + r for g, r in zip(G, res)]
+
+		G = dict(zip(self.statistics, G))
+		return self._normalize_statistics(G, selected.sum(axis=(1, 2, 3)), normalize)
+
+	def forward(self, x, use_mask=False, visibility_mask=None, ids=None):
+		if chainer.config.train:
+			# the optimizer updates the parameters outside of the layer
+			self.publish_parameters()
+
+		if self._use_cache(ids):
+			return self.encode_cached(ids, x, use_mask, visibility_mask)
 		return self.encode(x, use_mask, visibility_mask)
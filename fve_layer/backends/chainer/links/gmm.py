@@ -1,19 +1,27 @@
 import abc
 import chainer
 import numpy as np
+import warnings
 
 from chainer import functions as F
 from chainer.backends import cuda
 
+from fve_layer.backends.chainer.links.base import ActiveComponents
 from fve_layer.backends.chainer.links.base import BaseEncodingLayer
+from fve_layer.backends.chainer.links.base import ParamSnapshot
+from fve_layer.backends.chainer.links.base import consistent_params
 from fve_layer.backends.chainer.links.base import promote_x_dtype
+from fve_layer.common import checkpoint
 from fve_layer.common import mixtures
-from fve_layer.common import visualization
+from fve_layer.common import sampling
+from fve_layer.common import scoring
+from fve_layer.common.index import ComponentIndex
+from fve_layer.common import shared
 
 class GMMMixin(abc.ABC):
 
 	def __init__(self, *args,
-		gmm_cls=mixtures.GMM,
+		gmm_cls=None,
 		sk_learn_kwargs=dict(
 			max_iter=1,
 			tol=np.inf,
@@ -27,26 +35,103 @@ class GMMMixin(abc.ABC):
 		sk_learn_kwargs["reg_covar"] = sk_learn_kwargs.get("reg_covar", self.eps)
 		self.sk_learn_kwargs = sk_learn_kwargs
 		self.sk_gmm = None
+		self.shared_params = None
 
 	@abc.abstractmethod
 	def set_gmm_params(self, gmm):
 		pass
 
 	def new_gmm(self, gmm_cls=None, *args, **kwargs):
-		return (gmm_cls or self.gmm_cls)(
-			covariance_type="diag",
+		# the mixtures (and sklearn) are only imported, if they are needed
+		tied_diag = self.covariance_type == "tied_diag"
+		gmm = (gmm_cls or self.gmm_cls or mixtures.GMM)(
+			covariance_type="diag" if tied_diag else self.covariance_type,
 			n_components=self.n_components,
 			**kwargs
 		)
+		# the shared diagonal is estimated directly (see mixtures.GPUMixin)
+		gmm.tied_diag = tied_diag
+		return gmm
+
+	def _sk_covariances(self, sig, n_components=None):
+		"""
+			Converts variances (or their inverse square roots) from the
+			layout of the layer to the layout of sklearn: (n_components,
+			in_size) or (n_components,) for the diagonal or spherical
+			covariances. The shared variances of tied_diag are repeated
+			for every component (the mixture fits them as diagonal ones).
+		"""
+		if self.covariance_type == "spherical":
+			return sig[0]
+		elif self.covariance_type == "tied_diag":
+			xp = chainer.backend.get_array_module(sig)
+			shape = (n_components or self.n_components, self.in_size)
+			return xp.ascontiguousarray(xp.broadcast_to(sig[:, 0], shape))
+		return sig.T
+
+	def _layer_sig(self, covariances):
+		""" inverse of _sk_covariances """
+		if self.covariance_type == "spherical":
+			return covariances[None]
+		elif self.covariance_type == "tied_diag":
+			return covariances.mean(axis=0)[:, None]
+		return covariances.T
 
 	def as_sklearn_gmm(self, gmm_cls=None, **gmm_kwargs):
 		gmm = self.new_gmm(gmm_cls=gmm_cls, warm_start=True, **gmm_kwargs)
 		self.set_gmm_params(gmm)
 		return gmm
 
-	def sample(self, n_samples):
-		gmm = self.as_sklearn_gmm(**self.sk_learn_kwargs)
-		return gmm.sample(n_samples)
+	def sample(self, n_samples, *, random_state=None, chunk_size=None, out=None):
+		""" draws samples (n_samples, in_size) and their components from
+			the current mixture (see fve_layer.common.sampling.sample)
+		"""
+		mu, sig, w = [getattr(p, "array", p) for p in self._current_params()[:3]]
+		return sampling.sample(mu.T, sig.T, w, n_samples,
+			random_state=random_state, chunk_size=chunk_size, out=out, xp=self.xp)
+
+	@consistent_params
+	def score(self, X, *, top_k=None, per_feature=True, chunk_size=16384, n_threads=None):
+		"""
+			Chunked and graph-free scoring of the (whitened) features X
+			(N, in_size), e.g. an np.memmap of a whole dataset (see
+			fve_layer.common.scoring.MixtureScorer). Returns the weighted
+			log-likelihoods, the nearest components and their Mahalanobis
+			distances of all features (if per_feature is set) and the top_k
+			features with the lowest log-likelihood.
+		"""
+		params = self._compute_params()
+		mu, sig, w = [getattr(p, "array", p) for p in params[:3]]
+		scorer = scoring.MixtureScorer(mu, sig, w,
+			chunk_size=chunk_size, n_threads=n_threads, xp=self.xp)
+		try:
+			scores = scorer(X, top_k=top_k, per_feature=per_feature)
+		finally:
+			scorer.close()
+
+		active = self._current_params().active
+		if active is not None and scores.nearest is not None:
+			# indices of the active components -> indices of all components
+			scores = scores._replace(nearest=cuda.to_cpu(active.idx)[scores.nearest])
+		return scores
+
+	def share_parameters(self):
+		"""
+			Creates a shared-memory snapshot of the parameters, that can be
+			passed to other processes (e.g. data-loader workers) and is
+			updated on every parameter update. The parameters, that are
+			updated by an optimizer (FVELayer_noEM), are published on the
+			next forward pass in training mode.
+		"""
+		if self.shared_params is None:
+			self.shared_params = shared.SharedParameters.from_layer(self)
+		return self.shared_params
+
+	def publish_parameters(self):
+		if self.shared_params is not None:
+			with chainer.no_backprop_mode():
+				params = self.param_snapshot()
+			self.shared_params.publish(params.mu, params.sig, params.w)
 
 	@property
 	def precisions_chol(self):
@@ -55,33 +140,109 @@ class GMMMixin(abc.ABC):
 			Reference:
 				https://github.com/scikit-learn/scikit-learn/blob/0.21.3/sklearn/mixture/gaussian_mixture.py#L288
 		"""
-		return 1. / self.xp.sqrt(self.sig)
+		return 1. / self.xp.sqrt(self._current_params().sig)
 
-	def plot(self, ax=None, x=None, label=True):
+	def plot(self, ax=None, x=None, label=True, **kwargs):
+		""" kwargs (e.g. density_bins or n_per_component) are passed to plot_gmm """
 		assert self.in_size == 2, \
 			"Plotting is only for 2D mixtures!"
+		from fve_layer.common import visualization
+
 		gmm = self.as_sklearn_gmm()
-		ax = visualization.plot_gmm(gmm, X=x, label=label, ax=ax, nsig=1)
+		kwargs.setdefault("nsig", 1)
+		ax = visualization.plot_gmm(gmm, X=x, label=label, ax=ax, **kwargs)
 		# visualization.plot_grad(list(self.params()), ax=ax)
+		return ax
 
 class GMMLayer(GMMMixin, BaseEncodingLayer):
 
 	def __init__(self, in_size, n_components, *,
 		init_from_data=False,
 		alpha=0.99,
+		pca_size=None,
+		whitening_interval=100,
+		whitening_eps=1e-5,
+		prune_eps=None,
+		respawn_interval=None,
+		respawn_scale=0.5,
+		index_kwargs=None,
+		update_interval=1,
+		decay_threshold=None,
+		max_update_interval=None,
+		max_update_features=None,
+		subsampling="uniform",
+		subsampling_seed=None,
+		visualization_interval=None,
+		visualization_folder="mu_change",
 		**kwargs):
-		super(GMMLayer, self).__init__(in_size, n_components, **kwargs)
+		"""
+			pca_size:         if set, the input features (with in_size dimensions)
+			                  are projected onto their pca_size whitened principal
+			                  components (see whiten) and the mixture is estimated
+			                  in this space, i.e. self.in_size is set to pca_size.
+			prune_eps:        if set, components with a weight below prune_eps
+			                  are pruned after every update (see prune_components).
+			respawn_interval: if set, the pruned components are respawned every
+			                  respawn_interval updates by splitting the heaviest
+			                  components (see respawn_components).
+			index_kwargs:     if set, the soft assignment is computed coarse-to-fine
+			                  with a ComponentIndex, that is created with these
+			                  arguments (see component_index), whenever no
+			                  gradient w.r.t. the input is required.
+
+			EM schedule (see forward):
+			update_interval:     the mixture is updated every update_interval
+			                     training iterations.
+			decay_threshold:     if set, the interval is doubled (up to
+			                     max_update_interval) after every update, that
+			                     changed the means by less than decay_threshold
+			                     (see param_change), otherwise it is reset.
+			max_update_features: if set, an update uses at most this many
+			                     features, that are subsampled "uniform"ly or
+			                     weighted by their "norm" (see subsample).
+
+			visualization_interval: if set, a snapshot of the mixture is rendered
+			                        into visualization_folder every
+			                        visualization_interval updates (see visualize).
+		"""
+		assert subsampling in ("uniform", "norm"), \
+			f"Unknown subsampling: {subsampling}"
+		self.input_size = in_size
+		self.pca_size = pca_size
+		self.whitening_interval = whitening_interval
+		self.whitening_eps = whitening_eps
+		self.prune_eps = prune_eps
+		self.respawn_interval = respawn_interval
+		self.respawn_scale = respawn_scale
+		self.index_kwargs = index_kwargs
+		self._index = None
+		self.update_interval = update_interval
+		self.decay_threshold = decay_threshold
+		self.max_update_interval = max_update_interval
+		self.max_update_features = max_update_features
+		self.subsampling = subsampling
+		self._rnd = np.random.RandomState(subsampling_seed)
+		super(GMMLayer, self).__init__(
+			in_size if pca_size is None else pca_size, n_components, **kwargs)
 
 		with self.init_scope():
 			self.add_persistent("alpha", alpha)
 			self.add_persistent("t", 1)
-
-		self.i = 0
-		self.lim = 1
-		self.visualization_interval = 100
-		self.visualization_folder = "mu_change"
+			# state of the EM schedule: the number of the training
+			# iterations, the current interval and the next update
+			self.add_persistent("iteration", 0)
+			self.add_persistent("interval", update_interval)
+			self.add_persistent("next_update", 1)
+			self.add_persistent("last_change", np.inf)
+			if pca_size is not None:
+				self.add_whitening_params()
+
+		self.visualization_interval = visualization_interval
+		self.visualization_folder = visualization_folder
+		self._renderer = None
 
 		self._initialized = not init_from_data
+		self._sk_gmm_active = None
 
 	def add_params(self, dtype):
 
@@ -89,11 +250,293 @@ class GMMLayer(GMMMixin, BaseEncodingLayer):
 			np.zeros((self.in_size, self.n_components), dtype))
 
 		self.add_persistent("sig",
-			np.zeros((self.in_size, self.n_components), dtype))
+			np.zeros(self.sig_shape, dtype))
 
 		self.add_persistent("w",
 			np.zeros((self.n_components), dtype))
 
+		self.add_persistent("active",
+			np.ones((self.n_components), bool))
+
+		self._snapshot = self._new_snapshot(self.mu, self.sig, self.w, 0)
+
+	def param_snapshot(self):
+		return self._snapshot
+
+	@property
+	def n_active(self):
+		""" number of the active (not pruned) components """
+		return int(self.active.sum())
+
+	def _new_snapshot(self, mu, sig, w, version):
+		""" creates a snapshot with contiguous buffers of the active components """
+		if self.active.all():
+			return ParamSnapshot(mu, sig, w, version)
+
+		xp = self.xp
+		idx = xp.flatnonzero(self.active)
+		order = xp.concatenate([idx, xp.flatnonzero(~self.active)])
+		perm = xp.empty_like(order)
+		perm[order] = xp.arange(len(order))
+		# the tied_diag variances are shared by all components
+		_sig = sig if sig.shape[1] == 1 else sig[:, idx]
+
+		active = ActiveComponents(idx, perm,
+			xp.ascontiguousarray(mu[:, idx]),
+			xp.ascontiguousarray(_sig),
+			xp.ascontiguousarray(w[idx]))
+		return ParamSnapshot(mu, sig, w, version, active)
+
+	def add_whitening_params(self):
+		assert self.pca_size <= self.input_size, \
+			f"PCA size ({self.pca_size}) is larger than the input size ({self.input_size})!"
+		dtype = self.mu.dtype
+		size = self.input_size
+		# EMA of the first and second moments of the features
+		self.add_persistent("pca_mean", np.zeros(size, dtype))
+		self.add_persistent("pca_moment", np.eye(size, dtype=dtype))
+		self.add_persistent("pca_t", 1)
+		# projection and offset, that are currently applied
+		self.add_persistent("pca_proj", np.eye(size, self.pca_size, dtype=dtype))
+		self.add_persistent("pca_offset", np.zeros(size, dtype))
+
+	@property
+	def printable_specs(self):
+		yield from super(GMMLayer, self).printable_specs
+		if self.pca_size is not None:
+			yield ('input_size', self.input_size)
+			yield ('pca_size', self.pca_size)
+
+	def whiten(self, x):
+		"""
+			Projects the features (n, t, input_size) onto the whitened
+			principal components: (n, t, in_size). The centering is folded
+			into the bias of a single matrix product. Without PCA, the
+			features are returned unchanged.
+
+			Except for forward, all methods of the layer expect
+			already whitened features.
+		"""
+		if self.pca_size is None:
+			return x
+
+		n, t, size = x.shape
+		assert size == self.input_size, \
+			f"feature size of the input does not match input size: ({size} != {self.input_size})!"
+
+		proj = self.pca_proj.astype(x.dtype, copy=False)
+		bias = -self.pca_offset.astype(x.dtype, copy=False) @ proj
+		z = F.linear(F.reshape(x, (n * t, size)), proj.T, bias)
+		return F.reshape(z, (n, t, self.in_size))
+
+	def update_whitening(self, x):
+		""" updates the moments with the (selected) features (N, input_size)
+			and recomputes the projection every whitening_interval updates
+		"""
+		_x = getattr(x, "array", x).astype(self.pca_mean.dtype, copy=False)
+		self.pca_mean = self._ema(self.pca_mean, _x.mean(axis=0), t=self.pca_t)
+		self.pca_moment = self._ema(self.pca_moment, _x.T @ _x / len(_x), t=self.pca_t)
+
+		if (self.pca_t - 1) % self.whitening_interval == 0:
+			self.refresh_whitening()
+		self.pca_t += 1
+
+	def refresh_whitening(self):
+		"""
+			Eigendecomposition of the current covariance estimate. The
+			parameters of the mixture are mapped into the new space, i.e.
+			z_new = (z_old @ pinv(P_old) + offset_old - offset_new) @ P_new,
+			where the variances are approximated by the diagonal of the
+			mapped covariance matrices. On the first refresh, the (initial)
+			parameters are kept as they are.
+		"""
+		xp = self.xp
+		mean = self.pca_mean
+		cov = self.pca_moment - xp.outer(mean, mean)
+		eig_vals, eig_vecs = xp.linalg.eigh(cov)
+		# eigh returns the eigenvalues in ascending order
+		idxs = xp.argsort(eig_vals)[::-1][:self.pca_size]
+		eig_vals = xp.maximum(eig_vals[idxs], 0)
+		proj = eig_vecs[:, idxs] / xp.sqrt(eig_vals + self.whitening_eps)
+		proj = proj.astype(self.pca_proj.dtype)
+
+		remap = self._initialized and self.pca_t > 1
+		if remap:
+			A = xp.linalg.pinv(self.pca_proj) @ proj
+			shift = (self.pca_offset - mean) @ proj
+			params = self.param_snapshot()
+			mu = A.T @ params.mu + shift[:, None]
+			sig = (A**2).T @ self._full_sig(params.sig)
+			sig = xp.maximum(self._constrain_sig(sig), self.eps)
+
+		self.pca_proj = proj
+		self.pca_offset = mean.copy()
+
+		if remap:
+			self.set_params(mu=mu, sig=sig)
+			if self.sk_gmm is not None:
+				self._set_gmm_params(self.sk_gmm, self._compute_params())
+
+	def set_params(self, mu=None, sig=None, w=None, active=None):
+		"""
+			Publishes new parameters with a single (atomic) assignment.
+			The arrays of a published snapshot are never modified
+			(copy-on-write), hence readers, that pinned the previous
+			snapshot, can still use it while the parameters are updated.
+		"""
+		prev = self._snapshot
+		mu, sig, w = [
+			prev_param if param is None else self.xp.asarray(param, dtype=prev_param.dtype)
+				for param, prev_param in zip([mu, sig, w], prev)]
+
+		if active is not None:
+			self.active = self.xp.asarray(active, dtype=bool)
+
+		self._snapshot = self._new_snapshot(mu, sig, w, prev.version + 1)
+		# the persistents are still needed for serialization and to_device
+		self.mu, self.sig, self.w = mu, sig, w
+		self.publish_parameters()
+
+	def device_resident_accept(self, visitor):
+		super(GMMLayer, self).device_resident_accept(visitor)
+		self._snapshot = self._new_snapshot(self.mu, self.sig, self.w, self._snapshot.version)
+
+	def serialize(self, serializer):
+		super(GMMLayer, self).serialize(serializer)
+		if isinstance(serializer, chainer.serializer.Deserializer):
+			version = self._snapshot.version + 1
+			self._snapshot = self._new_snapshot(self.mu, self.sig, self.w, version)
+
+	def _state_config(self):
+		return dict(
+			input_size=self.input_size,
+			in_size=self.in_size,
+			n_components=self.n_components,
+			covariance_type=self.covariance_type,
+			pca_size=self.pca_size)
+
+	def save_state(self, folder):
+		"""
+			Saves the complete state of the mixture into a checkpoint folder
+			(see fve_layer.common.checkpoint): all persistents (parameters,
+			EM and whitening statistics, schedule counters), the state of
+			the subsampling and the state of the EM estimator (sk_gmm).
+		"""
+		state = {name: getattr(self, name) for name in self._persistent}
+		layer_arrays, layer_scalars = checkpoint.split_state(state)
+		arrays = {f"layer.{name}": arr for name, arr in layer_arrays.items()}
+
+		rng_name, rng_keys, rng_pos, has_gauss, cached_gauss = self._rnd.get_state()
+		arrays["state.rng_keys"] = rng_keys
+		if self._sk_gmm_active is not None:
+			arrays["state.sk_gmm_active"] = self._sk_gmm_active
+
+		sk_gmm = None
+		if self.sk_gmm is not None:
+			sk_arrays, sk_gmm = checkpoint.estimator_state(self.sk_gmm)
+			arrays.update({f"sk_gmm.{name}": arr for name, arr in sk_arrays.items()})
+
+		checkpoint.save(folder, arrays, dict(
+			layer=type(self).__name__,
+			config=self._state_config(),
+			persistents=layer_scalars,
+			state=dict(
+				initialized=self._initialized,
+				rng=[rng_name, int(rng_pos), int(has_gauss), float(cached_gauss)]),
+			sk_gmm=sk_gmm,
+		))
+
+	def load_state(self, folder, mmap_mode="r"):
+		"""
+			Loads a checkpoint of save_state. With mmap_mode, the arrays
+			of the layer are memory-mapped (on the CPU), hence many
+			processes can share them without a copy. The arrays are never
+			modified in-place, i.e. training can be resumed as well.
+		"""
+		arrays, manifest = checkpoint.load(folder, mmap_mode=mmap_mode)
+		config = self._state_config()
+		if manifest["config"] != config:
+			raise ValueError(
+				f"Checkpoint does not match the layer: {manifest['config']} != {config}")
+
+		def _arrays(prefix):
+			return {name[len(prefix):]: arr for name, arr in arrays.items()
+				if name.startswith(prefix)}
+
+		layer_arrays, layer_scalars = _arrays("layer."), manifest["persistents"]
+		for name in self._persistent:
+			if name in layer_arrays:
+				arr = layer_arrays[name]
+				setattr(self, name, arr if self.xp is np else self.xp.asarray(arr))
+			elif name in layer_scalars:
+				setattr(self, name, layer_scalars[name])
+
+		version = self._snapshot.version + 1
+		self._snapshot = self._new_snapshot(self.mu, self.sig, self.w, version)
+		self.publish_parameters()
+
+		state, state_arrays = manifest["state"], _arrays("state.")
+		self._initialized = state["initialized"]
+		rng_name, rng_pos, has_gauss, cached_gauss = state["rng"]
+		self._rnd.set_state((rng_name, np.array(state_arrays["rng_keys"]),
+			rng_pos, has_gauss, cached_gauss))
+
+		self._sk_gmm_active = None
+		if "sk_gmm_active" in state_arrays:
+			self._sk_gmm_active = self.xp.array(state_arrays["sk_gmm_active"])
+
+		self.sk_gmm = None
+		if manifest["sk_gmm"] is not None:
+			self.sk_gmm = checkpoint.restore_estimator(_arrays("sk_gmm."), manifest["sk_gmm"])
+			self.sk_gmm.autotuner = self.autotuner
+			self.sk_gmm.tied_diag = self.covariance_type == "tied_diag"
+			if self.precision is not None:
+				self.sk_gmm.accum_dtype = self.precision.m_step
+
+		return self
+
+	def prune_components(self, w, active):
+		"""
+			Deactivates the components with a weight below prune_eps (the
+			heaviest component is always kept). The weights of the pruned
+			components are set to zero and the remaining are renormalized.
+			All computations skip the pruned components, only the
+			encodings contain zero blocks for them (the layout is stable).
+		"""
+		xp = self.xp
+		keep = w >= self.prune_eps
+		keep[xp.argmax(w)] = True
+		active = xp.logical_and(active, keep)
+		w = w * active
+		return w / w.sum(), active
+
+	def respawn_components(self, mu, sig, w, active):
+		"""
+			Respawns the pruned components by splitting the heaviest active
+			component (one after another): the means are moved apart by
+			respawn_scale standard deviations along the dimension of the
+			largest variance, the variances are copied and the weight is
+			shared equally.
+		"""
+		xp = self.xp
+		full_sig = self._full_sig(sig)
+
+		for dead in xp.flatnonzero(~active).tolist():
+			heavy = int(xp.argmax(w * active))
+			dim = int(xp.argmax(full_sig[:, heavy]))
+			offset = self.respawn_scale * xp.sqrt(full_sig[dim, heavy])
+
+			mu[:, dead] = mu[:, heavy]
+			mu[dim, dead] += offset
+			mu[dim, heavy] -= offset
+			if sig.shape[1] != 1:
+				sig[:, dead] = sig[:, heavy]
+			w[heavy] /= 2
+			w[dead] = w[heavy]
+			active[dead] = True
+
+		return mu, sig, w, active
+
 	def reset(self):
 		self.t = 1 # pragma: no cover
 
@@ -109,15 +552,22 @@ class GMMLayer(GMMMixin, BaseEncodingLayer):
 
 		gmm.fit(data.reshape(-1, data.shape[-1]))
 
-		self.mu[:]  = self.xp.array(gmm.means_.T)
-		self.sig[:] = self.xp.array(gmm.covariances_.T)
-		self.w[:]   = self.xp.array(gmm.weights_)
+		self.set_params(
+			mu=self.xp.array(gmm.means_.T),
+			sig=self.xp.array(self._layer_sig(gmm.covariances_)),
+			w=self.xp.array(gmm.weights_))
 
 		self._initialized = True
 
 	def set_gmm_params(self, gmm):
-		means_, covariances_, prec_chol_, weights_ = \
-			[self.mu.T, self.sig.T, self.precisions_chol.T, self.w]
+		self._set_gmm_params(gmm, self._current_params())
+
+	def _set_gmm_params(self, gmm, params):
+		means_, covariances_, prec_chol_, weights_ = [
+			params.mu.T,
+			self._sk_covariances(params.sig, len(params.w)),
+			self._sk_covariances(1. / self.xp.sqrt(params.sig), len(params.w)),
+			params.w]
 
 		gmm.precisions_cholesky_ = prec_chol_
 		gmm.covariances_ = covariances_
@@ -125,6 +575,50 @@ class GMMLayer(GMMMixin, BaseEncodingLayer):
 		gmm.weights_= weights_
 
 
+	def component_index(self):
+		"""
+			Two-level index of the active components (see
+			fve_layer.common.index.ComponentIndex). It is rebuilt lazily,
+			whenever the parameters have changed (e.g. by update_parameter
+			or init_from_data), i.e. the version of the snapshot differs.
+		"""
+		params = self._current_params()
+		index = self._index
+		if index is None or index.version != params.version or index.xp is not self.xp:
+			_params = self._compute_params()
+			index = ComponentIndex(_params.mu, _params.sig, _params.w,
+				version=params.version, xp=self.xp, **(self.index_kwargs or {}))
+			self._index = index
+		return index
+
+	@consistent_params
+	def _log_soft_assignment(self, x, use_index=None, **kwargs):
+		"""
+			With use_index, only the components of the nearest coarse
+			cells are evaluated (see component_index) and all others get
+			a log-probability of -inf. This soft assignment is not
+			differentiated, hence by default (use_index=None) the index
+			is only used, if index_kwargs were given and no gradient
+			w.r.t. the input is required. Otherwise, the exact soft
+			assignment is computed.
+		"""
+		needs_grad = chainer.config.enable_backprop and getattr(x, "requires_grad", False)
+		if use_index is None:
+			use_index = self.index_kwargs is not None and not needs_grad
+
+		elif use_index and needs_grad:
+			warnings.warn("The soft assignment of the component index is not "
+				"differentiated, hence no gradient is propagated to the input!")
+
+		if not use_index:
+			return super(GMMLayer, self)._log_soft_assignment(x, **kwargs)
+
+		n, t = self._check_input(x)
+		dtype = self._stage_dtype("logsumexp", x.dtype)
+		_x = getattr(x, "array", x).reshape(n * t, self.in_size).astype(dtype, copy=False)
+		log_gamma = self.component_index().log_soft_assignment(_x)
+		return chainer.Variable(log_gamma.reshape(n, t, -1))
+
 	def _sk_learn_dist(self, x):
 		"""
 			Estimate the log Gaussian probability
@@ -132,9 +626,11 @@ class GMMLayer(GMMMixin, BaseEncodingLayer):
 				https://github.com/scikit-learn/scikit-learn/blob/0.21.3/sklearn/mixture/gaussian_mixture.py#L380
 		"""
 		n, t, size = x.shape
-		_x = x.reshape(-1, size).array
-		_mu = self.mu.T
-		_precs = 1 / self.sig.T
+		dtype = self._stage_dtype("logsumexp", x.dtype)
+		_x = getattr(x, "array", x).reshape(-1, size).astype(dtype, copy=False)
+		params = self._compute_params()
+		_mu = params.mu.T.astype(dtype, copy=False)
+		_precs = 1 / self._full_sig(params.sig, params.w.shape[0]).T.astype(dtype, copy=False)
 
 		res0 = F.sum((_mu ** 2 * _precs), 1)
 		res1 = -2. * F.matmul(_x, (_mu * _precs).T)
@@ -142,33 +638,100 @@ class GMMLayer(GMMMixin, BaseEncodingLayer):
 		res = F.broadcast_to(res0, res1.shape) + res1 + res2
 		return res.reshape(n, t, -1)
 
-	def _log_proba_intern(self, x, use_sk_learn=False):
+	def _dist_impls(self):
+		impls = super(GMMLayer, self)._dist_impls()
+		if not chainer.config.enable_backprop:
+			# the input is not differentiated by this implementation
+			impls["sk_learn"] = self._sk_learn_dist
+		return impls
+
+	def _approximate_dist_impls(self):
+		# the expanded distances of sklearn are not centered
+		return super(GMMLayer, self)._approximate_dist_impls() | {"sk_learn"}
+
+	def _log_proba_intern(self, x, use_sk_learn=False, **kwargs):
 
 		if not use_sk_learn:
-			return super(GMMLayer, self)._log_proba_intern(x)
+			return super(GMMLayer, self)._log_proba_intern(x, **kwargs)
 
 		_x, _mu, _sig, _w = self._expand_params(x)
 		_dist = self._sk_learn_dist(x)
-		prec_chol_ = self.precisions_chol
+		params = self._compute_params()
+		prec_chol_ = 1. / self.xp.sqrt(self._full_sig(params.sig, params.w.shape[0]))
 		# det(precision_chol) is half of det(precision)
 		log_det_chol = self.xp.sum(self.xp.log(prec_chol_), axis=0)
+		log_det_chol = log_det_chol.astype(_dist.dtype, copy=False)
 		_log_proba = -0.5 * (self.in_size * self._LOG_2PI + _dist) + log_det_chol
 
 		return _log_proba, _w
 
 	def forward(self, x, use_mask=False, visibility_mask=None):
+		"""
+			Updates the mixture in training mode and returns the (whitened,
+			see whiten) features.
+		"""
+		if chainer.config.train and self.pca_size is not None:
+			mask = self.get_mask(x, use_mask, visibility_mask)
+			self.update_whitening(x[mask].reshape(-1, self.input_size))
+
+		x = self.whiten(x)
 		if chainer.config.train:
 			mask = self.get_mask(x,
 			                     use_mask=use_mask,
 			                     visibility_mask=visibility_mask)
-			selected = x[mask]
-			selected = selected.reshape(-1, x.shape[-1])
-			self.update_parameter(selected)
+			self.iteration += 1
+			if self.iteration >= self.next_update:
+				selected = x[mask]
+				selected = selected.reshape(-1, x.shape[-1])
+				self.update_parameter(self.subsample(selected))
+				self._schedule_update()
 		return x
 
-	def _ema(self, old, new):
-		prev_correction = 1 - (self.alpha ** (self.t-1))
-		correction = 1 - (self.alpha ** self.t)
+	def subsample(self, x):
+		""" selects at most max_update_features of the features (N, in_size) """
+		if self.max_update_features is None or len(x) <= self.max_update_features:
+			return x
+
+		xp = self.xp
+		u = xp.asarray(self._rnd.rand(len(x)))
+		if self.subsampling == "uniform":
+			keys = u
+		else:
+			# weighted sampling without replacement: the largest u^(1/p)
+			norms = xp.sqrt((getattr(x, "array", x)**2).sum(axis=1))
+			with np.errstate(divide="ignore"):
+				keys = xp.log(u) / norms.astype(u.dtype)
+
+		idxs = xp.argpartition(-keys, self.max_update_features - 1)[:self.max_update_features]
+		return x[xp.sort(idxs)]
+
+	def _schedule_update(self):
+		if self.decay_threshold is None:
+			interval = self.update_interval
+
+		elif self.last_change < self.decay_threshold:
+			interval = 2 * self.interval
+			if self.max_update_interval is not None:
+				interval = min(interval, self.max_update_interval)
+
+		else:
+			interval = self.update_interval
+
+		self.interval = int(interval)
+		self.next_update = self.iteration + self.interval
+
+	def param_change(self, mu, sig):
+		""" mean absolute change of the means (w.r.t. the given parameters)
+			in units of the standard deviations
+		"""
+		params = self.param_snapshot()
+		std = self.xp.sqrt(self._full_sig(sig, params.w.shape[0]))
+		return float((self.xp.abs(params.mu - mu) / std).mean())
+
+	def _ema(self, old, new, t=None):
+		t = self.t if t is None else t
+		prev_correction = 1 - (self.alpha ** (t-1))
+		correction = 1 - (self.alpha ** t)
 
 		uncorrected_old = old * prev_correction
 		res = self.alpha * uncorrected_old + (1 - self.alpha) * new
@@ -176,14 +739,29 @@ class GMMLayer(GMMMixin, BaseEncodingLayer):
 		return res / correction
 
 	def get_new_params(self, x):
+		""" one EM step on x, that only estimates the active components """
 		if self.sk_gmm is None:
 			# self.sk_gmm = self.as_sklearn_gmm(**self.sk_learn_kwargs)
 			self.sk_gmm = self.new_gmm(**self.sk_learn_kwargs)
+			# selects the E-step implementation (see GPUMixin._e_step)
+			self.sk_gmm.autotuner = self.autotuner
+			self._sk_gmm_active = self.active.copy()
+			if self.precision is not None:
+				self.sk_gmm.accum_dtype = self.precision.m_step
+
+		if self._sk_gmm_active is None or (self._sk_gmm_active != self.active).any():
+			# the set of the active components has changed
+			params = self._compute_params()
+			self.sk_gmm.n_components = len(params.w)
+			self._set_gmm_params(self.sk_gmm, params)
+			self._sk_gmm_active = self.active.copy()
 
 		self.sk_gmm.fit(x)
 
-		new_mu, new_sig, new_w = map(self.xp.array,
-			[self.sk_gmm.means_.T, self.sk_gmm.covariances_.T, self.sk_gmm.weights_.T])
+		new_mu, new_sig, new_w = map(self.xp.array, [
+			self.sk_gmm.means_.T,
+			self._layer_sig(self.sk_gmm.covariances_),
+			self.sk_gmm.weights_.T])
 
 
 		return new_mu, new_sig, new_w
@@ -198,13 +776,54 @@ class GMMLayer(GMMMixin, BaseEncodingLayer):
 
 		new_mu, new_sig, new_w = self.get_new_params(x)
 
-		self.w[:] = self._ema(self.w, new_w)
-		self.mu[:]  = self._ema(self.mu, new_mu)
-		self.sig[:] = self._ema(self.sig, new_sig)
+		params = self.param_snapshot()
+		if params.active is None:
+			w = self._ema(params.w, new_w)
+			mu = self._ema(params.mu, new_mu)
+			sig = self._ema(params.sig, new_sig)
+
+		else:
+			# only the active components are updated (copy-on-write)
+			idx = params.active.idx
+			mu, sig, w = [p.copy() for p in params[:3]]
+			w[idx] = self._ema(params.active.w, new_w)
+			mu[:, idx] = self._ema(params.active.mu, new_mu)
+			if sig.shape[1] == 1:
+				sig = self._ema(sig, new_sig)
+			else:
+				sig[:, idx] = self._ema(params.active.sig, new_sig)
 		self.t += 1
 
-		self.sig = self.xp.maximum(self.sig, self.eps)
+		sig = self.xp.maximum(sig, self.eps)
+		active = self.active.copy()
+
+		if self.prune_eps is not None:
+			w, active = self.prune_components(w, active)
+
+		if self.respawn_interval and (self.t - 1) % self.respawn_interval == 0:
+			mu, sig, w, active = self.respawn_components(mu, sig, w, active)
+
+		prev_mu, prev_sig = self.mu, self.sig
+		self.set_params(mu=mu, sig=sig, w=w, active=active)
+		self.last_change = self.param_change(prev_mu, prev_sig)
+
+		if self.visualization_interval:
+			self.visualize(x)
+
+	def visualize(self, x):
+		"""
+			Adds the features of an update to the density of the snapshots
+			and renders a snapshot of the first two dimensions every
+			visualization_interval updates
+			(see fve_layer.common.visualization.SnapshotRenderer).
+		"""
+		if self._renderer is None:
+			from fve_layer.common import visualization
+			self._renderer = visualization.SnapshotRenderer(self.visualization_folder)
+
+		self._renderer.update(cuda.to_cpu(getattr(x, "array", x)))
 
-		# self.i += 1
-		# if (self.i-1) % self.visualization_interval == 0:
-		# 	self.__visualize(x, gamma, new_mu, None, new_w)
+		step = self.t - 1
+		if (step - 1) % self.visualization_interval == 0:
+			mu, sig, w = map(cuda.to_cpu, self.param_snapshot()[:3])
+			self._renderer.render(mu.T, np.broadcast_to(sig, mu.shape).T, w, step)
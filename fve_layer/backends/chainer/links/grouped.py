@@ -0,0 +1,434 @@
+import chainer
+import numpy as np
+
+from chainer import functions as F
+from chainer import initializers
+from chainer import link
+
+from fve_layer.backends.chainer.functions import fisher_normalize
+from fve_layer.backends.chainer.links.base import ParamSnapshot
+from fve_layer.backends.chainer.links.fve import FVEMixin
+from fve_layer.common import encoding
+
+
+class GroupedGMMLayer(link.Link):
+	"""
+		G independent mixtures (e.g. one per part or per scale of a
+		feature map) with stacked parameters: mu and sig have the shape
+		(n_groups, in_size, n_components), w has the shape
+		(n_groups, n_components). The input has the shape
+		(n, n_groups, t, in_size), i.e. the features of every group are
+		evaluated by the corresponding mixture only.
+
+		The soft assignment and the EM update of all groups are computed
+		by batched matrix products, hence there is no per-group call
+		overhead. Only diagonal covariances are supported.
+	"""
+	_LOG_2PI = np.log(2 * np.pi)
+
+	def __init__(self, in_size, n_components, n_groups, *,
+		init_mu=None,
+		init_sig=1,
+		eps=1e-2,
+		alpha=0.99,
+		init_from_data=False,
+		random_state=None,
+		dtype=chainer.get_dtype(map_mixed16=np.float32)):
+		"""
+			init_mu, init_sig: initial parameters, that are broadcasted to
+			                   (n_groups, in_size, n_components). init_mu
+			                   is a scale of the uniform initialization
+			                   (default: 1), an array or an initializer.
+			init_from_data:    if set, the means are initialized on the first
+			                   update with random (selected) features of every
+			                   group and the variances with their variance
+			                   (see init_from_data).
+		"""
+		super(GroupedGMMLayer, self).__init__()
+		self.in_size = in_size
+		self.n_components = n_components
+		self.n_groups = n_groups
+		self._rnd = np.random.RandomState(random_state)
+
+		if init_mu is None or isinstance(init_mu, (int, float)):
+			init_mu = initializers.Uniform(scale=1 if init_mu is None else init_mu, dtype=dtype)
+		elif not isinstance(init_mu, chainer.initializer.Initializer):
+			init_mu = initializers.Constant(init_mu, dtype=dtype)
+
+		shape = (n_groups, in_size, n_components)
+		mu = np.empty(shape, dtype=dtype)
+		sig = np.empty(shape, dtype=dtype)
+		init_mu(mu)
+		initializers.Constant(init_sig, dtype=dtype)(sig)
+		w = np.full((n_groups, n_components), 1 / n_components, dtype=dtype)
+
+		with self.init_scope():
+			self.add_persistent("eps", eps)
+			self.add_persistent("alpha", alpha)
+			self.add_persistent("t", 1)
+			self.add_persistent("mu", mu)
+			self.add_persistent("sig", sig)
+			self.add_persistent("w", w)
+
+		self._snapshot = ParamSnapshot(self.mu, self.sig, self.w, 0)
+		self._initialized = not init_from_data
+
+	@property
+	def printable_specs(self):
+		specs = [
+			('in_size', self.in_size),
+			('n_components', self.n_components),
+			('n_groups', self.n_groups),
+			('eps', self.eps),
+		]
+		for spec in specs:
+			yield spec
+
+	@classmethod
+	def from_layers(cls, layers, **kwargs):
+		"""
+			Stacks the parameters of several layers (e.g. GMMLayer or
+			FVELayer) with the same in_size and n_components into one
+			grouped layer. The variances are broadcasted to diagonal ones.
+		"""
+		in_size, n_components = layers[0].in_size, layers[0].n_components
+		assert all((l.in_size, l.n_components) == (in_size, n_components) for l in layers), \
+			"All layers should have the same input size and number of components!"
+
+		kwargs.setdefault("dtype", layers[0].mu.dtype)
+		res = cls(in_size, n_components, len(layers), **kwargs)
+
+		mu, sig, w = zip(*[[getattr(p, "array", p) for p in l._current_params()[:3]]
+			for l in layers])
+		sig = [l._full_sig(s) for l, s in zip(layers, sig)]
+		res.set_params(*[res.xp.stack(p) for p in (mu, sig, w)])
+		return res
+
+	def param_snapshot(self):
+		""" returns the current parameters as one consistent tuple """
+		return self._snapshot
+
+	def set_params(self, mu=None, sig=None, w=None):
+		"""
+			Publishes new parameters with a single (atomic) assignment
+			(copy-on-write, see GMMLayer.set_params).
+		"""
+		prev = self._snapshot
+		mu, sig, w = [
+			prev_param if param is None else self.xp.asarray(param, dtype=prev_param.dtype)
+				for param, prev_param in zip([mu, sig, w], prev)]
+
+		self._snapshot = ParamSnapshot(mu, sig, w, prev.version + 1)
+		self.mu, self.sig, self.w = mu, sig, w
+
+	def device_resident_accept(self, visitor):
+		super(GroupedGMMLayer, self).device_resident_accept(visitor)
+		self._snapshot = ParamSnapshot(self.mu, self.sig, self.w, self._snapshot.version)
+
+	def serialize(self, serializer):
+		super(GroupedGMMLayer, self).serialize(serializer)
+		if isinstance(serializer, chainer.serializer.Deserializer):
+			version = self._snapshot.version + 1
+			self._snapshot = ParamSnapshot(self.mu, self.sig, self.w, version)
+
+	def _check_input(self, x):
+		assert x.ndim == 4, \
+			"input should have following dimensions: (batch_size, n_groups, n_features, feature_size)"
+		n, G, t, in_size = x.shape
+		assert G == self.n_groups, \
+			f"number of the groups does not match: ({G} != {self.n_groups})!"
+		assert in_size == self.in_size, \
+			f"feature size of the input does not match input size: ({in_size} != {self.in_size})!"
+		return n, t
+
+	def _promote(self, x, params):
+		dtype = np.promote_types(x.dtype, params.mu.dtype)
+		return x if x.dtype == dtype else F.cast(x, dtype)
+
+	@staticmethod
+	def _center(mu):
+		""" reference point (n_groups, in_size) of the features and the
+			means of every group (see encoding.EncodingParams)
+		"""
+		return mu.mean(axis=-1)
+
+	def _log_wu(self, x, params):
+		"""
+			Weighted log-likelihoods of the features x (n_groups, N,
+			in_size) under the components of their group: (n_groups,
+			N, n_components). The squared Mahalanobis distances are
+			expanded into batched matrix products (see
+			BaseEncodingLayer._matmul_dist) of the features and the
+			means relative to the reference point of their group.
+		"""
+		xp = self.xp
+		G, N, _ = x.shape
+		mu, sig, w = [p.astype(x.dtype, copy=False) for p in params[:3]]
+		center = self._center(mu)
+		x = x - xp.broadcast_to(center[:, None], x.shape)
+		mu = mu - center[..., None]
+		prec = 1 / sig
+		shape = (G, N, self.n_components)
+
+		_dist = F.matmul(x**2, prec) - 2 * F.matmul(x, mu * prec)
+
+		# normalization and the weights do not depend on the features
+		const = xp.sum(mu**2 * prec, axis=1) + xp.sum(xp.log(sig), axis=1) + \
+			self.in_size * self._LOG_2PI
+		const = -0.5 * const + xp.log(xp.maximum(w, xp.finfo(w.dtype).tiny))
+		return -0.5 * _dist + xp.broadcast_to(const[:, None], shape)
+
+	def _as_groups(self, x):
+		""" (n, n_groups, t, in_size) -> (n_groups, n*t, in_size) """
+		n, t = self._check_input(x)
+		if isinstance(x, chainer.Variable):
+			x = F.transpose(x, (1, 0, 2, 3))
+		else:
+			x = x.transpose(1, 0, 2, 3)
+		return x.reshape(self.n_groups, n * t, self.in_size)
+
+	def _from_groups(self, y, n, t):
+		""" (n_groups, n*t, n_components) -> (n, n_groups, t, n_components) """
+		y = F.reshape(y, (self.n_groups, n, t, -1))
+		return F.transpose(y, (1, 0, 2, 3))
+
+	def log_soft_assignment(self, x, params=None):
+		""" log-posteriors (n, n_groups, t, n_components) of the features """
+		n, t = self._check_input(x)
+		params = params or self.param_snapshot()
+		_x = self._as_groups(self._promote(x, params))
+
+		_log_wu = self._log_wu(_x, params)
+		_log_wu_sum = F.broadcast_to(F.logsumexp(_log_wu, axis=-1)[..., None], _log_wu.shape)
+		return self._from_groups(_log_wu - _log_wu_sum, n, t)
+
+	def soft_assignment(self, x, params=None):
+		""" posteriors (n, n_groups, t, n_components) of the features """
+		return F.exp(self.log_soft_assignment(x, params))
+
+	def log_proba(self, x, params=None):
+		""" log-likelihoods (n, n_groups, t) of the features under the mixture of their group """
+		n, t = self._check_input(x)
+		params = params or self.param_snapshot()
+		_x = self._as_groups(self._promote(x, params))
+
+		_log_proba = F.logsumexp(self._log_wu(_x, params), axis=-1)
+		return F.transpose(F.reshape(_log_proba, (self.n_groups, n, t)), (1, 0, 2))
+
+	def get_mask(self, x, use_mask, visibility_mask=None):
+		"""
+			Selection (n, n_groups, t) of the features of every group
+			(see fve_layer.common.encoding.selection_mask) or None.
+			The visibility_mask has the shape (n, t) or (n, n_groups, t).
+		"""
+		if not use_mask:
+			return None
+
+		_x = getattr(x, "array", x)
+		n, G, t, in_size = _x.shape
+		if visibility_mask is not None:
+			visibility_mask = getattr(visibility_mask, "array", visibility_mask)
+			if visibility_mask.ndim == 2:
+				visibility_mask = visibility_mask[:, None]
+			visibility_mask = self.xp.broadcast_to(visibility_mask, (n, G, t)).reshape(n * G, t)
+
+		selected = encoding.selection_mask(_x.reshape(n * G, t, in_size),
+			visibility_mask, xp=self.xp)
+		return selected.reshape(n, G, t)
+
+	def init_from_data(self, x, selected=None):
+		"""
+			Initializes the means of every group with n_components random
+			(selected) features of the group and the variances with the
+			variance of these features. The weights are uniform.
+
+			x: (n_groups, N, in_size), selected: (n_groups, N) or None
+		"""
+		xp = self.xp
+		G, N, _ = x.shape
+		keys = xp.asarray(self._rnd.rand(G, N))
+		if selected is not None:
+			keys[~selected.astype(bool)] = -1
+
+		idxs = xp.argpartition(-keys, self.n_components - 1, axis=1)[:, :self.n_components]
+		mu = x[xp.arange(G)[:, None], idxs]
+
+		weights = xp.ones((G, N), x.dtype) if selected is None else selected.astype(x.dtype)
+		n_feats = weights.sum(axis=1)[:, None]
+		mean = (weights[..., None] * x).sum(axis=1) / n_feats
+		var = (weights[..., None] * (x - mean[:, None])**2).sum(axis=1) / n_feats
+		sig = xp.broadcast_to(xp.maximum(var, self.eps)[..., None], self.mu.shape)
+		w = xp.full(self.w.shape, 1 / self.n_components, dtype=self.w.dtype)
+
+		self.set_params(mu=mu.transpose(0, 2, 1), sig=sig, w=w)
+		self._initialized = True
+
+	def get_new_params(self, x, selected=None):
+		"""
+			One batched EM step of all mixtures w.r.t. the current
+			parameters (the E-step of every group is a matrix product,
+			the M-step are two batched matrix products). The moments are
+			accumulated in encoding.ACCUM_DTYPE, since the variances
+			E[x**2] - mu**2 of tight and distant components cancel in
+			float32 (see encoding.fisher_blocks).
+
+			x: (n_groups, N, in_size), selected: (n_groups, N) or None
+		"""
+		xp = self.xp
+		G, N, _ = x.shape
+		params = self.param_snapshot()
+		with chainer.no_backprop_mode():
+			_log_wu = self._log_wu(x, params)
+			log_gamma = _log_wu - F.broadcast_to(
+				F.logsumexp(_log_wu, axis=-1)[..., None], _log_wu.shape)
+
+		dtype = np.promote_types(log_gamma.dtype, encoding.ACCUM_DTYPE)
+		gamma = xp.exp(log_gamma.array.astype(dtype))
+		if selected is None:
+			n_feats = xp.full((G, 1), N, dtype=gamma.dtype)
+		else:
+			gamma *= selected[..., None].astype(gamma.dtype)
+			n_feats = selected.sum(axis=1, keepdims=True).astype(gamma.dtype)
+
+		nk = gamma.sum(axis=1) + 10 * xp.finfo(gamma.dtype).eps
+		gamma_T = gamma.transpose(0, 2, 1)
+		# the moments relative to the reference point do not cancel out
+		center = self._center(params.mu.astype(dtype))[:, None]
+		x = x.astype(dtype) - center
+		# (n_groups, n_components, in_size)
+		mu = xp.matmul(gamma_T, x) / nk[..., None]
+		sig = xp.matmul(gamma_T, x**2) / nk[..., None] - mu**2
+		sig = xp.maximum(sig, self.eps)
+		mu += center
+
+		mu, sig, w = mu.transpose(0, 2, 1), sig.transpose(0, 2, 1), nk / n_feats
+		return [p.astype(params.mu.dtype) for p in (mu, sig, w)]
+
+	def _ema(self, old, new):
+		prev_correction = 1 - (self.alpha ** (self.t-1))
+		correction = 1 - (self.alpha ** self.t)
+
+		uncorrected_old = old * prev_correction
+		res = self.alpha * uncorrected_old + (1 - self.alpha) * new
+
+		return res / correction
+
+	def update_parameter(self, x, selected=None):
+		""" x: (n_groups, N, in_size), selected: (n_groups, N) or None """
+		x = getattr(x, "array", x)
+		if not self._initialized:
+			self.init_from_data(x, selected)
+
+		if self.alpha >= 1:
+			return #pragma: no cover
+
+		params = self.param_snapshot()
+		new_params = self.get_new_params(x, selected)
+		mu, sig, w = [self._ema(old, new) for old, new in zip(params[:3], new_params)]
+		self.t += 1
+
+		self.set_params(mu=mu, sig=self.xp.maximum(sig, self.eps), w=w)
+
+	def forward(self, x, use_mask=False, visibility_mask=None):
+		""" Updates the mixtures in training mode and returns the features. """
+		if chainer.config.train:
+			n, t = self._check_input(x)
+			selected = self.get_mask(x, use_mask, visibility_mask)
+			if selected is not None:
+				selected = selected.transpose(1, 0, 2).reshape(self.n_groups, n * t)
+			self.update_parameter(self._as_groups(getattr(x, "array", x)), selected)
+		return x
+
+
+class GroupedFVELayer(GroupedGMMLayer):
+	"""
+		Fisher vector encoding of every group w.r.t. its mixture (see
+		GroupedGMMLayer). The output has the shape (n, n_groups,
+		output_size), where the encoding of a group has the layout of
+		FVELayer.
+	"""
+
+	def __init__(self, *args, statistics="both",
+		power=None, intra_norm=False, l2_norm=False, **kwargs):
+		super(GroupedFVELayer, self).__init__(*args, **kwargs)
+		self.statistics = FVEMixin._check_statistics(statistics)
+		self.normalization = dict(power=power, intra=intra_norm, l2=l2_norm)
+
+	@property
+	def output_size(self):
+		""" size of the encoding of a single group """
+		return len(self.statistics) * self.n_components * self.in_size
+
+	@property
+	def printable_specs(self):
+		yield from super(GroupedFVELayer, self).printable_specs
+		yield ('statistics', self.statistics)
+		yield ('normalization', self.normalization)
+
+	@property
+	def normalized(self):
+		return self.normalization["power"] is not None or \
+			self.normalization["intra"] or self.normalization["l2"]
+
+	def encode(self, x, use_mask=False, visibility_mask=None, eps=1e-6, *, normalize=True):
+		"""
+			The statistics of all samples and groups are reduced with
+			batched matrix products (gamma^T x and gamma^T x**2 of the
+			features relative to the reference point of their group, see
+			fve_layer.common.encoding.fisher_blocks), hence without the
+			(n, t, in_size, n_components) intermediates of FVELayer. The
+			statistics and the blocks are computed in encoding.ACCUM_DTYPE.
+		"""
+		xp = self.xp
+		n, t = self._check_input(x)
+		G, K, D = self.n_groups, self.n_components, self.in_size
+		params = self.param_snapshot()
+		x = self._promote(x, params)
+
+		gamma = self.soft_assignment(x, params)
+		# mask out all gammas, that are < eps (see FVEMixin._fisher_contributions)
+		mask = (gamma.array >= eps).astype(gamma.dtype)
+
+		selected = self.get_mask(x, use_mask, visibility_mask)
+		if selected is None:
+			n_selected = xp.full((n, G), t, dtype=gamma.dtype)
+		else:
+			selected = selected.astype(gamma.dtype)
+			mask *= selected[..., None]
+			n_selected = selected.sum(axis=-1)
+		dtype = np.promote_types(x.dtype, encoding.ACCUM_DTYPE)
+		gamma = F.cast(F.reshape(gamma * mask, (n * G, t, K)), dtype)
+
+		mu, sig, w = [p.astype(dtype, copy=False) for p in params[:3]]
+		center = self._center(mu)
+		mu = mu - center[..., None]
+
+		shape = (n, G, K, D)
+		_x = F.cast(x, dtype) - xp.broadcast_to(center[None, :, None], x.shape)
+		_x = F.reshape(_x, (n * G, t, D))
+		S0 = F.broadcast_to(F.reshape(F.sum(gamma, axis=1), (n, G, K, 1)), shape)
+		S1 = F.reshape(F.matmul(gamma, _x, transa=True), shape)
+		S2 = None
+		if "sig" in self.statistics:
+			S2 = F.reshape(F.matmul(gamma, _x**2, transa=True), shape)
+
+		mu, sig = [xp.broadcast_to(p.transpose(0, 2, 1)[None], shape) for p in (mu, sig)]
+		# 1 / (T * sqrt(w)) of every sample, group and component
+		norm = 1 / (n_selected[..., None] * xp.sqrt(xp.maximum(w, xp.finfo(w.dtype).tiny)))
+		norm = xp.broadcast_to(norm.astype(dtype)[..., None], shape)
+
+		stats = encoding.fisher_blocks(S0, S1, S2, mu, sig, norm,
+			statistics=self.statistics)
+
+		# (n, G, S, n_components, in_size) -> (n*G, S*n_components*in_size)
+		res = F.reshape(F.stack(list(stats), axis=2), (n * G, -1))
+		res = F.cast(res, x.dtype)
+
+		if normalize and self.normalized:
+			res = fisher_normalize(res, D, K, **self.normalization)
+
+		return F.reshape(res, (n, G, -1))
+
+	def forward(self, x, use_mask=False, visibility_mask=None):
+		x = super(GroupedFVELayer, self).forward(x, use_mask, visibility_mask)
+		return self.encode(x, use_mask, visibility_mask)
@@ -0,0 +1,51 @@
+import chainer
+
+from chainer import links as L
+
+from fve_layer.backends.chainer.links.gmm import GMMLayer
+
+
+class FVELinear(chainer.Chain):
+	"""
+		Fisher vector encoding (FVELayer or FVELayer_noEM) followed by a
+		linear classifier. In the fused mode, the logits are computed
+		directly from the per-component statistics, hence neither the
+		(n, S*n_components*in_size) encoding nor its gradient are stored.
+		With fused=False, the encoding is passed to the classifier as
+		usual. Both modes share the same parameters.
+
+		The logits are linear in the statistics only for the unnormalized
+		encoding, hence the fused mode requires a layer without any
+		normalization (see FVEMixin.__init__).
+	"""
+
+	def __init__(self, fve, out_size, *,
+		nobias=False,
+		initialW=None,
+		initial_bias=None,
+		fused=True,
+		chunk_size=16):
+		super(FVELinear, self).__init__()
+		assert not (fused and fve.normalized), \
+			"Fused mode is not supported for normalized encodings!"
+
+		self.fused = fused
+		self.chunk_size = chunk_size
+
+		with self.init_scope():
+			self.fve = fve
+			self.fc = L.Linear(fve.output_size, out_size,
+				nobias=nobias,
+				initialW=initialW,
+				initial_bias=initial_bias)
+
+	def forward(self, x, use_mask=False, visibility_mask=None):
+		if not self.fused:
+			return self.fc(self.fve(x, use_mask, visibility_mask))
+
+		if isinstance(self.fve, GMMLayer):
+			# EM update of the mixture and whitening (see FVELayer.forward)
+			x = GMMLayer.forward(self.fve, x, use_mask, visibility_mask)
+
+		return self.fve.encode_linear(x, self.fc.W, self.fc.b,
+			use_mask, visibility_mask, chunk_size=self.chunk_size)
@@ -0,0 +1,174 @@
+""" Shape-aware selection of the fastest implementation of an operation.
+
+	The first time an operation is called for a shape bucket (e.g. the
+	number of the features rounded up to a power of two, the feature size,
+	the number of the components, the dtype and the device), all available
+	implementations are run on the actual input and the fastest one is
+	kept. The choices are cached in memory and optionally in a JSON file,
+	hence the benchmark runs once per bucket (and machine).
+
+	Only the implementations, that are as accurate as the default one, are
+	candidates of the benchmark: the faster but numerically worse ones
+	(e.g. the distances expanded into matrix products, which cancel if the
+	features are far from the means relative to the variances) are marked
+	as approximate by the caller and only benchmarked, if the autotuner is
+	created with approximate=True.
+
+	An override forces an implementation of an operation (e.g. to
+	reproduce a result), report() lists the choices and their timings.
+"""
+import json
+import numpy as np
+import os
+import threading
+import time
+
+from chainer.backends import cuda
+
+_DEFAULT = None
+
+
+def bucket(size):
+	""" rounds a size up to the next power of two """
+	return 1 << max(int(size) - 1, 0).bit_length()
+
+
+def default_tuner():
+	""" shared autotuner of all layers created with autotuner=True """
+	global _DEFAULT
+	if _DEFAULT is None:
+		_DEFAULT = Autotuner()
+	return _DEFAULT
+
+
+def _synchronize(xp):
+	if xp is not None and xp is not np:
+		cuda.Stream.null.synchronize()
+
+
+class Autotuner(object):
+
+	def __init__(self, cache_file=None, *, n_runs=3, overrides=None, approximate=False):
+		"""
+			cache_file:  if set, the choices are read from and written to
+			             this JSON file
+			n_runs:      number of the timed runs of every implementation
+			             (after a warm-up run), the fastest run counts
+			overrides:   dict operation -> name of the implementation, that
+			             is used without any benchmark
+			approximate: if set, the implementations, that are less accurate
+			             than the default one, are candidates as well
+		"""
+		self.cache_file = cache_file
+		self.n_runs = n_runs
+		self.approximate = approximate
+		self.overrides = dict(overrides or {})
+		self.choices = dict()
+		self._lock = threading.Lock()
+
+		if cache_file is not None and os.path.exists(cache_file):
+			with open(cache_file) as f:
+				for entry in json.load(f):
+					entry["source"] = "disk"
+					self.choices[entry["key"]] = entry
+
+	def __getstate__(self):
+		state = dict(self.__dict__)
+		del state["_lock"]
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def _key(op, key):
+		return "|".join(map(str, (op,) + tuple(key)))
+
+	def set_override(self, op, name=None):
+		""" forces (or with name=None: releases) an implementation of the operation """
+		if name is None:
+			self.overrides.pop(op, None)
+		else:
+			self.overrides[op] = name
+
+	def benchmark(self, impls, *args, xp=None, **kwargs):
+		""" returns the runtime (in seconds) of every implementation """
+		timings = dict()
+		for name, impl in impls.items():
+			impl(*args, **kwargs)
+			runs = []
+			for _ in range(self.n_runs):
+				_synchronize(xp)
+				t0 = time.perf_counter()
+				impl(*args, **kwargs)
+				_synchronize(xp)
+				runs.append(time.perf_counter() - t0)
+			timings[name] = min(runs)
+		return timings
+
+	def choose(self, op, key, impls, *args, xp=None, approximate=(), **kwargs):
+		"""
+			Returns the name of the implementation (one of impls, a dict
+			name -> callable), that is used for the operation and the
+			shape bucket key (a tuple). On the first call for a bucket,
+			the implementations are benchmarked with the given arguments.
+
+			The names in approximate are less accurate than the default
+			implementation. They are only chosen by an override or if the
+			autotuner is approximate.
+		"""
+		override = self.overrides.get(op)
+		if override is not None:
+			assert override in impls, \
+				f"Unknown implementation \"{override}\" of {op}: {', '.join(impls)}"
+			return override
+
+		if not self.approximate:
+			impls = {name: impl for name, impl in impls.items() if name not in approximate}
+		assert impls, f"No accurate implementation of {op}"
+		if len(impls) == 1:
+			return next(iter(impls))
+
+		# a different set of implementations is a different decision
+		_key = self._key(op, tuple(key) + (",".join(sorted(impls)),))
+		entry = self.choices.get(_key)
+		if entry is not None and entry["choice"] in impls:
+			return entry["choice"]
+
+		with self._lock:
+			entry = self.choices.get(_key)
+			if entry is None or entry["choice"] not in impls:
+				timings = self.benchmark(impls, *args, xp=xp, **kwargs)
+				entry = dict(key=_key, op=op,
+					choice=min(timings, key=timings.get),
+					timings=timings,
+					source="benchmark")
+				self.choices[_key] = entry
+				self.save()
+
+		return entry["choice"]
+
+	def save(self):
+		""" writes the choices to the cache file (if set) """
+		if self.cache_file is None:
+			return
+
+		entries = [{k: v for k, v in entry.items() if k != "source"}
+			for entry in self.choices.values()]
+		tmp = self.cache_file + ".tmp"
+		with open(tmp, "w") as f:
+			json.dump(entries, f, indent=2)
+		os.replace(tmp, self.cache_file)
+
+	def report(self):
+		""" a table of the choices, their timings and their origin """
+		lines = [f"{'bucket':<64s} {'choice':<10s} {'source':<9s} timings"]
+		for entry in sorted(self.choices.values(), key=lambda e: e["key"]):
+			timings = ", ".join(f"{name}: {t * 1000:.2f}ms"
+				for name, t in sorted(entry["timings"].items(), key=lambda item: item[1]))
+			lines.append(f"{entry['key']:<64s} {entry['choice']:<10s} {entry['source']:<9s} {timings}")
+
+		for op, name in sorted(self.overrides.items()):
+			lines.append(f"{op:<64s} {name:<10s} {'override':<9s}")
+		return "\n".join(lines)
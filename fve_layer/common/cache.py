@@ -0,0 +1,115 @@
+""" Disk-backed cache of the encodings of fixed inputs.
+
+	If the features (e.g. of a frozen backbone) and the mixture are fixed,
+	the encoding of a sample is the same in every epoch. The cache stores
+	one entry (e.g. the Fisher vector) per key in the slots of a single
+	np.memmap and keeps the keys in least-recently-used order. The number
+	of the slots is bounded by max_bytes, hence the oldest entries are
+	evicted, if the cache is full.
+
+	All entries belong to a single version of the parameters: a lookup or
+	an insertion with another version invalidates the whole cache.
+"""
+import numpy as np
+import tempfile
+
+from collections import OrderedDict
+
+
+class EncodingCache(object):
+
+	def __init__(self, entry_size, *, max_bytes=2**30, filename=None, dtype=np.float32):
+		"""
+			entry_size: number of the values of a single entry
+			max_bytes:  size of the memory-mapped store
+			filename:   file of the store (a temporary file, if None)
+		"""
+		self.entry_size = entry_size
+		self.dtype = np.dtype(dtype)
+		self.n_slots = int(max_bytes // (entry_size * self.dtype.itemsize))
+
+		assert self.n_slots >= 1, \
+			f"Cache size ({max_bytes} bytes) is too small for a single entry!"
+
+		self._tmp = None
+		if filename is None:
+			self._tmp = tempfile.NamedTemporaryFile(suffix=".cache")
+			filename = self._tmp.name
+
+		self.filename = filename
+		self._store = np.memmap(filename, mode="w+", dtype=self.dtype,
+			shape=(self.n_slots, entry_size))
+
+		self.version = None
+		self.hits = self.misses = 0
+		# key -> slot, in least-recently-used order
+		self._slots = OrderedDict()
+		self._free = list(range(self.n_slots - 1, -1, -1))
+
+	def __len__(self):
+		return len(self._slots)
+
+	def __contains__(self, key):
+		return key in self._slots
+
+	@property
+	def nbytes(self):
+		return self._store.nbytes
+
+	def _check_version(self, version):
+		if version != self.version:
+			self.clear()
+			self.version = version
+
+	def get(self, keys, version):
+		"""
+			Looks up the entries of the keys. Returns a boolean mask of the
+			hits (n,) and an array (n, entry_size) with the entries of the
+			hits (the rows of the misses are undefined).
+		"""
+		self._check_version(version)
+		hits = np.zeros(len(keys), dtype=bool)
+		res = np.empty((len(keys), self.entry_size), dtype=self.dtype)
+
+		for i, key in enumerate(keys):
+			slot = self._slots.get(key)
+			if slot is None:
+				continue
+			self._slots.move_to_end(key)
+			hits[i] = True
+			res[i] = self._store[slot]
+
+		n_hits = int(hits.sum())
+		self.hits += n_hits
+		self.misses += len(keys) - n_hits
+		return hits, res
+
+	def put(self, keys, values, version):
+		""" stores the entries (n, entry_size) of the keys """
+		self._check_version(version)
+		assert len(keys) == len(values), \
+			f"Number of keys and entries differ: {len(keys)} != {len(values)}"
+
+		for key, value in zip(keys, values):
+			slot = self._slots.get(key)
+			if slot is None:
+				if not self._free:
+					_, evicted = self._slots.popitem(last=False)
+					self._free.append(evicted)
+				slot = self._free.pop()
+				self._slots[key] = slot
+			else:
+				self._slots.move_to_end(key)
+			self._store[slot] = value
+
+	def clear(self):
+		self._slots.clear()
+		self._free = list(range(self.n_slots - 1, -1, -1))
+
+	def close(self):
+		self.clear()
+		self._store = None
+		# only the temporary file is removed
+		if self._tmp is not None:
+			self._tmp.close()
+			self._tmp = None
@@ -0,0 +1,105 @@
+""" Checkpoint format for the complete state of a mixture.
+
+	A checkpoint is a folder with one uncompressed .npy file per array and
+	a JSON manifest, that holds the scalars, the names of the arrays and
+	the format version. The data of a .npy file is aligned (the header is
+	padded to a multiple of 64 bytes), hence the arrays can be loaded with
+	np.load(mmap_mode="r") and shared by many processes without a copy.
+
+	Readers ignore unknown entries of the manifest and refuse checkpoints
+	with a newer format version.
+"""
+import importlib
+import json
+import numpy as np
+import os
+
+from chainer.backends import cuda
+
+FORMAT = "fve_layer.checkpoint"
+FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+
+
+def _is_array(value):
+	return isinstance(value, np.ndarray) or isinstance(value, cuda.ndarray)
+
+
+def _to_json(value):
+	""" converts numpy scalars to the corresponding python types """
+	return value.item() if isinstance(value, np.generic) else value
+
+
+def split_state(state):
+	""" splits a dict into the arrays and the (JSON serializable) scalars """
+	arrays = {key: value for key, value in state.items() if _is_array(value)}
+	scalars = {key: _to_json(value) for key, value in state.items() if key not in arrays}
+	return arrays, scalars
+
+
+def save(folder, arrays, meta):
+	"""
+		Writes the arrays (a dict name -> array) and the meta data (a JSON
+		serializable dict) to the folder. The manifest is written last,
+		hence a folder without a manifest is an incomplete checkpoint.
+	"""
+	os.makedirs(folder, exist_ok=True)
+	files = dict()
+	for name, arr in arrays.items():
+		fname = f"{name}.npy"
+		np.save(os.path.join(folder, fname), np.ascontiguousarray(cuda.to_cpu(arr)))
+		files[name] = fname
+
+	manifest = dict(meta, format=FORMAT, version=FORMAT_VERSION, arrays=files)
+	tmp = os.path.join(folder, MANIFEST + ".tmp")
+	with open(tmp, "w") as f:
+		json.dump(manifest, f, indent=2)
+	os.replace(tmp, os.path.join(folder, MANIFEST))
+
+
+def load(folder, mmap_mode="r"):
+	""" returns the arrays (memory-mapped, if mmap_mode is set) and the manifest """
+	with open(os.path.join(folder, MANIFEST)) as f:
+		manifest = json.load(f)
+
+	if manifest.get("format") != FORMAT:
+		raise ValueError(f"{folder} is not a checkpoint ({manifest.get('format')})!")
+
+	if manifest["version"] > FORMAT_VERSION:
+		raise ValueError(
+			f"Checkpoint version {manifest['version']} is not supported "
+			f"(supported up to version {FORMAT_VERSION})!")
+
+	arrays = {name: np.load(os.path.join(folder, fname), mmap_mode=mmap_mode)
+		for name, fname in manifest["arrays"].items()}
+	return arrays, manifest
+
+
+def estimator_state(est):
+	"""
+		State of an sklearn estimator: the class, the (JSON serializable)
+		constructor arguments and the fitted attributes (ending with "_").
+	"""
+	params = {key: value for key, value in est.get_params().items()
+		if value is None or isinstance(value, (bool, int, float, str))}
+
+	fitted = {key: value for key, value in vars(est).items()
+		if key.endswith("_") and not key.startswith("_")}
+	arrays, scalars = split_state(fitted)
+
+	cls = type(est)
+	meta = dict(cls=f"{cls.__module__}:{cls.__qualname__}", params=params, scalars=scalars)
+	return arrays, meta
+
+
+def restore_estimator(arrays, meta):
+	""" creates the estimator from its state (see estimator_state) """
+	module, name = meta["cls"].split(":")
+	cls = getattr(importlib.import_module(module), name)
+	est = cls(**meta["params"])
+	for key, value in meta["scalars"].items():
+		setattr(est, key, value)
+	for key, value in arrays.items():
+		# the estimator may update its attributes in-place
+		setattr(est, key, np.array(value))
+	return est
@@ -0,0 +1,257 @@
+""" Graph-free (numpy/cupy) implementation of the Fisher vector encoding.
+
+	All parameters are expected in the layout of the layers, i.e.
+	mu and sig have the shape (in_size, n_components) and w has the
+	shape (n_components,).
+"""
+import numpy as np
+
+_LOG_2PI = np.log(2 * np.pi)
+# the statistics and the blocks of the Fisher vector are computed in
+# (at least) this dtype, see fisher_blocks
+ACCUM_DTYPE = np.float64
+
+
+def _get_buffer(workspace, name, shape, dtype, xp=np):
+	""" returns a (cached) buffer from the workspace dict """
+	if workspace is None:
+		return xp.empty(shape, dtype=dtype)
+
+	buf = workspace.get(name)
+	if buf is None or buf.shape != shape or buf.dtype != dtype:
+		buf = workspace[name] = xp.empty(shape, dtype=dtype)
+	return buf
+
+
+class EncodingParams(object):
+	""" Precomputed, read-only terms of the mixture, that are
+		shared by all E-steps and encodings with the same parameters.
+
+		All terms are relative to a reference point (center, by default
+		the mean of the means), i.e. the features have to be centered
+		by it as well (X - center). The expanded distances and the
+		statistics are then independent of a common offset of the
+		features and the means, which would otherwise cancel out in
+		float32 (the offsets between the components are handled by the
+		dtype of the statistics, see fisher_blocks).
+	"""
+
+	def __init__(self, mu, sig, w, xp=np, *, center=None):
+		self.xp = xp
+		self.mu, self.sig, self.w = mu, sig, w
+		self.in_size, self.n_components = mu.shape
+
+		# (in_size,)
+		self.center = mu.mean(axis=1) if center is None else center
+		self.mu_c = mu - self.center[:, None]
+
+		self.prec = 1 / sig
+		# components with a zero weight (e.g. pruned ones) get zero
+		# posteriors (even if they are much closer than the others)
+		# and zero blocks in the Fisher vector
+		_w = xp.maximum(w, xp.finfo(w.dtype).tiny)
+		self.sqrt_w = xp.sqrt(_w)
+		self.log_w = xp.where(w > 0, xp.log(_w), -np.inf).astype(_w.dtype)
+		# x @ (-2 * mu * prec) + x**2 @ prec + const is the squared
+		# Mahalanobis distance extended by the normalization terms
+		self.lin = -2 * self.mu_c * self.prec
+		self.const = (
+			xp.sum(self.mu_c**2 * self.prec, axis=0) +
+			xp.sum(xp.log(sig), axis=0) +
+			self.in_size * _LOG_2PI)
+
+
+def selection_mask(X, visibility_mask=None, *, xp=np):
+	""" selects the features of X (n, t, in_size), whose L2-norm is at
+		least as large as the mean norm of the (visible) features of the
+		sample. Returns a boolean array of the shape (n, t).
+	"""
+	feat_lens = xp.sqrt(xp.sum(X**2, axis=2))
+
+	if visibility_mask is None:
+		return feat_lens >= feat_lens.mean(axis=1, keepdims=True)
+
+	if 0 in visibility_mask.sum(axis=1):
+		raise RuntimeError("Selection mask contains not selected samples!")
+
+	mean_feat_lens = (feat_lens * visibility_mask).sum(axis=1, keepdims=True)
+	n_visible_feats = visibility_mask.sum(axis=1, keepdims=True)
+	mean_feat_lens = mean_feat_lens / n_visible_feats.astype(feat_lens.dtype)
+
+	selected = feat_lens >= mean_feat_lens
+	return xp.logical_and(selected, visibility_mask)
+
+
+def soft_assignment(X, params, *, workspace=None):
+	""" computes the posteriors for X with shape (N, in_size) and
+		returns an array with the shape (N, n_components)
+	"""
+	xp = params.xp
+	N = X.shape[0]
+	dtype = np.promote_types(X.dtype, params.mu.dtype)
+	shape = (N, params.n_components)
+
+	Xc = _get_buffer(workspace, "Xc", X.shape, dtype, xp=xp)
+	xp.subtract(X, params.center, out=Xc)
+	X2 = _get_buffer(workspace, "X2", X.shape, dtype, xp=xp)
+	xp.multiply(Xc, Xc, out=X2)
+
+	gamma = _get_buffer(workspace, "gamma", shape, dtype, xp=xp)
+	tmp = _get_buffer(workspace, "tmp", shape, dtype, xp=xp)
+
+	xp.dot(Xc, params.lin, out=gamma)
+	xp.dot(X2, params.prec, out=tmp)
+	gamma += tmp
+	gamma += params.const
+	gamma *= -0.5
+	gamma += params.log_w
+
+	# normalize in log-space (logsumexp) and go back to probabilities
+	gamma -= gamma.max(axis=1, keepdims=True)
+	xp.exp(gamma, out=gamma)
+	gamma /= gamma.sum(axis=1, keepdims=True)
+
+	return gamma
+
+
+def fisher_statistics(X, gamma, selected=None, *, eps=1e-6, second_order=True,
+	center=None, accum_dtype=ACCUM_DTYPE, xp=np):
+	""" computes the zeroth, first and (optionally) second order statistics
+
+		X:           (n, t, in_size)
+		gamma:       (n, t, n_components)
+		selected:    (n, t) or None
+		center:      (in_size,) reference point of the statistics
+		             (see EncodingParams) or None
+		accum_dtype: the statistics are accumulated in (at least) this
+		             dtype (see fisher_blocks)
+
+		returns S0 (n, n_components), S1 and S2 (n, n_components, in_size).
+		S2 is None, if the second order statistics are not required.
+	"""
+	dtype = np.promote_types(gamma.dtype, accum_dtype)
+	# mask out all gammas, that are < eps (see FVEMixin.encode)
+	gamma = (gamma * (gamma >= eps)).astype(dtype, copy=False)
+	if selected is not None:
+		gamma *= selected[..., None]
+
+	X = X.astype(dtype, copy=False)
+	if center is not None:
+		X = X - center
+
+	gamma_T = gamma.transpose(0, 2, 1)
+	S0 = gamma.sum(axis=1)
+	S1 = xp.matmul(gamma_T, X)
+	S2 = xp.matmul(gamma_T, X**2) if second_order else None
+
+	return S0, S1, S2
+
+
+def fisher_blocks(S0, S1, S2, mu, sig, scale, *, statistics=("mu", "sig")):
+	""" yields the block of every selected statistic (..., n_components, in_size)
+
+		S0:    sum_t gamma
+		S1:    sum_t gamma * x
+		S2:    sum_t gamma * x**2 (only used for "sig")
+		mu:    means of the components
+		sig:   variances of the components
+		scale: 1 / (T * sqrt(w))
+
+		The features of the statistics and the means have to be centered
+		by the same reference point, which removes a common offset. The
+		components can still be far apart relative to their variances,
+		hence sum_t gamma * (x - mu)**2 = S2 - mu * (2 * S1 - mu * S0)
+		(and S1 - mu * S0) cancel: the statistics and the blocks have to
+		be computed in float64 (see fisher_statistics). The arguments are
+		either arrays or chainer.Variables (with operands of equal shapes).
+	"""
+	for stat in statistics:
+		if stat == "mu":
+			yield (S1 - mu * S0) / sig**0.5 * scale
+
+		elif stat == "sig":
+			Q = S2 - mu * (2 * S1 - mu * S0)
+			yield (Q / sig - S0) * (scale / np.sqrt(2))
+
+
+def fisher_vector(S0, S1, S2, n_feats, params, *,
+	statistics=("mu", "sig"), out=None, dtype=None):
+	""" computes the Fisher vector from the statistics of n samples
+		(see fisher_statistics, centered by params.center) and the number
+		of the selected features per sample (n_feats with shape (n,)).
+		The result has the shape (n, S, n_components, in_size), where S
+		is the number of the selected statistics, and the given dtype
+		(default: the one of the parameters). The blocks are computed in
+		the dtype of the statistics.
+	"""
+	xp = params.xp
+	n = S0.shape[0]
+	K, D = params.n_components, params.in_size
+
+	if out is None:
+		out = xp.empty((n, len(statistics), K, D), dtype=dtype or params.mu.dtype)
+
+	_dtype = S1.dtype
+	norm = n_feats.reshape(n, 1, 1).astype(_dtype)
+	scale = 1 / (norm * params.sqrt_w[:, None])
+	# the centered means without the rounding of params.mu_c
+	mu_c = params.mu.T.astype(_dtype) - params.center.astype(_dtype)
+	blocks = fisher_blocks(S0[..., None], S1, S2, mu_c, params.sig.T, scale,
+		statistics=statistics)
+
+	for i, block in enumerate(blocks):
+		out[:, i] = block
+
+	return out
+
+
+def encode(X, mu, sig, w, selected=None, *, eps=1e-6,
+	statistics=("mu", "sig"), xp=np):
+	""" graph-free equivalent of FVEMixin.encode:
+		(n, t, in_size) -> (n, S*n_components*in_size)
+	"""
+	n, t, D = X.shape
+	params = EncodingParams(mu, sig, w, xp=xp)
+	gamma = soft_assignment(X.reshape(-1, D), params).reshape(n, t, -1)
+	stats = fisher_statistics(X, gamma, selected, eps=eps,
+		second_order="sig" in statistics, center=params.center, xp=xp)
+
+	n_feats = xp.full(n, t) if selected is None else selected.sum(axis=1)
+	return fisher_vector(*stats, n_feats, params,
+		statistics=statistics, dtype=gamma.dtype).reshape(n, -1)
+
+
+def _as_blocks(fv, in_size, n_components):
+	""" (..., S*n_components*in_size) -> (..., S, n_components, in_size) """
+	return fv.reshape(fv.shape[:-1] + (-1, n_components, in_size))
+
+
+def normalize(fv, in_size, n_components, *, power=None, intra=False, l2=False,
+	eps=1e-12, return_norms=False, xp=np):
+	""" improved Fisher vector normalization of encodings with the shape
+		(..., S*n_components*in_size): signed power normalization
+		sign(z) * |z|**power, L2-normalization of the block of every
+		component (intra-normalization) and L2-normalization of the whole
+		vector. With return_norms, the norms of the intra-normalization
+		(..., 1, n_components, 1) and of the L2-normalization (..., 1)
+		are returned as well (or None, if skipped).
+	"""
+	res = fv
+	if power is not None:
+		res = xp.sign(res) * xp.abs(res)**power
+
+	intra_norms = l2_norm = None
+	if intra:
+		blocks = _as_blocks(res, in_size, n_components)
+		intra_norms = xp.sqrt((blocks**2).sum(axis=(-3, -1), keepdims=True))
+		intra_norms = xp.maximum(intra_norms, eps)
+		res = (blocks / intra_norms).reshape(fv.shape)
+
+	if l2:
+		l2_norm = xp.sqrt((res**2).sum(axis=-1, keepdims=True))
+		l2_norm = xp.maximum(l2_norm, eps)
+		res = res / l2_norm
+
+	if return_norms:
+		return res, intra_norms, l2_norm
+	return res
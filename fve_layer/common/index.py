@@ -0,0 +1,225 @@
+""" Coarse-to-fine (two-level) soft assignment for large mixtures.
+
+	The means of the components are clustered into n_cells coarse cells
+	(k-means). A feature is scored exactly, but only against the
+	components of its n_probe nearest cells. All other components get a
+	zero posterior (a log-posterior of -inf). Hence, the costs of the
+	soft assignment are roughly n_probe / n_cells of the full one.
+
+	The coarse distances are computed in a space, that is scaled by the
+	average standard deviation of every dimension, which approximates
+	the Mahalanobis distances of the components.
+"""
+import numpy as np
+
+from fve_layer.common import encoding
+
+
+def _sq_dists(X, Y, xp=np):
+	""" squared Euclidean distances between the rows of X and Y """
+	X2 = (X**2).sum(axis=1, keepdims=True)
+	Y2 = (Y**2).sum(axis=1)
+	return xp.maximum(X2 - 2 * X @ Y.T + Y2, 0)
+
+
+def kmeans(X, n_clusters, *, max_iter=10, random_state=None, xp=np):
+	""" Lloyd's algorithm on the rows of X, returns the centers and the labels """
+	rnd = np.random.RandomState(random_state)
+	idxs = rnd.choice(len(X), n_clusters, replace=False)
+	centers = X[xp.asarray(idxs)].copy()
+
+	for _ in range(max_iter):
+		labels = _sq_dists(X, centers, xp=xp).argmin(axis=1)
+		counts = xp.bincount(labels, minlength=n_clusters)
+		# sums of the members of every cluster (the same on numpy and cupy)
+		one_hot = (labels[:, None] == xp.arange(n_clusters)).astype(X.dtype)
+		sums = one_hot.T @ X
+		# empty clusters keep their previous center
+		nonempty = counts > 0
+		centers[nonempty] = sums[nonempty] / counts[nonempty, None]
+
+	labels = _sq_dists(X, centers, xp=xp).argmin(axis=1)
+	return centers, labels
+
+
+class ComponentIndex(object):
+
+	def __init__(self, mu, sig, w, *,
+		n_cells=None,
+		n_probe=4,
+		max_iter=10,
+		fallback_ratio=None,
+		random_state=None,
+		version=None,
+		xp=np):
+		"""
+			mu, sig, w:     parameters in the layout of the layers
+			                (sig is broadcasted to the shape of mu)
+			n_cells:        number of the coarse cells (default: sqrt(n_components))
+			n_probe:        number of the probed cells per feature
+			fallback_ratio: if set, features whose nearest unprobed cell is
+			                less than fallback_ratio times farther away than
+			                the nearest cell are assigned exactly
+			version:        version of the parameters, the index was built for
+		"""
+		sig = xp.broadcast_to(sig, mu.shape)
+		self.params = encoding.EncodingParams(mu, sig, w, xp=xp)
+		self.xp = xp
+		self.version = version
+
+		K = self.n_components
+		self.n_cells = min(K, n_cells or max(1, int(round(np.sqrt(K)))))
+		self.n_probe = min(n_probe, self.n_cells)
+		self.fallback_ratio = fallback_ratio
+
+		# (in_size,): scaling of the coarse space
+		self.scale = 1 / xp.sqrt(sig.mean(axis=1))
+		self.centers, labels = kmeans(mu.T * self.scale, self.n_cells,
+			max_iter=max_iter, random_state=random_state, xp=xp)
+
+		# members of cell c: order[bounds[c]:bounds[c+1]]
+		self.order = xp.argsort(labels, kind="stable")
+		self.bounds = xp.searchsorted(labels[self.order], xp.arange(self.n_cells + 1)).tolist()
+
+	@property
+	def n_components(self):
+		return self.params.n_components
+
+	def members(self, cell):
+		return self.order[self.bounds[cell]:self.bounds[cell + 1]]
+
+	def probe(self, X):
+		""" returns the n_probe nearest cells (N, n_probe) and a boolean
+			mask (N,) of the features, that should be assigned exactly
+		"""
+		xp = self.xp
+		dists = _sq_dists(X * self.scale, self.centers, xp=xp)
+		fallback = xp.zeros(len(X), dtype=bool)
+
+		if self.n_probe == self.n_cells:
+			return xp.broadcast_to(xp.arange(self.n_cells), dists.shape), fallback
+
+		# the n_probe nearest cells (unordered) and the nearest unprobed cell
+		part = xp.argpartition(dists, self.n_probe, axis=1)
+		probes = part[:, :self.n_probe]
+
+		if self.fallback_ratio is not None:
+			rows = xp.arange(len(X))[:, None]
+			probed = dists[rows, probes]
+			next_unprobed = dists[rows[:, 0], part[:, self.n_probe]]
+			# compare the distances (not the squared ones)
+			fallback = next_unprobed < self.fallback_ratio**2 * probed.min(axis=1)
+
+		return probes, fallback
+
+	def _log_likelihoods(self, X, comps=Ellipsis):
+		""" weighted log-likelihoods of X (N, in_size) w.r.t. the components """
+		p = self.params
+		X = X - p.center
+		res = X @ p.lin[:, comps] + (X**2) @ p.prec[:, comps] + p.const[comps]
+		return -0.5 * res + p.log_w[comps]
+
+	def candidates(self, X):
+		"""
+			Scores the features X (N, in_size) against the components of
+			their probed cells. Returns the indices of the candidates
+			(N, n_probe * M) and their log-posteriors, where M is the size
+			of the largest cell (padded entries have the index n_components
+			and a log-posterior of -inf), and the mask of the features (N,),
+			that have to be assigned exactly.
+		"""
+		xp = self.xp
+		N, P = len(X), self.n_probe
+		probes, fallback = self.probe(X)
+		sizes = xp.diff(xp.asarray(self.bounds))
+		M = int(sizes.max())
+
+		# padded entries point to an additional (dummy) component
+		idxs = xp.full((N, P, M), self.n_components, dtype=self.order.dtype)
+		log_p = xp.full((N, P, M), -np.inf, dtype=X.dtype)
+
+		# group the (feature, probe) pairs by their cell: one matrix
+		# product per cell for all features, that probe this cell
+		cells = xp.where(fallback[:, None], self.n_cells, probes).ravel()
+		pairs = xp.argsort(cells, kind="stable")
+		pair_bounds = xp.searchsorted(cells[pairs], xp.arange(self.n_cells + 1)).tolist()
+
+		for cell in range(self.n_cells):
+			comps = self.members(cell)
+			_pairs = pairs[pair_bounds[cell]:pair_bounds[cell + 1]]
+			if len(_pairs) == 0 or len(comps) == 0:
+				continue
+			rows, slots = _pairs // P, _pairs % P
+			m = len(comps)
+			idxs[rows, slots, :m] = comps
+			log_p[rows, slots, :m] = self._log_likelihoods(X[rows], comps)
+
+		idxs, log_p = idxs.reshape(N, P * M), log_p.reshape(N, P * M)
+		with np.errstate(divide="ignore", invalid="ignore"):
+			log_p = log_p - _logsumexp(log_p, xp=xp)
+		return idxs, log_p, fallback
+
+	def log_soft_assignment(self, X, *, exact=False):
+		""" log-posteriors (N, n_components) of the features X (N, in_size),
+			that are -inf for all not probed components
+		"""
+		xp = self.xp
+		if exact or self.n_probe == self.n_cells:
+			log_p = self._log_likelihoods(X)
+			return log_p - _logsumexp(log_p, xp=xp)
+
+		idxs, log_gamma, fallback = self.candidates(X)
+		res = xp.full((len(X), self.n_components + 1), -np.inf, dtype=X.dtype)
+		res[xp.arange(len(X))[:, None], idxs] = log_gamma
+		res = res[:, :-1]
+
+		rows = xp.flatnonzero(fallback)
+		if len(rows):
+			log_p = self._log_likelihoods(X[rows])
+			res[rows] = log_p - _logsumexp(log_p, xp=xp)
+
+		return res
+
+	def soft_assignment(self, X, **kwargs):
+		return self.xp.exp(self.log_soft_assignment(X, **kwargs))
+
+
+def _logsumexp(log_p, xp=np):
+	_max = log_p.max(axis=1, keepdims=True)
+	# rows without any candidate (e.g. of the features, that are assigned exactly)
+	_max = xp.where(xp.isfinite(_max), _max, 0)
+	return _max + xp.log(xp.exp(log_p - _max).sum(axis=1, keepdims=True))
+
+
+# accuracy vs. speed of the coarse-to-fine soft assignment
+if __name__ == '__main__':
+	import time
+
+	rnd = np.random.RandomState(0)
+	N, D, K = 8192, 64, 4096
+
+	mu = rnd.randn(D, K).astype(np.float32)
+	sig = (rnd.rand(D, K) * 0.5 + 0.1).astype(np.float32)
+	w = np.full(K, 1 / K, dtype=np.float32)
+
+	comps = rnd.randint(K, size=N)
+	X = mu.T[comps] + rnd.randn(N, D).astype(np.float32) * np.sqrt(sig.T[comps])
+
+	def bench(func, n_runs=3):
+		func()
+		t0 = time.time()
+		for _ in range(n_runs):
+			res = func()
+		return res, (time.time() - t0) / n_runs
+
+	index = ComponentIndex(mu, sig, w, n_probe=1, random_state=0)
+	ref, t_ref = bench(lambda: index.soft_assignment(X, exact=True))
+	print(f"exact: {t_ref * 1000:.1f}ms ({N} features, {K} components, {index.n_cells} cells)")
+
+	for n_probe, fallback_ratio in [(1, None), (2, None), (4, None), (8, None), (4, 1.02)]:
+		index.n_probe, index.fallback_ratio = n_probe, fallback_ratio
+		gamma, t = bench(lambda: index.soft_assignment(X))
+		top1 = np.mean(gamma.argmax(axis=1) == ref.argmax(axis=1))
+		l1 = np.abs(gamma - ref).sum(axis=1).mean()
+		print(f"n_probe={n_probe}, fallback_ratio={fallback_ratio}: {t * 1000:.1f}ms "
+			f"(speed-up: {t_ref / t:.1f}x), top-1 agreement={top1:.3f}, mean L1 error={l1:.4f}")
@@ -0,0 +1,104 @@
+""" Blocked computation of the Fisher kernel (Gram matrix) K = FV(X) FV(Y)^T.
+
+	The samples are encoded in blocks of rows (and columns) and only a few
+	encoded blocks are held in memory at once (see BlockCache). Every tile
+	of the Gram matrix is a single matrix product and is written into the
+	output, which is usually an np.memmap. Hence, the memory consumption
+	is bounded by cache_size * block_size * encoding size, independent of
+	the number of samples.
+"""
+import numpy as np
+
+from collections import OrderedDict
+
+
+class BlockCache(object):
+	""" least-recently-used cache of the encoded blocks """
+
+	def __init__(self, encode, maxsize=4):
+		assert maxsize >= 2, \
+			"At least two blocks (a row and a column block) are required!"
+		self.encode = encode
+		self.maxsize = maxsize
+		self.hits = self.misses = 0
+		self._blocks = OrderedDict()
+
+	def __call__(self, name, X, start, stop):
+		""" returns the encoding of X[start:stop], name identifies X """
+		key = (name, start, stop)
+		if key in self._blocks:
+			self.hits += 1
+			self._blocks.move_to_end(key)
+			return self._blocks[key]
+
+		self.misses += 1
+		res = self.encode(X[start:stop])
+		self._blocks[key] = res
+		if len(self._blocks) > self.maxsize:
+			self._blocks.popitem(last=False)
+		return res
+
+	def clear(self):
+		self._blocks.clear()
+
+
+def _blocks(n, block_size):
+	return [(i0, min(i0 + block_size, n)) for i0 in range(0, n, block_size)]
+
+
+def gram_matrix(encode, X, Y=None, *, out=None, block_size=256, cache_size=4,
+	cache=None, dtype=np.float32):
+	"""
+		Computes the Gram matrix between the encodings of X and Y
+		(or X, if Y is None) in tiles of block_size x block_size.
+
+		encode:     maps a slice of the samples to the encodings (n, F)
+		X, Y:       indexable sequences of samples (e.g. arrays or memmaps)
+		out:        a file name, an array or None. A file name creates a new
+		            np.memmap, None creates an array in memory.
+		cache:      a BlockCache of the encoding (created with cache_size
+		            from encode, if None)
+
+		For X == Y (Y is None), only the upper triangle of tiles is
+		computed and mirrored. The order of the tiles is alternated row by
+		row (snake order), hence the most recent column blocks are reused.
+	"""
+	symmetric = Y is None
+	Y = X if symmetric else Y
+	shape = (len(X), len(Y))
+
+	if out is None:
+		out = np.empty(shape, dtype=dtype)
+	elif isinstance(out, str):
+		out = np.memmap(out, mode="w+", dtype=dtype, shape=shape)
+
+	assert out.shape == shape, \
+		f"Output has a wrong shape: {out.shape} != {shape}"
+
+	if cache is None:
+		cache = BlockCache(encode, maxsize=cache_size)
+	# the blocks of the rows are reused as columns, if X and Y are the same
+	row_name, col_name = ("X", "X") if symmetric else ("X", "Y")
+
+	row_blocks = _blocks(shape[0], block_size)
+	col_blocks = _blocks(shape[1], block_size)
+
+	for i, (i0, i1) in enumerate(row_blocks):
+		cols = list(enumerate(col_blocks))
+		if symmetric:
+			cols = cols[i:]
+		if i % 2 == 1:
+			cols = cols[::-1]
+
+		for j, (j0, j1) in cols:
+			A = cache(row_name, X, i0, i1)
+			B = cache(col_name, Y, j0, j1)
+			tile = A @ B.T
+			out[i0:i1, j0:j1] = tile
+			if symmetric and i != j:
+				out[j0:j1, i0:i1] = tile.T
+
+	if isinstance(out, np.memmap):
+		out.flush()
+
+	return out
@@ -1,7 +1,24 @@
-from fve_layer.common.mixtures.gaussian import GMM
-from fve_layer.common.mixtures.bayesian import BayesianGMM
+""" The mixtures are derived from the ones of sklearn, hence they are
+	imported lazily on the first access (see PEP 562).
+"""
+import importlib
+
+_MODULES = dict(
+	GMM="fve_layer.common.mixtures.gaussian",
+	BayesianGMM="fve_layer.common.mixtures.bayesian",
+)
 
 __all__ = [
 	"GMM",
 	"BayesianGMM",
 ]
+
+def __getattr__(name):
+	if name not in _MODULES:
+		raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+	value = getattr(importlib.import_module(_MODULES[name]), name)
+	globals()[name] = value
+	return value
+
+def __dir__():
+	return sorted(set(globals()) | set(__all__))
@@ -1,5 +1,6 @@
 import abc
 import chainer
+import functools
 import numpy as np
 import warnings
 
@@ -8,19 +9,14 @@ import warnings
 from chainer import functions as F
 from chainer.backends import cuda
 
-from sklearn.utils import check_random_state
-
+from fve_layer.common import autotune
+from fve_layer.common import sampling
 
 _LOG_2PI = np.log(2 * np.pi)
 
-def _kernel_e_step(X, means, cov, ws, xp=cuda.cupy):
-
-	t, size = X.shape
-	n_comp, size = means.shape
-	log_det = xp.sum(xp.log(1. / xp.sqrt(cov)), axis=1)
-
-
-	log_prob = xp.zeros((t, n_comp), dtype=X.dtype)
+@functools.lru_cache(maxsize=None)
+def _e_step_kernels():
+	""" the CUDA kernels are created on the first use (and compiled per device) """
 	log_prob_kernel = cuda.elementwise(
 		name="gmm_log_prob",
 		in_params="raw T X, T means, T cov, int32 t, int32 size, int32 n_comp",
@@ -41,8 +37,6 @@ def _kernel_e_step(X, means, cov, ws, xp=cuda.cupy):
 		"""
 	)
 
-	log_prob_kernel(X, means, cov, t, size, n_comp, log_prob)
-
 	weighting_kernel = cuda.elementwise(
 		name="gmm_weighted_prob",
 		in_params="T log_prob, T ws, T log_det, int32 size",
@@ -50,7 +44,6 @@ def _kernel_e_step(X, means, cov, ws, xp=cuda.cupy):
 		operation="weighted_log_prob = -0.5 * (size * LOG_2PI + log_prob) + log_det + log(ws);",
 		preamble="#define LOG_2PI log(2 * 3.14159265359)",
 	)
-	log_prob = weighting_kernel(log_prob, ws, log_det, size)
 
 	norm_kernel = cuda.elementwise(
 		name="gmm_norm_log_prob",
@@ -58,24 +51,57 @@ def _kernel_e_step(X, means, cov, ws, xp=cuda.cupy):
 		out_params="T norm_log_prob",
 		operation="norm_log_prob = log_prob - norm[i/n_comp];",
 	)
+	return log_prob_kernel, weighting_kernel, norm_kernel
+
+def _kernel_e_step(X, means, cov, ws, xp=cuda.cupy):
+
+	t, size = X.shape
+	n_comp, size = means.shape
+	log_det = xp.sum(xp.log(1. / xp.sqrt(cov)), axis=1)
+
+	log_prob_kernel, weighting_kernel, norm_kernel = _e_step_kernels()
+
+	log_prob = xp.zeros((t, n_comp), dtype=X.dtype)
+	log_prob_kernel(X, means, cov, t, size, n_comp, log_prob)
+	log_prob = weighting_kernel(log_prob, ws, log_det, size)
 
 	log_prob_norm = F.logsumexp(log_prob, axis=1).array
 	log_resp = norm_kernel(log_prob, log_prob_norm, n_comp)
 
 	return xp.mean(log_prob_norm), log_resp
 
-def _basic_e_step(X, means, cov, ws, xp=np):
+def _diag_covariances(cov, covariance_type="diag", xp=np):
+	"""
+		Converts the covariances from the layout of sklearn to variances,
+		that are broadcastable to (n_components, n_features).
+	"""
+	if covariance_type == "spherical":
+		return cov[:, None]
+	elif covariance_type == "diag":
+		return cov
+	raise ValueError(f"Unsupported covariance type: {covariance_type}")
+
+def _basic_e_step(X, means, cov, ws, xp=np, covariance_type="diag"):
 
 	n_features = X.shape[1]
 
-	log_det = xp.sum(xp.log(1. / xp.sqrt(cov)), axis=1)
+	cov = _diag_covariances(cov, covariance_type, xp=xp)
+	log_det = xp.sum(xp.log(1. / xp.sqrt(xp.broadcast_to(cov, means.shape))), axis=1)
 	precisions = 1. / cov
 
-	res0 = xp.sum((means ** 2 * precisions), 1)
-	res1 = -2. * xp.dot(X, (means * precisions).T)
-	res2 = xp.dot(X ** 2, precisions.T)
+	if covariance_type == "diag":
+		res0 = xp.sum((means ** 2 * precisions), 1)
+		res1 = -2. * xp.dot(X, (means * precisions).T)
+		res2 = xp.dot(X ** 2, precisions.T)
+
+	else:
+		res0 = xp.sum(means ** 2, 1)
+		res1 = -2. * xp.dot(X, means.T)
+		res2 = xp.einsum("ij,ij->i", X, X)[:, None]
 
 	log_prob = res0 + res1 + res2
+	if covariance_type == "spherical":
+		log_prob = log_prob * precisions.T
 	log_prob = -.5 * (n_features * _LOG_2PI + log_prob) + log_det
 
 	weighted_log_prob = log_prob + xp.log(ws)
@@ -88,6 +114,12 @@ def _basic_e_step(X, means, cov, ws, xp=np):
 
 
 class GPUMixin(abc.ABC):
+	"""
+		If the attribute "tied_diag" is set, the diagonal covariances
+		(covariance_type="diag") are shared by all components: the
+		estimated variances are averaged (weighted by the responsibilities)
+		and every row of covariances_ holds the same shared variances.
+	"""
 
 	def xp_from_array(self, X):
 		_x = getattr(X, "array", X)
@@ -101,6 +133,27 @@ class GPUMixin(abc.ABC):
 		_x = getattr(X, "array", X)
 		return _x, xp
 
+	def _tie(self, nk, covariances, xp=np):
+		""" the nk-weighted average of the diagonal covariances (if tied_diag is set) """
+		if not getattr(self, "tied_diag", False):
+			return covariances
+		variances = xp.dot(nk, covariances) / nk.sum()
+		return xp.ascontiguousarray(xp.broadcast_to(variances, covariances.shape))
+
+	def _initialize(self, X, resp):
+		super(GPUMixin, self)._initialize(X, resp)
+		if getattr(self, "tied_diag", False) and getattr(self, "precisions_init", None) is None:
+			nk = resp.sum(axis=0) + 10 * np.finfo(resp.dtype).eps
+			self.covariances_ = self._tie(nk, self.covariances_)
+			self.precisions_cholesky_ = 1. / np.sqrt(self.covariances_)
+
+	def _n_parameters(self):
+		n_parameters = super(GPUMixin, self)._n_parameters()
+		if getattr(self, "tied_diag", False):
+			# a single variance per dimension instead of one per component
+			n_parameters -= (self.n_components - 1) * self.means_.shape[1]
+		return n_parameters
+
 	def _initialize_parameters(self, X, random_state):
 		super(GPUMixin, self)._initialize_parameters(cuda.to_cpu(X), random_state)
 		xp = self.xp_from_array(X)
@@ -112,6 +165,8 @@ class GPUMixin(abc.ABC):
 
 
 	def fit(self, X, y=None):
+		from sklearn.utils import check_random_state
+
 		X, xp = self._transform_X(X)
 		self._check_initial_parameters(X)
 
@@ -127,13 +182,42 @@ class GPUMixin(abc.ABC):
 	def _e_step(self, X, xp=np, use_kernel=True):
 		""" E step.
 			Copied from sklearn/mixture/base.py
+
+			On the GPU, the kernel is used by default. If the estimator
+			has an approximate "autotuner" (see fve_layer.common.autotune),
+			it chooses between the kernel and the basic E-step per shape
+			bucket: the basic E-step expands the distances and is less
+			accurate than the kernel.
 		"""
-		if xp != np and use_kernel:
-			e_step_impl = _kernel_e_step
+		impls = self._e_step_impls(xp, use_kernel)
+		autotuner = getattr(self, "autotuner", None)
+
+		if autotuner is None or len(impls) == 1:
+			name = "kernel" if "kernel" in impls else "basic"
 		else:
-			e_step_impl = _basic_e_step
+			key = (self.covariance_type, autotune.bucket(X.shape[0]), X.shape[1],
+				self.means_.shape[0], X.dtype.name, xp.__name__)
+			name = autotuner.choose("e_step", key, impls, X, xp=xp,
+				approximate=("basic",))
 
-		return e_step_impl(X, self.means_, self.covariances_, self.weights_, xp=xp)
+		return impls[name](X)
+
+	def _e_step_impls(self, xp, use_kernel):
+		""" the available implementations of the E-step """
+
+		def basic(X):
+			return _basic_e_step(X, self.means_, self.covariances_, self.weights_, xp=xp,
+				covariance_type=self.covariance_type)
+
+		def kernel(X):
+			# the kernel expects the variances of every component
+			cov = _diag_covariances(self.covariances_, self.covariance_type, xp=xp)
+			cov = xp.ascontiguousarray(xp.broadcast_to(cov, self.means_.shape))
+			return _kernel_e_step(X, self.means_, cov, self.weights_, xp=xp)
+
+		if xp != np and use_kernel:
+			return dict(kernel=kernel, basic=basic)
+		return dict(basic=basic)
 
 	@abc.abstractmethod
 	def _m_step(self, *args, **kwargs):
@@ -142,25 +226,39 @@ class GPUMixin(abc.ABC):
 	def _gaussian_params(self, X, log_resp, xp):
 
 		resp = xp.exp(log_resp)
+		# accumulate the statistics in a higher precision than the features
+		accum_dtype = getattr(self, "accum_dtype", None)
+		if accum_dtype is not None:
+			resp = resp.astype(np.promote_types(resp.dtype, accum_dtype), copy=False)
 		nk = resp.sum(axis=0) + 10 * xp.finfo(resp.dtype).eps
 		means = xp.dot(resp.T, X) / nk[:, None]
 
+		if self.covariance_type == "spherical":
+			# only the squared norms of the features are required
+			avg_X2 = xp.dot(resp.T, xp.einsum("ij,ij->i", X, X)) / nk
+			covariances = (avg_X2 - xp.sum(means ** 2, axis=1)) / X.shape[1]
+			return nk, means, xp.maximum(covariances, self.reg_covar)
+
+
 		avg_X2 = xp.dot(resp.T, X ** 2) / nk[:, None]
 		avg_means2 = means ** 2
 		avg_X_means = means * xp.dot(resp.T, X) / nk[:, None]
 		covariances = avg_X2 - 2 * avg_X_means + avg_means2
+		covariances = self._tie(nk, covariances, xp=xp)
 
 		covariances = xp.maximum(covariances, self.reg_covar)
 
 		return nk, means, covariances
 
-	def sample(self, n_samples=1):
-		_save = self.means_, self.covariances_, self.weights_
-
-		self.means_, self.covariances_, self.weights_ = map(cuda.to_cpu, _save)
-		res = super(GPUMixin, self).sample(n_samples)
-		self.means_, self.covariances_, self.weights_ = _save
-		return res
+	def sample(self, n_samples=1, *, random_state=None, chunk_size=None, out=None):
+		""" vectorized sampling on the device of the parameters
+			(see fve_layer.common.sampling.sample)
+		"""
+		xp = self.xp_from_array(self.means_)
+		variances = _diag_covariances(self.covariances_, self.covariance_type, xp=xp)
+		return sampling.sample(self.means_, variances, self.weights_, n_samples,
+			random_state=self.random_state if random_state is None else random_state,
+			chunk_size=chunk_size, out=out, xp=xp)
 
 # testing the runtimes
 if __name__ == '__main__':
@@ -31,10 +31,34 @@ class BayesianGMM(GPUMixin, BayesianGaussianMixture):
 		self.degrees_of_freedom_ = self.degrees_of_freedom_prior_ + nk
 
 		diff = means - self.mean_prior_
+		mean_prec_ratio = self.mean_precision_prior_ / self.mean_precision_
+
+		if self.covariance_type == "spherical":
+			self.covariances_ = self.covariance_prior_ + nk * (
+				covariances + mean_prec_ratio * xp.mean(xp.square(diff), axis=1))
+			self.covariances_ /= self.degrees_of_freedom_
+			self.precisions_cholesky_ = 1. / xp.sqrt(self.covariances_)
+			return
+
+		elif getattr(self, "tied_diag", False):
+			# see sklearn's _estimate_wishart_tied, restricted to the diagonal
+			n_components = len(nk)
+			degrees_of_freedom = self.degrees_of_freedom_prior_ + nk.sum() / n_components
+			variances = (
+				self.covariance_prior_ +
+				covariances[0] * nk.sum() / n_components +
+				self.mean_precision_prior_ / n_components *
+					xp.dot(nk / self.mean_precision_, xp.square(diff)))
+			variances /= degrees_of_freedom
+			# stored like the diagonal covariances of every component
+			self.degrees_of_freedom_ = xp.full(n_components, degrees_of_freedom)
+			self.covariances_ = xp.ascontiguousarray(xp.broadcast_to(variances, means.shape))
+			self.precisions_cholesky_ = 1. / xp.sqrt(self.covariances_)
+			return
+
 		self.covariances_ = (
 			self.covariance_prior_ + nk[:, None] * (
-				covariances + (self.mean_precision_prior_ /
-					  self.mean_precision_)[:, None] * xp.square(diff)))
+				covariances + mean_prec_ratio[:, None] * xp.square(diff)))
 
 		# Contrary to the original bishop book, we normalize the covariances
 		self.covariances_ /= self.degrees_of_freedom_[:, None]
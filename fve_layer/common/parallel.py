@@ -0,0 +1,197 @@
+""" Multi-threaded CPU execution of the Fisher vector encoding. """
+import numpy as np
+import os
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from fve_layer.common import encoding
+
+
+def _split(size, n_chunks=None, chunk_size=None):
+	if chunk_size is None:
+		chunk_size = -(-size // max(1, n_chunks or 1))
+	chunk_size = max(1, int(chunk_size))
+	return [(i, min(i + chunk_size, size)) for i in range(0, size, chunk_size)]
+
+
+class ThreadedEncoder(object):
+	""" Splits the batch (and, if the batch is too small, the features
+		of each sample) into shards, that are encoded in a thread pool.
+		Each thread holds its own workspace buffers and the results are
+		written into a single preallocated output array.
+
+		This works, because numpy releases the GIL in the BLAS calls and
+		the element-wise operations, which dominate the runtime of the
+		encoding.
+	"""
+
+	def __init__(self, n_threads=None, *, batch_chunk=None, t_chunk=None):
+		self.n_threads = n_threads or os.cpu_count() or 1
+		self.batch_chunk = batch_chunk
+		self.t_chunk = t_chunk
+
+		self._pool = None
+		self._local = threading.local()
+
+	@property
+	def pool(self):
+		if self._pool is None:
+			self._pool = ThreadPoolExecutor(self.n_threads,
+				thread_name_prefix="fve_encoder")
+		return self._pool
+
+	def close(self):
+		if self._pool is not None:
+			self._pool.shutdown()
+			self._pool = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	@property
+	def workspace(self):
+		ws = getattr(self._local, "workspace", None)
+		if ws is None:
+			ws = self._local.workspace = dict()
+		return ws
+
+	def shards(self, n, t):
+		batch_shards = _split(n, self.n_threads, self.batch_chunk)
+
+		t_chunk = self.t_chunk
+		if t_chunk is None and len(batch_shards) < self.n_threads:
+			# not enough samples to keep all threads busy
+			t_chunk = -(-t * len(batch_shards) // self.n_threads)
+
+		t_shards = _split(t, chunk_size=t_chunk or t)
+		return batch_shards, t_shards
+
+	def _stats(self, X, params, selected, eps, second_order):
+		n, t, D = X.shape
+		_x = np.ascontiguousarray(X).reshape(-1, D)
+		gamma = encoding.soft_assignment(_x, params, workspace=self.workspace)
+		return encoding.fisher_statistics(X, gamma.reshape(n, t, -1),
+			selected, eps=eps, second_order=second_order, center=params.center)
+
+	def __call__(self, X, mu, sig, w, selected=None, *, eps=1e-6, out=None,
+		statistics=("mu", "sig")):
+		""" X: (n, t, in_size) -> (n, S*n_components*in_size) """
+		n, t, D = X.shape
+		K, S = mu.shape[1], len(statistics)
+		second_order = "sig" in statistics
+
+		x_dtype = X.dtype
+		dtype = np.promote_types(x_dtype, mu.dtype)
+		X = X.astype(dtype, copy=False)
+		params = encoding.EncodingParams(mu, sig, w)
+
+		if out is None:
+			out = np.empty((n, S * K * D), dtype=x_dtype)
+		assert out.shape == (n, S * K * D), \
+			f"Output has a wrong shape: {out.shape} != {(n, S * K * D)}"
+
+		if selected is None:
+			selected = np.ones((n, t), dtype=dtype)
+		n_feats = selected.sum(axis=1)
+		_out = out.reshape(n, S, K, D)
+
+		batch_shards, t_shards = self.shards(n, t)
+
+		def _encode(b0, b1):
+			stats = self._stats(X[b0:b1], params, selected[b0:b1], eps, second_order)
+			encoding.fisher_vector(*stats, n_feats[b0:b1], params,
+				statistics=statistics, out=_out[b0:b1])
+
+		def _partial(b0, b1, t0, t1):
+			return self._stats(X[b0:b1, t0:t1], params, selected[b0:b1, t0:t1],
+				eps, second_order)
+
+		if len(t_shards) == 1:
+			futures = [self.pool.submit(_encode, *b) for b in batch_shards]
+			for f in futures:
+				f.result()
+			return out
+
+		futures = [[self.pool.submit(_partial, *b, *_t) for _t in t_shards]
+			for b in batch_shards]
+
+		for (b0, b1), fs in zip(batch_shards, futures):
+			S0, S1, S2 = fs[0].result()
+			for f in fs[1:]:
+				_S0, _S1, _S2 = f.result()
+				S0 += _S0; S1 += _S1
+				if second_order:
+					S2 += _S2
+
+			encoding.fisher_vector(S0, S1, S2, n_feats[b0:b1], params,
+				statistics=statistics, out=_out[b0:b1])
+
+		return out
+
+
+# least-recently-used encoders, the thread pools of the evicted ones are closed
+_MAX_ENCODERS = 4
+_ENCODERS = OrderedDict()
+_ENCODERS_LOCK = threading.Lock()
+
+def get_encoder(n_threads=None, **kwargs):
+	""" returns a cached encoder, so that the thread pools are reused.
+		An encoder, that is owned by the caller, is created by
+		ThreadedEncoder (and closed by close or as a context manager).
+	"""
+	key = (n_threads, tuple(sorted(kwargs.items())))
+	with _ENCODERS_LOCK:
+		encoder = _ENCODERS.get(key)
+		if encoder is None:
+			encoder = _ENCODERS[key] = ThreadedEncoder(n_threads, **kwargs)
+			if len(_ENCODERS) > _MAX_ENCODERS:
+				_, evicted = _ENCODERS.popitem(last=False)
+				evicted.close()
+		else:
+			_ENCODERS.move_to_end(key)
+	return encoder
+
+
+# scaling benchmark: throughput against the number of threads
+if __name__ == '__main__':
+	import time
+
+	n_runs, warm_up = 10, 2
+	N, T, SIZE, N_COMP = 64, 196, 256, 64
+	dtype = np.float32
+
+	rnd = np.random.RandomState(42)
+	X = rnd.randn(N, T, SIZE).astype(dtype)
+	mu = rnd.randn(SIZE, N_COMP).astype(dtype)
+	sig = rnd.rand(SIZE, N_COMP).astype(dtype) + 0.5
+	w = np.full(N_COMP, 1 / N_COMP, dtype=dtype)
+	out = np.empty((N, 2 * N_COMP * SIZE), dtype=dtype)
+
+	ref = encoding.encode(X, mu, sig, w)
+
+	print(f"Input: {X.shape}, components: {N_COMP}")
+	print(f"{'threads':>8} | {'samples/s':>10} | {'speedup':>8}")
+	base = None
+	for n_threads in [1, 2, 4, 8, 16]:
+		if n_threads > (os.cpu_count() or 1):
+			break
+		with ThreadedEncoder(n_threads) as encoder:
+			for _ in range(warm_up):
+				encoder(X, mu, sig, w, out=out)
+
+			t0 = time.time()
+			for _ in range(n_runs):
+				encoder(X, mu, sig, w, out=out)
+			t0 = time.time() - t0
+
+		assert np.allclose(out, ref, atol=1e-4, rtol=1e-3), \
+			"Threaded encoding differs from the reference!"
+
+		throughput = N * n_runs / t0
+		base = base or throughput
+		print(f"{n_threads:>8d} | {throughput:>10.1f} | {throughput / base:>7.2f}x")
@@ -0,0 +1,128 @@
+""" Mixed-precision policies for the encoding and the EM updates. """
+import numpy as np
+
+
+class PrecisionPolicy(object):
+	"""
+		Defines the dtypes of the single stages of the computations:
+
+			storage:   input features and the large intermediates of the
+			           shape (n, t, in_size, n_components)
+			dist:      the computation of the distance terms (x - mu)**2 / sig
+			logsumexp: the (log-)likelihoods, the logsumexp over the
+			           components and the resulting soft assignment
+			stats:     the sums of the Fisher vector statistics over the
+			           features and their normalization
+			m_step:    the accumulation of the EM M-step
+			output:    the resulting encoding
+
+		The parameters of the mixture keep their own dtype (usually float32).
+
+		With the default MIXED16 policy, the features, the contributions
+		of the features to the statistics and the encoding are rounded to
+		float16. The distance terms are computed in float32: in float16,
+		their rounding changed the log-likelihoods by up to
+		u * sum_d (x_d - mu_d)**2 / sig_d and was the dominant error of
+		the soft assignment and hence of the encoding. The remaining
+		deviation from the float32 results is bounded by
+		mixed16_error_bound.
+	"""
+
+	STAGES = ("storage", "dist", "logsumexp", "stats", "m_step", "output")
+
+	def __init__(self, storage=np.float16, *,
+		dist=None,
+		logsumexp=np.float32,
+		stats=np.float32,
+		m_step=np.float32,
+		output=None):
+
+		self.storage = np.dtype(storage)
+		self.dist = np.dtype(dist or storage)
+		self.logsumexp = np.dtype(logsumexp)
+		self.stats = np.dtype(stats)
+		self.m_step = np.dtype(m_step)
+		self.output = np.dtype(output or storage)
+
+	def dtype(self, stage):
+		assert stage in self.STAGES, \
+			f"Unknown stage \"{stage}\"! Possible stages are: {', '.join(self.STAGES)}"
+		return getattr(self, stage)
+
+	def __repr__(self):
+		stages = ", ".join(f"{stage}={self.dtype(stage).name}" for stage in self.STAGES)
+		return f"<{type(self).__name__}: {stages}>"
+
+
+MIXED16 = PrecisionPolicy(np.float16, dist=np.float32)
+
+_POLICIES = dict(
+	mixed16=MIXED16,
+)
+
+def get_policy(policy):
+	""" returns a policy from a policy instance, its name or None """
+	if policy is None or isinstance(policy, PrecisionPolicy):
+		return policy
+
+	if policy not in _POLICIES:
+		raise ValueError(f"Unknown precision policy \"{policy}\"! "
+			f"Possible policies are: {', '.join(_POLICIES)}")
+
+	return _POLICIES[policy]
+
+
+def mixed16_error_bound(x, mu, sig, w, gamma):
+	"""
+		First-order bound of the deviation of the MIXED16 results from the
+		float32 results for the features x (n, t, in_size), the parameters
+		mu, sig (in_size, n_components), w (n_components,) and the float32
+		soft assignment gamma (n, t, n_components). Returns the bounds of
+		the soft assignment (n, t, n_components) and of the unnormalized
+		encoding with both statistics (n, 2*n_components*in_size).
+
+		With the unit roundoff u = 2**-11 and the absolute rounding error
+		of the subnormals eta = 2**-25 of float16:
+
+		- rounding of the features: |dx_d| <= u * |x_d|. The
+		  log-likelihoods change by at most
+		  L_k = u * sum_d |x_d| * |x_d - mu_dk| / sig_dk, hence
+		  |d gamma_k| <= gamma_k * (L_k + sum_j gamma_j * L_j).
+		- z = (x - mu) / sqrt(sig) from the rounded x, mu and sig
+		  (one rounding each, followed by the subtraction, the square
+		  root and the division):
+		  |dz| <= u * (|x| + |mu|) / sqrt(sig) + 3.5 * u * |z|.
+		- contributions gamma * z and gamma * (z**2 - 1) (the rounding of
+		  gamma, of the square, of the subtraction and of the products),
+		  the sums over the features in float32 (negligible) and the
+		  rounding of the encoding G: u * |G| + eta.
+	"""
+	u, eta = 2.0**-11, 2.0**-25
+	x = np.asarray(x, dtype=np.float64)[..., None]
+	mu, sig, w, gamma = [np.asarray(p, dtype=np.float64) for p in (mu, sig, w, gamma)]
+	n, t = x.shape[:2]
+
+	L = u * (np.abs(x) * np.abs(x - mu) / sig).sum(axis=2)
+	d_gamma = gamma * (L + (gamma * L).sum(axis=-1, keepdims=True))
+
+	std = np.sqrt(sig)
+	z = (x - mu) / std
+	dz = u * (np.abs(x) + np.abs(mu)) / std + 3.5 * u * np.abs(z)
+	g, dg = gamma[:, :, None], d_gamma[:, :, None]
+
+	z_sig = z**2 - 1
+	contributions = [
+		# contribution, its deviation and 1 / (T * sqrt(w)) of the statistic
+		(g * z, dg * np.abs(z) + g * (dz + 2 * u * np.abs(z)), 1 / (t * np.sqrt(w))),
+		(g * z_sig, dg * np.abs(z_sig) + g * (2 * np.abs(z) * dz + u * z**2 + 3 * u * np.abs(z_sig)),
+			1 / (t * np.sqrt(2 * w))),
+	]
+
+	bounds = []
+	for c, dc, scale in contributions:
+		G = c.sum(axis=1) * scale
+		dG = (dc + 2 * eta).sum(axis=1) * scale + u * np.abs(G) + eta
+		# (n, in_size, n_components) -> (n, n_components, in_size)
+		bounds.append(dG.transpose(0, 2, 1))
+
+	return d_gamma, np.stack(bounds, axis=1).reshape(n, -1)
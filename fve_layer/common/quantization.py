@@ -0,0 +1,201 @@
+""" Product quantization of the Fisher vectors.
+
+	The encoding (n, S*n_components*in_size) consists of one (S, in_size)
+	block per mixture component. Every block is split into n_subvectors
+	sub-vectors and every sub-vector is quantized by its own codebook with
+	n_centroids entries, that is the means of a mixture (mixtures.GMM,
+	initialized with k-means). A Fisher vector is stored as
+	n_components * n_subvectors codes of one or two bytes.
+
+	The database is searched with asymmetric distances (ADC): the query is
+	not quantized, instead a lookup table with the squared distances
+	between the sub-vectors of the query and all centroids is computed
+	once per query and the distance to a code is a sum of table entries.
+"""
+import numpy as np
+
+from fve_layer.common import encoding
+from fve_layer.common import mixtures
+
+
+class ProductQuantizer(object):
+
+	def __init__(self, in_size, n_components, n_statistics=2, *,
+		n_subvectors=1,
+		n_centroids=256,
+		max_iter=10,
+		random_state=None,
+		gmm_cls=None):
+
+		block_size = n_statistics * in_size
+		assert block_size % n_subvectors == 0, \
+			f"Block size ({block_size}) is not divisible by the number of sub-vectors ({n_subvectors})!"
+		assert n_centroids <= 2**16, \
+			"At most 2**16 centroids are supported!"
+
+		self.in_size = in_size
+		self.n_components = n_components
+		self.n_statistics = n_statistics
+		self.n_subvectors = n_subvectors
+		self.n_centroids = n_centroids
+		self.max_iter = max_iter
+		self.random_state = random_state
+		self.gmm_cls = gmm_cls
+
+		self.code_dtype = np.uint8 if n_centroids <= 2**8 else np.uint16
+		self.centroids = None
+
+	@property
+	def n_codes(self):
+		""" number of codes per Fisher vector """
+		return self.n_components * self.n_subvectors
+
+	@property
+	def sub_size(self):
+		return self.n_statistics * self.in_size // self.n_subvectors
+
+	@property
+	def code_nbytes(self):
+		""" memory of a single quantized Fisher vector """
+		return self.n_codes * np.dtype(self.code_dtype).itemsize
+
+	def _sub_vectors(self, fv):
+		""" (n, S*n_components*in_size) -> (n, n_codes, sub_size) """
+		blocks = encoding._as_blocks(fv, self.in_size, self.n_components)
+		# (n, S, n_components, in_size) -> (n, n_components, S, in_size)
+		blocks = blocks.transpose(0, 2, 1, 3)
+		return blocks.reshape(len(fv), self.n_codes, self.sub_size)
+
+	def new_gmm(self):
+		return (self.gmm_cls or mixtures.GMM)(
+			n_components=self.n_centroids,
+			covariance_type="diag",
+			init_params="kmeans",
+			max_iter=self.max_iter,
+			random_state=self.random_state,
+		)
+
+	def fit(self, fv):
+		""" trains the codebooks on the encodings (N, S*n_components*in_size) """
+		assert len(fv) >= self.n_centroids, \
+			f"At least {self.n_centroids} training samples are required!"
+
+		X = self._sub_vectors(fv)
+		centroids = np.empty((self.n_codes, self.n_centroids, self.sub_size), dtype=fv.dtype)
+
+		for j in range(self.n_codes):
+			gmm = self.new_gmm()
+			gmm.fit(np.ascontiguousarray(X[:, j]))
+			centroids[j] = gmm.means_
+
+		self.centroids = centroids
+		return self
+
+	def _check_fitted(self):
+		assert self.centroids is not None, \
+			"Quantizer was not trained yet!"
+
+	def lookup_tables(self, queries):
+		""" squared distances between the sub-vectors of the queries and
+			all centroids with the shape (q, n_codes, n_centroids)
+		"""
+		self._check_fitted()
+		X = self._sub_vectors(queries)
+		c_norms = (self.centroids**2).sum(axis=-1)
+		x_norms = (X**2).sum(axis=-1, keepdims=True)
+		# (n_codes, q, sub_size) x (n_codes, sub_size, n_centroids)
+		dots = np.matmul(X.transpose(1, 0, 2), self.centroids.transpose(0, 2, 1))
+		return x_norms - 2 * dots.transpose(1, 0, 2) + c_norms
+
+	def encode(self, fv, chunk_size=1024):
+		""" quantizes the encodings: (N, S*n_components*in_size) -> (N, n_codes) """
+		codes = np.empty((len(fv), self.n_codes), dtype=self.code_dtype)
+		for i0 in range(0, len(fv), chunk_size):
+			tables = self.lookup_tables(fv[i0:i0 + chunk_size])
+			codes[i0:i0 + chunk_size] = tables.argmin(axis=-1)
+		return codes
+
+	def decode(self, codes):
+		""" reconstructs the (approximated) encodings from the codes """
+		self._check_fitted()
+		n = len(codes)
+		S, K, D = self.n_statistics, self.n_components, self.in_size
+
+		X = self.centroids[np.arange(self.n_codes), codes]
+		# (n, n_components, S, in_size) -> (n, S, n_components, in_size)
+		X = X.reshape(n, K, S, D).transpose(0, 2, 1, 3)
+		return X.reshape(n, -1)
+
+	def distances(self, queries, codes, *, tables=None, chunk_size=4096):
+		""" asymmetric squared distances between the queries and the
+			quantized encodings with the shape (q, N)
+		"""
+		if tables is None:
+			tables = self.lookup_tables(queries)
+
+		q = len(tables)
+		res = np.empty((q, len(codes)), dtype=tables.dtype)
+		idxs = np.arange(self.n_codes)
+
+		for i0 in range(0, len(codes), chunk_size):
+			_codes = codes[i0:i0 + chunk_size].astype(np.intp)
+			# (q, chunk, n_codes) -> (q, chunk)
+			res[:, i0:i0 + chunk_size] = tables[:, idxs, _codes].sum(axis=-1)
+
+		return res
+
+	def search(self, queries, codes, k=10, *, chunk_size=4096):
+		""" returns the distances and the indices of the k nearest
+			quantized encodings for every query, each with shape (q, k)
+		"""
+		dist = self.distances(queries, codes, chunk_size=chunk_size)
+		k = min(k, dist.shape[1])
+
+		idxs = np.argpartition(dist, k - 1, axis=1)[:, :k]
+		_dist = np.take_along_axis(dist, idxs, axis=1)
+		order = np.argsort(_dist, axis=1)
+
+		return np.take_along_axis(_dist, order, axis=1), np.take_along_axis(idxs, order, axis=1)
+
+
+# recall vs. memory of the quantized encodings
+if __name__ == '__main__':
+	import time
+
+	rnd = np.random.RandomState(0)
+	N, Q, T, D, K = 2000, 100, 32, 32, 8
+
+	mu = rnd.randn(D, K).astype(np.float32)
+	sig = (rnd.rand(D, K) + 0.5).astype(np.float32)
+	w = np.full(K, 1 / K, dtype=np.float32)
+
+	def sample(n):
+		# every image has its own subset of components
+		comps = rnd.randint(K, size=(n, T))
+		X = mu.T[comps] + rnd.randn(n, T, D).astype(np.float32) * np.sqrt(sig.T[comps])
+		fv = encoding.encode(X, mu, sig, w)
+		return encoding.normalize(fv, D, K, power=0.5, l2=True)
+
+	database, queries = sample(N), sample(Q)
+	sq_dist = ((queries[:, None] - database[None])**2).sum(axis=-1)
+	nearest = sq_dist.argmin(axis=1)
+
+	print(f"float32 encodings: {database[0].nbytes:,d} bytes per image")
+	for n_subvectors, n_centroids in [(1, 64), (1, 256), (4, 256), (16, 256)]:
+		pq = ProductQuantizer(D, K,
+			n_subvectors=n_subvectors,
+			n_centroids=n_centroids,
+			random_state=0)
+
+		t0 = time.time()
+		codes = pq.fit(database).encode(database)
+		t_train = time.time() - t0
+
+		t0 = time.time()
+		_, idxs = pq.search(queries, codes, k=10)
+		t_search = time.time() - t0
+
+		recall = {R: np.mean([n in idx[:R] for n, idx in zip(nearest, idxs)]) for R in (1, 10)}
+		print(f"m={n_subvectors:2d}, c={n_centroids:3d}: {pq.code_nbytes:4d} bytes per image, "
+			f"recall@1={recall[1]:.2f}, recall@10={recall[10]:.2f} "
+			f"(training: {t_train:.1f}s, search: {t_search * 1000:.1f}ms)")
@@ -0,0 +1,118 @@
+""" Vectorized sampling from a mixture with diagonal covariances.
+
+	The number of the samples of every component is drawn with a single
+	multinomial draw. Afterwards, the standard normal noise of all samples
+	is drawn at once into a preallocated array (optionally in chunks of
+	rows, which bounds the memory of the temporary arrays of the GPU) and
+	the rows of every component are scaled and shifted in-place, i.e.
+	mu_k + std_k * eps.
+
+	Like in sklearn, the samples are ordered by their component.
+"""
+import numpy as np
+
+
+def _rng(random_state, xp=np):
+	""" a random generator of xp from a seed, a generator or None """
+	if random_state is None or isinstance(random_state, (int, np.integer)):
+		if xp is np:
+			return np.random.default_rng(random_state)
+		return xp.random.RandomState(random_state)
+
+	if isinstance(random_state, np.random.RandomState):
+		# derive a seed from the legacy generator (e.g. of sklearn)
+		return _rng(int(random_state.randint(2**31)), xp=xp)
+
+	return random_state
+
+
+def _standard_normal(rng, out):
+	if isinstance(rng, np.random.Generator) and out.dtype in (np.float32, np.float64):
+		return rng.standard_normal(dtype=out.dtype, out=out)
+	out[:] = rng.standard_normal(out.shape, dtype=out.dtype)
+	return out
+
+
+def sample(means, variances, weights, n_samples, *,
+	random_state=None, chunk_size=None, out=None, dtype=None, xp=np):
+	"""
+		means:       (n_components, n_features)
+		variances:   broadcastable to the shape of the means
+		weights:     (n_components,)
+		chunk_size:  number of the rows, that are generated at once
+		out:         preallocated array (n_samples, n_features) for the samples
+
+		Returns the samples (n_samples, n_features) and their components (n_samples,).
+	"""
+	n_components, n_features = means.shape
+	rng = _rng(random_state, xp=xp)
+
+	# the multinomial is drawn on the CPU in double precision
+	pvals = np.asarray(_to_cpu(weights), dtype=np.float64)
+	pvals = pvals / pvals.sum()
+	cpu_rng = rng
+	if not isinstance(rng, np.random.Generator):
+		cpu_rng = np.random.default_rng(int(rng.randint(2**31)))
+	counts = cpu_rng.multinomial(n_samples, pvals)
+
+	labels = xp.repeat(xp.arange(n_components), xp.asarray(counts))
+
+	if out is None:
+		out = xp.empty((n_samples, n_features), dtype=dtype or means.dtype)
+
+	assert out.shape == (n_samples, n_features), \
+		f"Output has a wrong shape: {out.shape} != {(n_samples, n_features)}"
+
+	chunk_size = chunk_size or max(n_samples, 1)
+	for i0 in range(0, n_samples, chunk_size):
+		_standard_normal(rng, out[i0:i0 + chunk_size])
+
+	std = xp.sqrt(xp.broadcast_to(variances, means.shape)).astype(out.dtype, copy=False)
+	means = means.astype(out.dtype, copy=False)
+
+	# the samples are ordered by their component
+	bounds = np.concatenate([[0], np.cumsum(counts)]).tolist()
+	for k, (i0, i1) in enumerate(zip(bounds[:-1], bounds[1:])):
+		if i0 == i1:
+			continue
+		out[i0:i1] *= std[k]
+		out[i0:i1] += means[k]
+
+	return out, labels
+
+
+def _to_cpu(arr):
+	return arr.get() if hasattr(arr, "get") else arr
+
+
+# runtime of the vectorized sampling vs. the one of sklearn
+if __name__ == '__main__':
+	import time
+
+	from sklearn.mixture import GaussianMixture
+
+	rnd = np.random.RandomState(0)
+	N, D, K = 1_000_000, 64, 256
+
+	means = rnd.randn(K, D).astype(np.float32)
+	variances = (rnd.rand(K, D) + 0.5).astype(np.float32)
+	weights = rnd.dirichlet(np.ones(K)).astype(np.float32)
+
+	gmm = GaussianMixture(K, covariance_type="diag")
+	gmm.means_, gmm.covariances_, gmm.weights_ = means, variances, weights
+
+	t0 = time.time()
+	X_sk, _ = gmm.sample(N)
+	t_sk = time.time() - t0
+	print(f"sklearn:    {t_sk:.2f}s ({X_sk.dtype})")
+
+	out = np.empty((N, D), dtype=np.float32)
+	for chunk_size in [None, 65536]:
+		t0 = time.time()
+		X, y = sample(means, variances, weights, N,
+			random_state=0, chunk_size=chunk_size, out=out)
+		t = time.time() - t0
+		print(f"vectorized: {t:.2f}s ({X.dtype}, chunk_size={chunk_size}, speed-up: {t_sk / t:.1f}x)")
+
+	err = np.abs(X.mean(axis=0) - weights @ means).max()
+	print(f"max. deviation of the sample mean: {err:.4f}")
@@ -0,0 +1,168 @@
+""" Graph-free scoring of large sets of features w.r.t. a mixture.
+
+	The features (N, in_size) (e.g. an np.memmap of a whole dataset) are
+	processed in chunks of rows, that are scored in a thread pool. For
+	every feature, the log-likelihood under the mixture and the nearest
+	component are computed with two matrix products per chunk (see
+	encoding.EncodingParams). The Mahalanobis distance to the nearest
+	component is computed directly from the differences, since the
+	expanded distance cancels for features close to a mean. Optionally,
+	only a running top-k of the features with the lowest log-likelihood
+	(the most anomalous ones) is kept. At most 2 * n_threads chunks are
+	in flight, each with (chunk_size, n_components) intermediates, hence
+	the memory does not depend on N.
+"""
+import numpy as np
+import os
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from fve_layer.common import encoding
+from fve_layer.common.parallel import _split
+
+# per-feature results (None, if not requested) and the top-k as
+# (indices, log_likelihoods), sorted from the most anomalous feature
+Scores = namedtuple("Scores", ["log_likelihood", "nearest", "distance", "top_k"])
+
+
+def _to_cpu(arr):
+	return arr.get() if hasattr(arr, "get") else arr
+
+
+class TopK(object):
+	""" running selection of the k smallest scores and their indices """
+
+	def __init__(self, k, dtype=np.float64):
+		self.k = k
+		self.scores = np.empty(0, dtype=dtype)
+		self.indices = np.empty(0, dtype=np.int64)
+
+	def update(self, scores, indices):
+		scores = np.concatenate([self.scores, scores])
+		indices = np.concatenate([self.indices, indices])
+		if len(scores) > self.k:
+			keep = np.argpartition(scores, self.k - 1)[:self.k]
+			scores, indices = scores[keep], indices[keep]
+		self.scores, self.indices = scores, indices
+
+	def result(self):
+		order = np.argsort(self.scores, kind="stable")
+		return self.indices[order], self.scores[order]
+
+
+class MixtureScorer(object):
+
+	def __init__(self, mu, sig, w, *, chunk_size=16384, n_threads=None, xp=np):
+		"""
+			mu, sig, w: parameters in the layout of the layers
+			            (sig is broadcasted to the shape of mu)
+		"""
+		sig = xp.broadcast_to(sig, mu.shape)
+		self.params = encoding.EncodingParams(mu, sig, w, xp=xp)
+		# the squared Mahalanobis distances do not contain the normalization
+		self.mu_prec = xp.sum(self.params.mu_c**2 * self.params.prec, axis=0)
+		self.chunk_size = chunk_size
+		# the GPU is not shared by several threads
+		self.n_threads = 1 if xp is not np else (n_threads or os.cpu_count() or 1)
+		self.xp = xp
+		self._pool = None
+
+	@property
+	def pool(self):
+		if self._pool is None:
+			self._pool = ThreadPoolExecutor(self.n_threads,
+				thread_name_prefix="fve_scorer")
+		return self._pool
+
+	def close(self):
+		if self._pool is not None:
+			self._pool.shutdown()
+			self._pool = None
+
+	def score_chunk(self, X):
+		""" log-likelihoods, nearest components and their distances of X (N, in_size) """
+		xp, p = self.xp, self.params
+		X = xp.asarray(X, dtype=np.promote_types(X.dtype, p.mu.dtype))
+		# the terms of the parameters are relative to their reference point
+		X = X - p.center
+
+		res = X @ p.lin
+		res += (X**2) @ p.prec
+
+		nearest = (res + self.mu_prec).argmin(axis=1)
+		diff = X - p.mu_c.T[nearest]
+		dist = xp.sqrt(xp.sum(diff**2 * p.prec.T[nearest], axis=1))
+
+		res += p.const
+		res *= -0.5
+		res += p.log_w
+		_max = res.max(axis=1, keepdims=True)
+		log_likelihood = _max[:, 0] + xp.log(xp.exp(res - _max).sum(axis=1))
+
+		return log_likelihood, nearest, dist
+
+	def __call__(self, X, *, top_k=None, per_feature=True):
+		"""
+			Scores the features X (N, in_size). If per_feature is False,
+			only the top_k most anomalous features are returned.
+		"""
+		N = len(X)
+		dtype = np.promote_types(X.dtype, self.params.mu.dtype)
+		chunks = _split(N, chunk_size=self.chunk_size)
+
+		log_likelihood = nearest = distance = None
+		if per_feature:
+			log_likelihood = np.empty(N, dtype=dtype)
+			nearest = np.empty(N, dtype=np.int64)
+			distance = np.empty(N, dtype=dtype)
+
+		topk = None if top_k is None else TopK(min(top_k, N), dtype=dtype)
+
+		def _score(i0, i1):
+			res = [_to_cpu(r) for r in self.score_chunk(X[i0:i1])]
+			if per_feature:
+				log_likelihood[i0:i1], nearest[i0:i1], distance[i0:i1] = res
+			if topk is None:
+				return None
+			# the candidates of the chunk are merged in the calling thread
+			k = min(topk.k, i1 - i0)
+			idxs = np.argpartition(res[0], k - 1)[:k]
+			return res[0][idxs], idxs + i0
+
+		# at most 2 * n_threads chunks are in flight
+		window = 2 * self.n_threads
+		for c0 in range(0, len(chunks), window):
+			futures = [self.pool.submit(_score, *c) for c in chunks[c0:c0 + window]]
+			for f in futures:
+				res = f.result()
+				if res is not None:
+					topk.update(*res)
+
+		return Scores(log_likelihood, nearest, distance,
+			None if topk is None else topk.result())
+
+
+# throughput of the chunked scoring against the number of threads
+if __name__ == '__main__':
+	import time
+
+	rnd = np.random.RandomState(0)
+	N, D, K = 1_000_000, 64, 256
+	dtype = np.float32
+
+	X = rnd.randn(N, D).astype(dtype)
+	mu = rnd.randn(D, K).astype(dtype)
+	sig = (rnd.rand(D, K) + 0.5).astype(dtype)
+	w = np.full(K, 1 / K, dtype=dtype)
+
+	print(f"Input: {X.shape}, components: {K}")
+	for n_threads in [1, 2, 4, 8]:
+		if n_threads > (os.cpu_count() or 1):
+			break
+		scorer = MixtureScorer(mu, sig, w, n_threads=n_threads)
+		t0 = time.time()
+		scores = scorer(X, top_k=100)
+		t = time.time() - t0
+		scorer.close()
+		print(f"{n_threads:>2d} threads: {t:.2f}s ({N / t / 1e6:.2f}M features/s)")
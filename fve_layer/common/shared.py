@@ -0,0 +1,240 @@
+""" Shared-memory snapshots of the mixture parameters.
+
+	The parameters (mu, sig, w) are stored in a shared memory block, that
+	can be mapped (without copying) by other processes, e.g. the workers
+	of a chainer.iterators.MultiprocessIterator. Pickling the snapshot only
+	transfers the name of the memory block, hence it is cheap to pass it
+	to a worker.
+
+	The block holds two parameter slots (double-buffering): a new version
+	of the parameters is written into the inactive slot and published
+	afterwards by switching the active slot and increasing the version
+	counter. Every slot is guarded by a sequence counter, that is odd
+	while the slot is written, so that readers detect an overwritten slot
+	and retry without any locks.
+"""
+import mmap
+import numpy as np
+import os
+
+from multiprocessing import shared_memory
+
+from fve_layer.common import encoding
+
+# header layout: [version, active slot, sequence of slot 0, sequence of slot 1]
+_VERSION, _ACTIVE, _SEQ = 0, 1, 2
+_HEADER_SIZE = 4
+_ALIGN = 64
+
+
+def _aligned(nbytes):
+	return -(-nbytes // _ALIGN) * _ALIGN
+
+
+def _attach(name):
+	""" attaches to an existing block without registering it at the
+		resource tracker, otherwise the block would be removed as soon
+		as the first worker exits.
+	"""
+	try:
+		return shared_memory.SharedMemory(name=name, track=False)
+	except TypeError: # python < 3.13
+		pass
+
+	if os.name == "nt":
+		# the blocks are not tracked on windows
+		return shared_memory.SharedMemory(name=name)
+	return _UntrackedBlock(name)
+
+
+class _UntrackedBlock(object):
+	""" a mapping of an existing POSIX shared memory block, that is not
+		registered at the resource tracker (unlike SharedMemory before
+		python 3.13). Unregistering after the attach is not an option:
+		the workers share the resource tracker of the creator, hence the
+		registration of the creator would be removed as well.
+	"""
+
+	def __init__(self, name):
+		import _posixshmem
+
+		fd = _posixshmem.shm_open("/" + name, os.O_RDWR, mode=0o600)
+		try:
+			self._mmap = mmap.mmap(fd, os.fstat(fd).st_size)
+		finally:
+			os.close(fd)
+		self.name = name
+		self.buf = memoryview(self._mmap)
+
+	def close(self):
+		self.buf.release()
+		self._mmap.close()
+
+
+class SharedParameters(object):
+
+	def __init__(self, in_size, n_components, dtype=np.float32, *, name=None):
+		self.in_size = in_size
+		self.n_components = n_components
+		self.dtype = np.dtype(dtype)
+		self._owner = name is None
+
+		if self._owner:
+			self._shm = shared_memory.SharedMemory(create=True, size=self.nbytes)
+		else:
+			self._shm = _attach(name)
+
+		self._init_views()
+		if self._owner:
+			self._header[:] = 0
+
+	@classmethod
+	def from_layer(cls, layer):
+		mu, sig, w = _layer_params(layer)
+		res = cls(layer.in_size, layer.n_components, dtype=mu.dtype)
+		res.publish(mu, sig, w)
+		return res
+
+	@property
+	def name(self):
+		return self._shm.name
+
+	@property
+	def _param_shapes(self):
+		D, K = self.in_size, self.n_components
+		return [(D, K), (D, K), (K,)]
+
+	@property
+	def _slot_nbytes(self):
+		return sum(_aligned(int(np.prod(s)) * self.dtype.itemsize)
+			for s in self._param_shapes)
+
+	@property
+	def nbytes(self):
+		return _aligned(_HEADER_SIZE * 8) + 2 * self._slot_nbytes
+
+	def _init_views(self):
+		buf = self._shm.buf
+		self._header = np.ndarray((_HEADER_SIZE,), dtype=np.int64, buffer=buf)
+
+		self._slots = []
+		offset = _aligned(_HEADER_SIZE * 8)
+		for _ in range(2):
+			slot = []
+			for shape in self._param_shapes:
+				arr = np.ndarray(shape, dtype=self.dtype, buffer=buf, offset=offset)
+				slot.append(arr)
+				offset += _aligned(arr.nbytes)
+			self._slots.append(slot)
+
+	def __getstate__(self):
+		return dict(
+			name=self.name,
+			in_size=self.in_size,
+			n_components=self.n_components,
+			dtype=self.dtype.str)
+
+	def __setstate__(self, state):
+		self.__init__(state["in_size"], state["n_components"],
+			dtype=state["dtype"], name=state["name"])
+
+	@property
+	def version(self):
+		""" is increased on every publish; 0 means nothing was published yet """
+		return int(self._header[_VERSION])
+
+	def publish(self, mu, sig, w):
+		""" writes new parameters (only from a single writer process!) """
+		assert self._owner, \
+			"Only the process, that created the shared parameters, may publish!"
+
+		slot = 1 - int(self._header[_ACTIVE]) if self.version else 0
+
+		self._header[_SEQ + slot] += 1
+		for dst, src in zip(self._slots[slot], (mu, sig, w)):
+			dst[:] = _to_cpu(src)
+		self._header[_SEQ + slot] += 1
+
+		self._header[_ACTIVE] = slot
+		self._header[_VERSION] += 1
+
+	def snapshot(self):
+		""" returns zero-copy views of the currently active parameters
+			together with the version and a token, that can be validated
+			with is_valid after the views were used.
+		"""
+		assert self.version > 0, \
+			"No parameters were published yet!"
+
+		while True:
+			version = self.version
+			slot = int(self._header[_ACTIVE])
+			seq = int(self._header[_SEQ + slot])
+			if seq % 2 == 0:
+				mu, sig, w = self._slots[slot]
+				return (mu, sig, w), version, (slot, seq)
+
+	def is_valid(self, token):
+		""" checks, whether the slot of a snapshot was not overwritten """
+		slot, seq = token
+		return int(self._header[_SEQ + slot]) == seq
+
+	def copy(self):
+		""" returns a consistent copy of the current parameters """
+		while True:
+			params, version, token = self.snapshot()
+			res = [p.copy() for p in params]
+			if self.is_valid(token):
+				return res, version
+
+	def encode(self, x, use_mask=False, visibility_mask=None, eps=1e-6, *,
+		statistics=("mu", "sig"), normalization=None):
+		""" worker-side equivalent of FVEMixin.encode. x has either the
+			shape (t, in_size) or (n, t, in_size). normalization is passed
+			to encoding.normalize (e.g. FVEMixin.normalization).
+		"""
+		single = x.ndim == 2
+		X = x[None] if single else x
+
+		selected = None
+		if use_mask:
+			selected = encoding.selection_mask(X, visibility_mask)
+			selected = selected.astype(self.dtype)
+
+		while True:
+			(mu, sig, w), _, token = self.snapshot()
+			res = encoding.encode(X.astype(self.dtype, copy=False),
+				mu, sig, w, selected, eps=eps, statistics=statistics)
+			if self.is_valid(token):
+				break
+
+		if normalization:
+			res = encoding.normalize(res, self.in_size, self.n_components,
+				**normalization)
+
+		res = res.astype(x.dtype, copy=False)
+		return res[0] if single else res
+
+	def close(self):
+		self._header = self._slots = None
+		self._shm.close()
+
+	def unlink(self):
+		""" removes the shared memory block (only by the creator) """
+		self.close()
+		if self._owner:
+			self._shm.unlink()
+
+
+def _to_cpu(arr):
+	arr = getattr(arr, "array", arr)
+	return arr.get() if hasattr(arr, "get") else arr
+
+
+def _layer_params(layer):
+	return [_to_cpu(p) for p in (layer.mu, layer.sig, layer.w)]
+
+
+def worker_encode(shared_params, x, **kwargs):
+	""" picklable encoding function, e.g. for a TransformDataset """
+	return shared_params.encode(x, **kwargs)
@@ -0,0 +1,211 @@
+""" Block-sparse format of the Fisher vectors.
+
+	After the masking of the soft assignment (gamma < eps), a component
+	without any assigned feature contributes an all-zero block of the
+	shape (S, in_size) to the encoding of a sample (S is the number of the
+	selected statistics). In the block-sparse format, only the blocks of
+	the active components are computed and stored, similar to the CSR
+	format: the blocks of sample i are blocks[indptr[i]:indptr[i+1]] and
+	belong to the components components[indptr[i]:indptr[i+1]].
+"""
+import numpy as np
+
+from fve_layer.common import encoding
+
+
+def _to_cpu(arr):
+	return arr.get() if hasattr(arr, "get") else arr
+
+
+class BlockSparseFV(object):
+
+	def __init__(self, indptr, components, blocks, n_components, *, xp=np):
+		self.indptr = indptr
+		self.components = components
+		self.blocks = blocks
+		self.n_components = n_components
+		self.xp = xp
+
+	@property
+	def n(self):
+		return len(self.indptr) - 1
+
+	@property
+	def shape(self):
+		nnz, S, D = self.blocks.shape
+		return (self.n, S * self.n_components * D)
+
+	@property
+	def dtype(self):
+		return self.blocks.dtype
+
+	@property
+	def nbytes(self):
+		return self.indptr.nbytes + self.components.nbytes + self.blocks.nbytes
+
+	@property
+	def density(self):
+		""" fraction of the active blocks """
+		return len(self.components) / max(self.n * self.n_components, 1)
+
+	@property
+	def sample_indices(self):
+		""" sample index of every block """
+		xp = self.xp
+		return xp.repeat(xp.arange(self.n), xp.diff(self.indptr))
+
+	@classmethod
+	def from_dense(cls, fv, in_size, n_components, *, xp=np):
+		""" converts encodings with the shape (n, S*n_components*in_size) """
+		# (n, S, n_components, in_size) -> (n, n_components, S, in_size)
+		blocks = encoding._as_blocks(fv, in_size, n_components).transpose(0, 2, 1, 3)
+		active = (blocks != 0).any(axis=(2, 3))
+		sample_idx, components = xp.nonzero(active)
+
+		indptr = xp.zeros(len(fv) + 1, dtype=np.int64)
+		indptr[1:] = xp.cumsum(active.sum(axis=1))
+		return cls(indptr, components, blocks[sample_idx, components], n_components, xp=xp)
+
+	def to_dense(self, out=None):
+		nnz, S, D = self.blocks.shape
+		xp = self.xp
+		if out is None:
+			out = xp.zeros((self.n, S, self.n_components, D), dtype=self.dtype)
+		else:
+			out = out.reshape(self.n, S, self.n_components, D)
+			out[:] = 0
+
+		out[self.sample_indices, :, self.components] = self.blocks
+		return out.reshape(self.shape)
+
+	def to_csr(self):
+		""" converts the encodings to a scipy.sparse.csr_matrix (on the CPU) """
+		try:
+			from scipy import sparse
+		except ImportError as e: # pragma: no cover
+			raise ImportError("Conversion to CSR requires scipy!") from e
+
+		nnz, S, D = self.blocks.shape
+		K = self.n_components
+		rows = _to_cpu(self.sample_indices)[:, None, None]
+		comps = _to_cpu(self.components)[:, None, None]
+		# column of the entry (s, d) of the block of component k
+		cols = np.arange(S)[:, None] * K * D + comps * D + np.arange(D)
+
+		res = sparse.csr_matrix(
+			(_to_cpu(self.blocks).ravel(),
+				(np.broadcast_to(rows, cols.shape).ravel(), cols.ravel())),
+			shape=self.shape)
+		res.sort_indices()
+		return res
+
+	def normalize(self, power=None, intra=False, l2=False, eps=1e-12):
+		""" block-sparse equivalent of encoding.normalize """
+		xp = self.xp
+		blocks = self.blocks
+		if power is not None:
+			blocks = xp.sign(blocks) * xp.abs(blocks)**power
+
+		if intra:
+			norms = xp.sqrt((blocks**2).sum(axis=(1, 2), keepdims=True))
+			blocks = blocks / xp.maximum(norms, eps)
+
+		if l2:
+			sq_norms = xp.bincount(self.sample_indices,
+				weights=(blocks**2).sum(axis=(1, 2)), minlength=self.n)
+			norms = xp.maximum(xp.sqrt(sq_norms), eps).astype(blocks.dtype)
+			blocks = blocks / norms[self.sample_indices, None, None]
+
+		return BlockSparseFV(self.indptr, self.components, blocks, self.n_components, xp=xp)
+
+	def dot(self, W, b=None):
+		"""
+			Linear scoring of the encodings (equivalent to fv @ W.T + b),
+			that only touches the weights of the active blocks.
+
+			W: weights with the shape (out_size, S*n_components*in_size)
+		"""
+		xp = self.xp
+		nnz, S, D = self.blocks.shape
+		C = W.shape[0]
+		W4 = W.reshape(C, S, self.n_components, D)
+		dtype = np.promote_types(self.dtype, W.dtype)
+		y = xp.zeros((self.n, C), dtype=dtype)
+
+		# group the blocks by their component: one GEMM per active component
+		order = xp.argsort(self.components, kind="stable")
+		comps = self.components[order]
+		rows = self.sample_indices[order]
+		bounds = xp.searchsorted(comps, xp.arange(self.n_components + 1)).tolist()
+
+		for k, (i0, i1) in enumerate(zip(bounds[:-1], bounds[1:])):
+			if i0 == i1:
+				continue
+			blocks = self.blocks[order[i0:i1]].reshape(i1 - i0, S * D)
+			# every sample has at most one block per component
+			y[rows[i0:i1]] += blocks @ W4[:, :, k].reshape(C, S * D).T
+
+		if b is not None:
+			y += b
+		return y
+
+
+def encode(X, mu, sig, w, selected=None, *, eps=1e-6,
+	statistics=("mu", "sig"), xp=np):
+	""" block-sparse equivalent of encoding.encode: the statistics and
+		the Fisher vector are only computed for the active blocks.
+	"""
+	n, t, D = X.shape
+	params = encoding.EncodingParams(mu, sig, w, xp=xp)
+	gamma = encoding.soft_assignment(X.reshape(-1, D), params).reshape(n, t, -1)
+
+	# mask out all gammas, that are < eps (see FVEMixin.encode)
+	gamma = gamma * (gamma >= eps)
+	if selected is not None:
+		gamma *= selected[..., None]
+
+	active = (gamma > 0).any(axis=1)
+	sample_idx, components = xp.nonzero(active)
+	indptr = xp.zeros(n + 1, dtype=np.int64)
+	indptr[1:] = xp.cumsum(active.sum(axis=1))
+	nnz = len(components)
+
+	n_feats = xp.full(n, t) if selected is None else selected.sum(axis=1)
+	n_feats = n_feats.astype(gamma.dtype)
+
+	# (nnz, t): soft assignment of the active blocks
+	dtype = np.promote_types(gamma.dtype, encoding.ACCUM_DTYPE)
+	_gamma = gamma[sample_idx, :, components].astype(dtype)
+	S0 = _gamma.sum(axis=1)
+	S1 = xp.empty((nnz, D), dtype=dtype)
+	S2 = xp.empty((nnz, D), dtype=dtype) if "sig" in statistics else None
+
+	# the statistics are relative to the reference point of the mixture
+	# and accumulated in float64 (see encoding.fisher_blocks)
+	bounds = indptr.tolist()
+	for i, (i0, i1) in enumerate(zip(bounds[:-1], bounds[1:])):
+		if i0 == i1:
+			continue
+		x = X[i].astype(dtype) - params.center
+		S1[i0:i1] = _gamma[i0:i1] @ x
+		if S2 is not None:
+			S2[i0:i1] = _gamma[i0:i1] @ x**2
+
+	# the Fisher vector is linear in the statistics, hence all blocks are
+	# normalized by the number of the features of their sample in advance
+	# and are handled as the components of a single sample
+	norm = n_feats[sample_idx]
+	S0 = (S0 / norm)[None]
+	S1 = (S1 / norm[:, None])[None]
+	if S2 is not None:
+		S2 = (S2 / norm[:, None])[None]
+
+	block_params = encoding.EncodingParams(
+		mu[:, components], sig[:, components], w[components], xp=xp,
+		center=params.center)
+	blocks = encoding.fisher_vector(S0, S1, S2, xp.ones(1), block_params,
+		statistics=statistics, dtype=gamma.dtype)
+
+	# (1, S, nnz, in_size) -> (nnz, S, in_size)
+	blocks = blocks[0].transpose(1, 0, 2)
+	return BlockSparseFV(indptr, components, blocks, params.n_components, xp=xp)
@@ -1,9 +1,21 @@
-""" Source: https://jakevdp.github.io/PythonDataScienceHandbook/05.12-gaussian-mixtures.html """
+""" Source: https://jakevdp.github.io/PythonDataScienceHandbook/05.12-gaussian-mixtures.html
+
+	For large sets of points, the points are binned into a 2D histogram
+	(density_bins) and only a stratified subset (n_per_component points
+	of every predicted component) is scattered. The ellipses of all
+	components are drawn as a single EllipseCollection.
+"""
 import numpy as np
+import os
 
 from matplotlib import pyplot as plt
+from matplotlib.collections import EllipseCollection
+from matplotlib.colors import LogNorm
+from matplotlib.colors import to_rgba
 from matplotlib.patches import Ellipse
 
+from fve_layer.common.mixtures.base import _diag_covariances
+
 def draw_ellipse(position, covariance, *, nsig, ax=None, **kwargs):
 	"""Draw an ellipse with a given position and covariance"""
 	ax = ax or plt.gca()
@@ -23,26 +35,167 @@ def draw_ellipse(position, covariance, *, nsig, ax=None, **kwargs):
 			sig_factor * width, sig_factor * height,
 			angle, **kwargs))
 
-def plot_gmm(gmm, X=None, *, nsig=4, label=True, ax=None):
+def ellipse_collection(means, variances, alphas, *, nsig, ax, color="C0"):
+	"""
+		All ellipses (nsig of every component) as a single collection.
+		means and variances have the shape (n_components, 2) (the
+		variances are axis-aligned), alphas has the shape (n_components,).
+	"""
+	factors = np.arange(1, nsig + 1)[:, None, None]
+	# (nsig, n_components, 2) -> (nsig * n_components, 2)
+	sizes = (factors * 2 * np.sqrt(variances)).reshape(-1, 2)
+	offsets = np.broadcast_to(means, (nsig,) + means.shape).reshape(-1, 2)
+
+	colors = np.zeros((len(sizes), 4))
+	colors[:] = to_rgba(color)
+	colors[:, 3] = np.tile(np.clip(alphas, 0, 1), nsig)
+
+	collection = EllipseCollection(sizes[:, 0], sizes[:, 1], np.zeros(len(sizes)),
+		units="xy", offsets=offsets, offset_transform=ax.transData,
+		facecolors=colors, edgecolors="none")
+	ax.add_collection(collection)
+	return collection
+
+def density(X, *, bins=256, extent=None, ax=None, cmap="Greys"):
+	""" 2D histogram of the points X (N, 2) with a logarithmic color scale """
+	ax = ax or plt.gca()
+	if extent is None:
+		extent = (X[:, 0].min(), X[:, 0].max(), X[:, 1].min(), X[:, 1].max())
+	x0, x1, y0, y1 = extent
+
+	hist, _, _ = np.histogram2d(X[:, 0], X[:, 1], bins=bins, range=[[x0, x1], [y0, y1]])
+	return ax.imshow(np.ma.masked_equal(hist.T, 0), origin="lower", extent=extent,
+		aspect="auto", cmap=cmap, norm=LogNorm(), interpolation="nearest", zorder=1)
+
+def stratified_sample(labels, n_per_component, *, random_state=None):
+	""" indices of at most n_per_component points of every label """
+	rnd = np.random.RandomState(random_state)
+	# a random order, that is (stable) sorted by the labels
+	perm = rnd.permutation(len(labels))
+	order = perm[np.argsort(labels[perm], kind="stable")]
+	_labels = labels[order]
+
+	starts = np.searchsorted(_labels, _labels, side="left")
+	rank = np.arange(len(_labels)) - starts
+	return np.sort(order[rank < n_per_component])
+
+def plot_gmm(gmm, X=None, *, nsig=4, label=True, ax=None,
+	density_bins=None, n_per_component=None, random_state=None):
+	"""
+		density_bins:    if set, the points are shown as a 2D histogram
+		n_per_component: if set, only a stratified subset of the points
+		                 (w.r.t. the predicted components) is scattered
+	"""
 	ax = ax or plt.gca()
 
 	if X is not None:
-		labels = gmm.predict(X)
-		if label:
-			ax.scatter(X[:, 0], X[:, 1], c=labels, s=40, cmap='viridis', zorder=2)
-		else:
-			ax.scatter(X[:, 0], X[:, 1], s=40, zorder=2)
+		if density_bins is not None:
+			density(X, bins=density_bins, ax=ax)
+
+		labels = None
+		if label or n_per_component is not None:
+			labels = gmm.predict(X)
+
+		if n_per_component is not None:
+			idxs = stratified_sample(labels, n_per_component, random_state=random_state)
+			X, labels = X[idxs], labels[idxs]
+
+		if density_bins is None or n_per_component is not None:
+			size = 40 if density_bins is None else 4
+			if label:
+				ax.scatter(X[:, 0], X[:, 1], c=labels, s=size, cmap='viridis', zorder=2)
+			else:
+				ax.scatter(X[:, 0], X[:, 1], s=size, zorder=2)
 		ax.axis('equal')
 
 	w_factor = 0.2 / gmm.weights_.max()
-	_params = zip(gmm.means_, gmm.covariances_, gmm.weights_)
-	for i, (pos, covar, w) in enumerate(_params):
-		ax.scatter(*pos, marker="x", color="black")
-		ax.text(*pos, s=f"Comp #{i}",
-			bbox=dict(facecolor="white", alpha=0.5),
-			horizontalalignment="center",
-			verticalalignment="center",
-		)
-		draw_ellipse(pos, covar, nsig=nsig, ax=ax, alpha=w * w_factor)
+	covariances = _diag_covariances(gmm.covariances_, gmm.covariance_type)
+	covariances = np.broadcast_to(covariances, gmm.means_.shape)
+
+	ax.scatter(gmm.means_[:, 0], gmm.means_[:, 1], marker="x", color="black", zorder=3)
+	if label:
+		for i, pos in enumerate(gmm.means_):
+			ax.text(*pos, s=f"Comp #{i}",
+				bbox=dict(facecolor="white", alpha=0.5),
+				horizontalalignment="center",
+				verticalalignment="center",
+			)
+	ellipse_collection(gmm.means_, covariances, gmm.weights_ * w_factor, nsig=nsig, ax=ax)
 	ax.autoscale_view()
 	return ax
+
+
+class SnapshotRenderer(object):
+	"""
+		Renders snapshots of a mixture during the training without pyplot.
+		The points of every update are accumulated into a 2D histogram
+		with a fixed extent (cheap), the snapshots are rendered into
+		folder/<step>.png by a single figure, that is reused.
+	"""
+
+	def __init__(self, folder, *, dims=(0, 1), bins=128, extent=None, nsig=2,
+		figsize=(6, 6), dpi=100):
+		from matplotlib.backends.backend_agg import FigureCanvasAgg
+		from matplotlib.figure import Figure
+
+		self.folder = folder
+		self.dims = list(dims)
+		self.bins = bins
+		self.extent = extent
+		self.nsig = nsig
+		self.hist = None
+
+		self.fig = Figure(figsize=figsize, dpi=dpi)
+		FigureCanvasAgg(self.fig)
+		self.ax = self.fig.add_subplot(1, 1, 1)
+		self._image = self._ellipses = self._means = None
+
+	def update(self, X):
+		""" adds the points X (N, n_features) to the histogram """
+		X = X[:, self.dims]
+		if self.extent is None:
+			# a margin of 10% around the first points
+			lo, hi = X.min(axis=0), X.max(axis=0)
+			margin = 0.1 * (hi - lo)
+			lo, hi = lo - margin, hi + margin
+			self.extent = (lo[0], hi[0], lo[1], hi[1])
+
+		x0, x1, y0, y1 = self.extent
+		hist, _, _ = np.histogram2d(X[:, 0], X[:, 1], bins=self.bins,
+			range=[[x0, x1], [y0, y1]])
+		self.hist = hist if self.hist is None else self.hist + hist
+
+	def render(self, means, variances, weights, step):
+		"""
+			means, variances: (n_components, n_features)
+			Returns the file name of the snapshot.
+		"""
+		means, variances = means[:, self.dims], variances[:, self.dims]
+		ax = self.ax
+
+		if self.hist is not None:
+			data = np.ma.masked_equal(self.hist.T, 0)
+			if self._image is None:
+				self._image = ax.imshow(data, origin="lower", extent=self.extent,
+					aspect="auto", cmap="Greys", norm=LogNorm(), interpolation="nearest")
+			else:
+				self._image.set_data(data)
+				self._image.autoscale()
+
+		for artist in (self._ellipses, self._means):
+			if artist is not None:
+				artist.remove()
+
+		alphas = 0.2 * weights / max(weights.max(), np.finfo(weights.dtype).tiny)
+		self._ellipses = ellipse_collection(means, variances, alphas, nsig=self.nsig, ax=ax)
+		self._means = ax.scatter(means[:, 0], means[:, 1], marker="x", color="black", s=10)
+
+		if self.extent is not None:
+			ax.set_xlim(*self.extent[:2])
+			ax.set_ylim(*self.extent[2:])
+		ax.set_title(f"Step {step}")
+
+		os.makedirs(self.folder, exist_ok=True)
+		fname = os.path.join(self.folder, f"{step:06d}.png")
+		self.fig.savefig(fname)
+		return fname
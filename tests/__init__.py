@@ -1,3 +1,5 @@
 from tests.fve_tests import FVELayerTest
 from tests.fve_tests import FVELayer_noEMTest
 from tests.gmm_tests import GMMLayerTest
+from tests.grouped_tests import GroupedLayerTest
+from tests.import_tests import ImportTest
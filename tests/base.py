@@ -24,7 +24,11 @@ class BaseFVEncodingTest(abc.ABC, unittest.TestCase):
 		self.n_components = 2
 		self.alpha = 0.9
 
-		self.seed = None
+		self._init_data(seed=None)
+
+	def _init_data(self, seed=None):
+		""" (re-)creates the input and the initial parameters """
+		self.seed = seed
 
 		self.rnd = self.xp.random.RandomState(self.seed)
 
@@ -1,12 +1,25 @@
 import abc
 import chainer
 import numpy as np
+import os
+import pickle
+import tempfile
+
+from chainer import functions as F
+from chainer import gradient_check
 
 from cyvlfeat.fisher import fisher
 from cyvlfeat.gmm import cygmm
 
+from fve_layer.backends.chainer.functions import fisher_normalize
 from fve_layer.backends.chainer.links import FVELayer
 from fve_layer.backends.chainer.links import FVELayer_noEM
+from fve_layer.backends.chainer.links import FVELinear
+from fve_layer.common import encoding
+from fve_layer.common import kernel
+from fve_layer.common import parallel
+from fve_layer.common import precision
+from fve_layer.common import sparse
 from tests.base import BaseFVEncodingTest
 from tests.base import _as_array
 
@@ -26,6 +39,147 @@ class BaseFVELayerTest(BaseFVEncodingTest):
 		self.assertEqual(output.shape, output_shape,
 			"Output shape was not correct!")
 
+	def test_statistics(self):
+		layer = self._new_layer()
+		with chainer.using_config("train", False):
+			ref = layer(self.X).array.reshape(self.n, 2, -1)
+
+		for i, stat in enumerate(["mu", "sig"]):
+			layer = self._new_layer(statistics=stat)
+			self.assertEqual(layer.output_size, self.n_components * self.in_size)
+
+			with chainer.using_config("train", False):
+				output = layer(self.X).array
+
+			self.assertEqual(output.shape, (self.n, layer.output_size),
+				"Output shape was not correct!")
+			self.assertClose(output, ref[:, i],
+				f"{stat}-Part was not equal to the full encoding")
+
+			output = layer.encode_parallel(self.X, n_threads=2)
+			self.assertClose(output, ref[:, i],
+				f"{stat}-Part of the parallel encoding was not equal to the full encoding")
+
+		with self.assertRaises(ValueError):
+			self._new_layer(statistics="pi")
+
+	def test_regions(self):
+		layer = self._new_layer()
+		idxs = [np.arange(self.t), np.arange(self.t // 2), np.arange(self.t // 2, self.t), [1]]
+		regions = np.zeros((len(idxs), self.t), dtype=self.dtype)
+		for i, idx in enumerate(idxs):
+			regions[i, idx] = 1
+
+		with chainer.using_config("train", False):
+			output = layer.encode_regions(self.X, regions)
+			refs = [layer.encode(self.X[:, idx]).array for idx in idxs]
+
+		self.assertEqual(output.shape, (self.n, len(idxs), 2 * self.n_components * self.in_size),
+			"Output shape was not correct!")
+
+		for i, ref in enumerate(refs):
+			self.assertClose(output.array[:, i], ref,
+				f"Encoding of region {i} was not equal to the encoding of the region")
+
+		batch_regions = np.broadcast_to(regions, (self.n,) + regions.shape)
+		with chainer.using_config("train", False):
+			output = layer.encode_regions(self.X, batch_regions, use_mask=True)
+			ref = layer.encode(self.X, use_mask=True)
+
+		self.assertClose(output.array[:, 0], ref.array,
+			"Masked encoding of the full region was not equal to the masked encoding")
+
+		# the sums over the features of a region are accumulated in float32
+		layer = self._new_layer(precision="mixed16")
+		x = self.X.array.astype(np.float16)
+		with chainer.using_config("train", False):
+			output = layer.encode_regions(x, regions)
+			refs = [layer.encode(x[:, idx]).array for idx in idxs]
+
+		self.assertEqual(output.dtype, np.float16)
+		for i, ref in enumerate(refs):
+			self.assertClose(output.array[:, i], ref,
+				f"Mixed precision encoding of region {i} was not equal to the encoding of the region")
+
+	def _normalization_reference(self, fv, power=None, intra=False):
+		""" the same normalization as a sequence of chainer functions """
+		res = F.sign(fv) * F.absolute(fv)**power if power else fv
+		if intra:
+			blocks = F.reshape(res, (self.n, 2, self.n_components, self.in_size))
+			norms = F.sqrt(F.sum(blocks**2, axis=(1, 3), keepdims=True))
+			# components without assigned features have empty blocks
+			norms = F.maximum(norms, self.xp.full(norms.shape, 1e-12, dtype=norms.dtype))
+			res = F.reshape(blocks / F.broadcast_to(norms, blocks.shape), fv.shape)
+		return F.normalize(res, eps=1e-12)
+
+	def test_normalization(self):
+		layer = self._new_layer(power=0.5, intra_norm=True, l2_norm=True)
+
+		with chainer.using_config("train", False):
+			fv = layer.encode(self.X, normalize=False)
+			ref = self._normalization_reference(fv, power=0.5, intra=True)
+			output = layer(self.X)
+
+		self.assertClose(output, ref,
+			"Normalized encoding was not similar to the reference")
+		self.assertClose(np.linalg.norm(output.array, axis=1), 1,
+			"Normalized encoding has no unit length")
+		self.assertClose(layer.encode_parallel(self.X), ref,
+			"Normalized parallel encoding was not similar to the reference")
+
+		shared = layer.share_parameters()
+		self.addCleanup(shared.unlink)
+		output = shared.encode(self.X.array, normalization=layer.normalization)
+		self.assertClose(output, ref,
+			"Normalized worker-side encoding was not similar to the reference")
+
+		# the derivative of the power normalization is unbounded at zero,
+		# hence it is checked numerically on well-conditioned inputs
+		fv = self.rnd.uniform(0.1, 1, size=(3, layer.output_size))
+		fv *= self.rnd.choice([-1, 1], size=fv.shape)
+		gradient_check.check_backward(
+			lambda fv: fisher_normalize(fv, self.in_size, self.n_components,
+				**layer.normalization),
+			fv, self.rnd.randn(*fv.shape), dtype=np.float64, atol=1e-4, rtol=1e-3)
+
+	def test_normalization_gradients(self):
+		layer = self._new_layer(l2_norm=True)
+		x = chainer.Variable(self.X.array.copy())
+
+		with chainer.using_config("train", False), chainer.force_backprop_mode():
+			ref = self._normalization_reference(layer.encode(x, normalize=False))
+			output = layer(x)
+
+		grad = np.linspace(-1, 1, ref.size, dtype=ref.dtype).reshape(ref.shape)
+		ref.grad = grad
+		ref.backward()
+		ref_gx = x.grad.copy()
+
+		x.cleargrad()
+		output.grad = grad
+		output.backward()
+		self.assertClose(x.grad, ref_gx,
+			"Gradient of the normalized encoding was not similar to the reference")
+
+	def test_output_improved(self):
+		layer = self._new_layer(power=0.5, l2_norm=True)
+		mean, var, w = map(_as_array, [layer.mu, layer.sig, layer.w])
+
+		with chainer.using_config("train", False):
+			output = layer(self.X).array
+
+		params = (mean.T.copy(), var.T.copy(), w.copy())
+		ref = np.stack([fisher(_x, *params,
+					normalized=False,
+					square_root=False,
+					improved=True,
+					fast=False,
+					verbose=False,
+			) for _x in self.X.array.astype(np.float32)])
+
+		self.assertClose(output, ref,
+			"Improved output was not similar to reference")
+
 	def test_output(self):
 		layer = self._new_layer()
 
@@ -93,6 +247,375 @@ class BaseFVELayerTest(BaseFVEncodingTest):
 				f"[{i}] Log-likelihood was not similar to reference (vlfeat)")
 
 
+	def test_parallel_encode(self):
+		layer = self._new_layer()
+
+		with chainer.using_config("train", False):
+			ref = layer.encode(self.X).array
+			ref_masked = layer.encode(self.X, use_mask=True).array
+
+		output = layer.encode_parallel(self.X, n_threads=2)
+		self.assertClose(output, ref,
+			"Parallel encoding was not similar to the encoding")
+
+		# split the features of each sample across the threads
+		output = layer.encode_parallel(self.X, n_threads=4, batch_chunk=self.n, t_chunk=1)
+		self.assertClose(output, ref,
+			"Parallel encoding with feature shards was not similar to the encoding")
+
+		output = layer.encode_parallel(self.X, use_mask=True, n_threads=2)
+		self.assertClose(output, ref_masked,
+			"Masked parallel encoding was not similar to the encoding")
+
+		# the cached encoders are bounded and the evicted ones are closed
+		first = parallel.get_encoder(2, t_chunk=-1)
+		first.pool
+		encoders = [parallel.get_encoder(2, t_chunk=-2 - i)
+			for i in range(parallel._MAX_ENCODERS)]
+		self.assertIsNone(first._pool, "Evicted encoder was not closed")
+		self.assertEqual(len(parallel._ENCODERS), parallel._MAX_ENCODERS)
+		self.assertIs(parallel.get_encoder(2, t_chunk=-2), encoders[0])
+
+	def test_sparse_encode(self):
+		# more components, such that some of them are inactive
+		self.n_components = 16
+		self.init_mu = self.rnd.randn(self.in_size, self.n_components).astype(self.dtype) * 3
+		self.init_sig = np.ones((self.in_size, self.n_components), dtype=self.dtype)
+
+		for kwargs in [dict(), dict(power=0.5, intra_norm=True, l2_norm=True)]:
+			layer = self._new_layer(**kwargs)
+
+			# the dense graph-free encoding with the same soft assignment
+			# (the float32 soft assignment of the layer rounds differently
+			# for such distant means, see test_separated_encode)
+			def dense(use_mask):
+				x, params, selected = layer._graph_free_inputs(self.X, use_mask)
+				res = encoding.encode(x, *params, selected)
+				if not layer.normalized:
+					return res
+				return encoding.normalize(res, self.in_size, self.n_components,
+					**layer.normalization)
+
+			ref, ref_masked = dense(False), dense(True)
+
+			output = layer.encode_sparse(self.X)
+			self.assertLess(output.density, 1)
+			self.assertLess(output.nbytes, ref.nbytes)
+			self.assertClose(output.to_dense(), ref,
+				"Sparse encoding was not similar to the encoding")
+			self.assertClose(output.to_csr().toarray(), ref,
+				"CSR matrix was not similar to the encoding")
+
+			self.assertClose(layer.encode_sparse(self.X, use_mask=True).to_dense(), ref_masked,
+				"Masked sparse encoding was not similar to the encoding")
+
+			converted = sparse.BlockSparseFV.from_dense(ref, self.in_size, self.n_components)
+			self.assertEqual(len(converted.components), len(output.components))
+			self.assertClose(converted.to_dense(), ref,
+				"Converted encoding was not similar to the encoding")
+
+			W = self.rnd.randn(5, layer.output_size).astype(self.dtype)
+			b = self.rnd.randn(5).astype(self.dtype)
+			self.assertClose(output.dot(W, b), ref.astype(np.float64) @ W.T + b,
+				"Sparse scores were not similar to the scores of the encoding")
+
+	def test_shifted_encode(self):
+		# a common offset of the features and the means must not change
+		# the graph-free encodings (see encoding.fisher_blocks)
+		shift = 100
+		X = self.X.array + shift
+		layer = self._new_layer(init_mu=self.init_mu + shift)
+
+		with chainer.using_config("train", False):
+			ref = layer.encode(X).array
+
+		self.assertClose(layer.encode_sparse(X).to_dense(), ref,
+			"Sparse encoding of shifted features was not similar to the encoding")
+		self.assertClose(layer.encode_parallel(X, n_threads=2), ref,
+			"Parallel encoding of shifted features was not similar to the encoding")
+
+	def test_separated_encode(self):
+		# components, that are far apart relative to their variances: the
+		# centered raw moments still cancel (see encoding.fisher_blocks)
+		self.n_components = 4
+		mu = (self.rnd.randn(self.in_size, self.n_components) * 200).astype(self.dtype)
+		sig = np.full(mu.shape, 2e-2, dtype=self.dtype)
+		comp = self.rnd.randint(self.n_components, size=(self.n, self.t))
+		X = mu.T[comp] + 0.1 * self.rnd.randn(self.n, self.t, self.in_size).astype(self.dtype)
+		layer = self._new_layer(init_mu=mu, init_sig=sig)
+
+		params = [_as_array(p).astype(np.float64) for p in (layer.mu, layer.sig, layer.w)]
+		ref = encoding.encode(X.astype(np.float64), *params)
+		with chainer.using_config("train", False):
+			self.assertClose(layer.encode(X).array, ref,
+				"Encoding of separated components was not correct")
+
+		output = encoding.encode(X, *[_as_array(p) for p in (layer.mu, layer.sig, layer.w)])
+		self.assertEqual(output.dtype, X.dtype)
+		self.assertClose(output, ref,
+			"Graph-free encoding of separated components was not correct")
+		self.assertClose(layer.encode_parallel(X, n_threads=2, t_chunk=1), ref,
+			"Parallel encoding of separated components was not correct")
+		self.assertClose(layer.encode_sparse(X).to_dense(), ref,
+			"Sparse encoding of separated components was not correct")
+
+	def test_gram_matrix(self):
+		layer = self._new_layer()
+		X = self.rnd.randn(10, self.t, self.in_size).astype(self.dtype)
+		Y = self.rnd.randn(7, self.t, self.in_size).astype(self.dtype)
+
+		with chainer.using_config("train", False):
+			enc_X, enc_Y = layer.encode(X).array, layer.encode(Y).array
+
+		with tempfile.TemporaryDirectory() as folder:
+			gram = layer.gram_matrix(X, out=os.path.join(folder, "gram.npy"), block_size=3)
+			self.assertIsInstance(gram, np.memmap)
+			self.assertClose(gram, enc_X @ enc_X.T,
+				"Blocked Gram matrix was not similar to the reference")
+			del gram
+
+		gram = layer.gram_matrix(X, Y, block_size=4, cache_size=2)
+		self.assertEqual(gram.shape, (len(X), len(Y)))
+		self.assertClose(gram, enc_X @ enc_Y.T,
+			"Blocked Gram matrix between X and Y was not similar to the reference")
+
+		# every block is encoded once, if all blocks fit into the cache
+		encoded = []
+		def encode(x):
+			encoded.append(len(x))
+			return layer.encode_parallel(x)
+
+		gram = kernel.gram_matrix(encode, X, block_size=3, cache_size=4)
+		self.assertEqual(sum(encoded), len(X))
+		self.assertClose(gram, enc_X @ enc_X.T,
+			"Blocked Gram matrix was not similar to the reference")
+
+	def test_cached_encode(self):
+		entry_nbytes = self.n_components * self.in_size * 2 * np.dtype(self.dtype).itemsize
+		layer = self._new_layer(cache_kwargs=dict(max_bytes=6 * entry_nbytes))
+		ids = np.arange(self.n)
+
+		with chainer.using_config("train", False):
+			ref = layer.encode(self.X).array
+			res = layer(self.X, ids=ids)
+			self.assertIsNone(res.creator, "Cached encoding should be a constant")
+			self.assertClose(res, ref, "Cached encoding was not correct")
+			self.assertEqual(len(layer.cache), 6)
+
+			# the features of the misses are requested by their ids
+			requested = []
+			def features(_ids):
+				requested.extend(_ids)
+				return self.X[np.array(_ids)]
+
+			res = layer.encode_cached(ids[-4:], features)
+			self.assertEqual(requested, [], "Cached entries were encoded again")
+			self.assertClose(res, ref[-4:], "Cached encoding was not correct")
+
+			# the two least-recently-used entries were evicted
+			res = layer.encode_cached(ids, features)
+			self.assertEqual(requested, [0, 1])
+			self.assertClose(res, ref, "Encoding after the eviction was not correct")
+
+			# other mask settings are other entries
+			res = layer.encode_cached(ids[:2], self.X[:2], use_mask=True)
+			self.assertClose(res, layer.encode(self.X[:2], use_mask=True),
+				"Cached encoding with the mask was not correct")
+
+			# the cache is invalidated, if the parameters change
+			mu = _as_array(layer.mu) + 1
+			if hasattr(layer, "set_params"):
+				layer.set_params(mu=mu)
+			else:
+				layer.mu.array[:] = mu
+			res = layer.encode_cached(ids[:2], self.X[:2])
+			self.assertEqual(len(layer.cache), 2)
+			self.assertClose(res, layer.encode(self.X[:2]),
+				"Cache was not invalidated")
+
+		layer.cache.close()
+
+	def test_quantization(self):
+		layer = self._new_layer(power=0.5, l2_norm=True)
+		X = self.rnd.randn(64, self.t, self.in_size).astype(self.dtype)
+		database = layer.encode_parallel(X)
+		queries = database[:5] + 1e-2 * self.rnd.randn(5, layer.output_size).astype(self.dtype)
+
+		pq = layer.new_quantizer(n_subvectors=4, n_centroids=8, max_iter=2, random_state=0)
+		codes = pq.fit(database).encode(database)
+
+		self.assertEqual(codes.shape, (len(database), self.n_components * 4))
+		self.assertEqual(codes.dtype, np.uint8)
+		self.assertLess(pq.code_nbytes, database[0].nbytes)
+
+		decoded = pq.decode(codes)
+		self.assertEqual(decoded.shape, database.shape)
+		self.assertLess(np.linalg.norm(decoded - database), np.linalg.norm(database),
+			"Quantization error should be smaller than the encodings")
+
+		# asymmetric distances are the distances to the reconstructed encodings
+		dist = pq.distances(queries, codes)
+		ref_dist = ((queries[:, None] - decoded[None])**2).sum(axis=-1)
+		self.assertClose(dist, ref_dist,
+			"Asymmetric distances were not similar to the reference")
+
+		top_dist, top_idxs = pq.search(queries, codes, k=3)
+		self.assertEqual(top_idxs.shape, (len(queries), 3))
+		self.assertTrue((np.diff(top_dist, axis=1) >= 0).all())
+		self.assertClose(top_dist, np.sort(ref_dist, axis=1)[:, :3],
+			"Search results were not the nearest codes")
+
+	def test_shared_encode(self):
+		layer = self._new_layer()
+		shared = layer.share_parameters()
+		self.addCleanup(shared.unlink)
+
+		with chainer.using_config("train", False):
+			ref = layer.encode(self.X).array
+			ref_masked = layer.encode(self.X, use_mask=True).array
+
+		# this is what happens, when the parameters are passed to a worker
+		worker_params = pickle.loads(pickle.dumps(shared))
+		self.addCleanup(worker_params.close)
+		self.assertEqual(worker_params.version, shared.version)
+
+		x = self.X.array
+		self.assertClose(worker_params.encode(x), ref,
+			"Worker-side encoding was not similar to the encoding")
+
+		self.assertClose(worker_params.encode(x[0]), ref[0],
+			"Worker-side encoding of a single sample was not similar to the encoding")
+
+		self.assertClose(worker_params.encode(x, use_mask=True), ref_masked,
+			"Masked worker-side encoding was not similar to the encoding")
+
+	def test_mixed_precision(self):
+		self._init_data(seed=0)
+		ref_layer = self._new_layer()
+		layer = self._new_layer(precision="mixed16")
+		x = self.X.array.astype(np.float16)
+
+		with chainer.using_config("train", False):
+			ref_gamma = ref_layer.soft_assignment(self.X).array
+			ref = ref_layer(self.X).array
+
+			gamma = layer.soft_assignment(x)
+			output = layer(x)
+
+		self.assertEqual(gamma.dtype, np.float32,
+			"Soft assignment should be computed in float32!")
+		self.assertEqual(output.dtype, np.float16,
+			"Output should be stored in float16!")
+
+		gamma_bound, bound = precision.mixed16_error_bound(self.X.array,
+			*[_as_array(p) for p in (ref_layer.mu, ref_layer.sig, ref_layer.w)], ref_gamma)
+		self.assertTrue((np.abs(gamma.array - ref_gamma) <= gamma_bound).all(),
+			"Mixed precision soft assignment differs from the float32 results")
+		self.assertTrue((np.abs(output.array - ref) <= bound).all(),
+			"Mixed precision encoding differs from the float32 results")
+
+		with chainer.using_config("train", True), chainer.force_backprop_mode():
+			x = chainer.Variable(x)
+			output = layer(x)
+			output.grad = layer.xp.ones_like(output.array)
+			output.backward()
+
+		self.assertEqual(x.grad.dtype, np.float16)
+		self.assertTrue(np.isfinite(x.grad).all())
+
+		for param in (layer.mu, layer.sig, layer.w):
+			self.assertEqual(_as_array(param).dtype, np.float32,
+				"Parameters should stay in float32!")
+
+	def test_fused_linear(self):
+		# both paths round the gradients (sums over all features,
+		# components and classes) differently in float32, hence the
+		# data is fixed
+		self._init_data(seed=1)
+		n_classes = 5
+		layer = self._new_layer()
+		initialW = self.rnd.randn(n_classes, layer.output_size).astype(self.dtype)
+		model = FVELinear(layer, n_classes, fused=False,
+			initialW=initialW / np.sqrt(layer.output_size))
+
+		def run(fused, X=self.X.array, **kwargs):
+			model.fused = fused
+			model.cleargrads()
+			x = chainer.Variable(X.copy())
+
+			with chainer.using_config("train", False), chainer.force_backprop_mode():
+				y = model(x, **kwargs)
+				y.grad = np.linspace(-1, 1, y.size, dtype=y.dtype).reshape(y.shape)
+				y.backward()
+
+			grads = {name: _as_array(param.grad).copy()
+				for name, param in model.namedparams()}
+			return y.array, x.grad, grads
+
+		for kwargs in [dict(), dict(use_mask=True)]:
+			ref, ref_gx, ref_grads = run(False, **kwargs)
+			output, gx, grads = run(True, **kwargs)
+
+			self.assertEqual(output.shape, (self.n, n_classes))
+			self.assertClose(output, ref,
+				"Fused logits were not similar to the logits of the encoding")
+			self.assertClose(gx, ref_gx,
+				"Fused input gradients were not similar to the reference")
+
+			self.assertEqual(grads.keys(), ref_grads.keys())
+			for name, grad in grads.items():
+				self.assertClose(grad, ref_grads[name],
+					f"Fused gradient of {name} was not similar to the reference")
+
+		# a common offset of the features and the means must not matter
+		shift = 100
+		model = FVELinear(self._new_layer(init_mu=self.init_mu + shift), n_classes,
+			fused=False, initialW=model.fc.W.array)
+		ref, ref_gx, _ = run(False, self.X.array + shift)
+		output, gx, _ = run(True, self.X.array + shift)
+		self.assertClose(output, ref,
+			"Fused logits of shifted features were not similar to the logits of the encoding")
+		self.assertClose(gx, ref_gx,
+			"Fused input gradients of shifted features were not similar to the reference")
+
+		# components, that are far apart relative to their variances
+		mu = (self.rnd.randn(self.in_size, self.n_components) * 200).astype(self.dtype)
+		sig = np.full(mu.shape, 2e-2, dtype=self.dtype)
+		comp = self.rnd.randint(self.n_components, size=(self.n, self.t))
+		X = mu.T[comp] + 0.1 * self.rnd.randn(self.n, self.t, self.in_size).astype(self.dtype)
+		model = FVELinear(self._new_layer(init_mu=mu, init_sig=sig), n_classes,
+			fused=False, initialW=model.fc.W.array)
+		ref, ref_gx, _ = run(False, X)
+		output, gx, _ = run(True, X)
+		self.assertClose(output, ref,
+			"Fused logits of separated components were not similar to the logits of the encoding")
+		self.assertClose(gx, ref_gx,
+			"Fused input gradients of separated components were not similar to the reference")
+
+	def test_covariance_types(self):
+		sigs = dict(
+			spherical=self.init_sig.mean(axis=0, keepdims=True),
+			tied_diag=self.init_sig.mean(axis=1, keepdims=True),
+		)
+		for covariance_type, init_sig in sigs.items():
+			layer = self._new_layer(init_sig=init_sig, covariance_type=covariance_type)
+			full_sig = np.broadcast_to(init_sig, self.init_sig.shape)
+			ref_layer = self._new_layer(init_sig=np.array(full_sig))
+
+			with chainer.using_config("train", False):
+				output = layer(self.X)
+				ref = ref_layer(self.X)
+
+			self.assertEqual(output.shape, ref.shape,
+				f"{covariance_type}: Output shape was not correct!")
+			self.assertClose(output, ref,
+				f"{covariance_type}: Encoding was not equal to the encoding with diagonal covariances")
+
+			self.assertClose(layer.encode_parallel(self.X), ref,
+				f"{covariance_type}: Parallel encoding was not correct")
+			self.assertClose(layer.encode_sparse(self.X).to_dense(), ref,
+				f"{covariance_type}: Sparse encoding was not correct")
+
 	def test_gap_init(self):
 		self.n_components = 1
 		layer = self._new_layer(init_mu=0, init_sig=1)
@@ -117,6 +640,78 @@ class FVELayerTest(BaseFVELayerTest):
 	def _new_layer(self, *args, **kwargs):
 		return super(FVELayerTest, self)._new_layer(layer_cls=FVELayer, *args, **kwargs)
 
+	def test_shared_refresh(self):
+		layer = self._new_layer()
+		shared = layer.share_parameters()
+		self.addCleanup(shared.unlink)
+		worker_params = pickle.loads(pickle.dumps(shared))
+		self.addCleanup(worker_params.close)
+
+		version = worker_params.version
+		with chainer.using_config("train", True):
+			layer(self.X)
+
+		self.assertGreater(worker_params.version, version,
+			"Parameter update was not published!")
+
+		(mu, sig, w), version = worker_params.copy()
+		self.assertEqual(version, worker_params.version)
+		for param, ref in zip([mu, sig, w], [layer.mu, layer.sig, layer.w]):
+			self.assertClose(param, ref,
+				"Shared parameters were not similar to the updated parameters")
+
+	def test_pruned_encode(self):
+		self.n_components = 3
+		self.init_mu = self.rnd.randn(self.in_size, self.n_components).astype(self.dtype)
+		self.init_mu[:, 2] += 50
+		layer = self._new_layer(init_sig=1, prune_eps=1e-3)
+		layer.sk_gmm = layer.as_sklearn_gmm(**layer.sk_learn_kwargs)
+		with chainer.using_config("train", True):
+			layer(self.X)
+		self.assertFalse(layer.active[2], "Component was not pruned")
+
+		with chainer.using_config("train", False):
+			output = layer(self.X).array
+
+		self.assertEqual(output.shape, (self.n, layer.output_size))
+		blocks = output.reshape(self.n, 2, self.n_components, self.in_size)
+		self.assertTrue(np.all(blocks[:, :, 2] == 0),
+			"Pruned component should result in zero blocks")
+
+		sig = np.broadcast_to(layer.sig, layer.mu.shape)
+		ref = encoding.encode(self.X.array, layer.mu, sig, layer.w)
+		self.assertClose(output, ref,
+			"Encoding was not equal to the encoding of all components")
+
+		self.assertClose(layer.encode_parallel(self.X), ref,
+			"Parallel encoding was not correct")
+		self.assertClose(layer.encode_sparse(self.X).to_dense(), ref,
+			"Sparse encoding was not correct")
+
+		W = self.rnd.randn(3, layer.output_size).astype(self.dtype)
+		with chainer.using_config("train", False):
+			logits = layer.encode_linear(self.X, W).array
+		self.assertClose(logits / np.abs(ref @ W.T).max(), ref @ W.T / np.abs(ref @ W.T).max(),
+			"Fused linear scores were not correct")
+
+	def test_whitening(self):
+		pca_size = 16
+		layer = self._new_layer(pca_size=pca_size, whitening_interval=1,
+			init_mu=0, init_sig=1)
+		self.assertEqual(layer.output_size, 2 * self.n_components * pca_size)
+
+		for train in [True, True, False]:
+			with chainer.using_config("train", train):
+				output = layer(self.X)
+
+			self.assertEqual(output.shape, (self.n, layer.output_size))
+			self.assertTrue(np.isfinite(output.array).all())
+
+		with chainer.using_config("train", False):
+			ref = layer.encode(layer.whiten(self.X))
+		self.assertClose(output, ref,
+			"Encoding of the whitened features was not similar to the output")
+
 class FVELayer_noEMTest(BaseFVELayerTest):
 
 	def _new_layer(self, *args, **kwargs):
@@ -145,3 +740,60 @@ class FVELayer_noEMTest(BaseFVELayerTest):
 
 		for param in layer.params():
 			self.assertIsNotNone(param.grad)
+
+	def test_recompute(self):
+		layer = self._new_layer(l2_norm=True)
+
+		def run(**kwargs):
+			layer.cleargrads()
+			x = chainer.Variable(self.X.array.copy())
+
+			with chainer.using_config("train", True):
+				y = layer(x, use_mask=True)
+				y.grad = np.linspace(-1, 1, y.size, dtype=y.dtype).reshape(y.shape)
+				y.backward()
+
+			grads = {name: _as_array(param.grad).copy()
+				for name, param in layer.namedparams()}
+			return y.array, x.grad, grads
+
+		ref, ref_gx, ref_grads = run()
+		# chunks of different sizes (the last one is smaller)
+		for chunk in [None, 3]:
+			layer.recompute, layer.recompute_chunk = True, chunk
+			output, gx, grads = run()
+
+			self.assertClose(output, ref,
+				f"Recomputed encoding was not correct (chunk={chunk})")
+			self.assertClose(gx, ref_gx,
+				f"Recomputed input gradients were not correct (chunk={chunk})")
+			for name, grad in grads.items():
+				self.assertClose(grad, ref_grads[name],
+					f"Recomputed gradient of {name} was not correct (chunk={chunk})")
+
+	def test_shared_refresh(self):
+		layer = self._new_layer()
+		shared = layer.share_parameters()
+		self.addCleanup(shared.unlink)
+		worker_params = pickle.loads(pickle.dumps(shared))
+		self.addCleanup(worker_params.close)
+
+		optimizer = chainer.optimizers.SGD(lr=0.1)
+		optimizer.setup(layer)
+
+		with chainer.using_config("train", True):
+			layer.cleargrads()
+			F.sum(layer(self.X)**2).backward()
+			optimizer.update()
+
+			version = worker_params.version
+			# the next iteration publishes the updated parameters
+			layer(self.X)
+
+		self.assertGreater(worker_params.version, version,
+			"Parameter update was not published!")
+
+		(mu, sig, w), _ = worker_params.copy()
+		for param, ref in zip([mu, sig, w], [layer.mu, layer.sig, layer.w]):
+			self.assertClose(param, ref.array,
+				"Shared parameters were not similar to the updated parameters")
@@ -1,9 +1,16 @@
 import chainer
 import numpy as np
+import os
+import sys
+import tempfile
+import threading
+import time
 
+from chainer import functions as F
 from scipy.stats import multivariate_normal as mvn
 
 from fve_layer.backends.chainer.links import GMMLayer
+from fve_layer.common import autotune
 from fve_layer.common.mixtures import BayesianGMM
 from tests.base import BaseFVEncodingTest
 from tests.base import _as_array
@@ -62,6 +69,36 @@ class GMMLayerTest(BaseFVEncodingTest):
 		self.assertClose(res0, res1,
 			"sklearn results in a different result!")
 
+	def test_whitening(self):
+		pca_size = 16
+		layer = self._new_layer(pca_size=pca_size, whitening_interval=2,
+			init_mu=0, init_sig=1)
+		self.assertEqual(layer.mu.shape, (pca_size, self.n_components))
+
+		# correlated features (with pca_size dominant directions) and a non-zero mean
+		A = self.rnd.randn(pca_size, self.in_size).astype(self.dtype)
+		def sample(n):
+			x = self.rnd.randn(n, 64, pca_size).astype(self.dtype) @ A
+			noise = self.rnd.randn(n, 64, self.in_size).astype(self.dtype)
+			return x + 0.1 * noise + 2
+
+		for i in range(5):
+			with chainer.using_config("train", True):
+				z = layer(sample(self.n))
+			self.assertEqual(z.shape, (self.n, 64, pca_size))
+
+		self.assertEqual(layer.pca_t, 6)
+		self.assertTrue(np.isfinite(layer.mu).all() and (layer.sig > 0).all(),
+			"Mixture parameters were not valid after the refresh of the whitening")
+
+		with chainer.using_config("train", False):
+			z = layer(sample(64)).array.reshape(-1, pca_size)
+
+		self.assertTrue(np.allclose(z.mean(axis=0), 0, atol=0.2),
+			"Whitened features were not centered")
+		self.assertTrue(np.allclose(np.cov(z.T), np.eye(pca_size), atol=0.2),
+			"Whitened features were not decorrelated")
+
 	def test_gpu(self):
 		layer = self._new_layer()
 		device = chainer.backends.cuda.get_device_from_id(0)
@@ -95,6 +132,8 @@ class GMMLayerTest(BaseFVEncodingTest):
 		params0 = [np.copy(p) for p in params]
 		with chainer.using_config("train", True):
 			y0 = layer(self.X)
+		# the parameters are updated copy-on-write
+		params = (layer.mu, layer.sig, layer.w)
 		params1 = [np.copy(p) for p in params]
 
 		for p0, p1 in zip(params0, params1):
@@ -169,3 +208,513 @@ class GMMLayerTest(BaseFVEncodingTest):
 
 				self.assertClose(p1, p2,
 					f"{[n,t,component]}: Likelihood was not the same")
+
+	def test_covariance_types(self):
+		sigs = dict(
+			spherical=self.init_sig.mean(axis=0, keepdims=True),
+			tied_diag=self.init_sig.mean(axis=1, keepdims=True),
+		)
+		x = self.X.array.reshape(-1, self.in_size)
+
+		for covariance_type, init_sig in sigs.items():
+			layer = self._new_layer(init_sig=init_sig, covariance_type=covariance_type)
+			self.assertEqual(layer.sig.shape, init_sig.shape)
+
+			var = np.broadcast_to(layer.sig, (self.in_size, self.n_components)).T
+			log_ref = np.stack([mvn.logpdf(x, mean, cov)
+				for mean, cov in zip(layer.mu.T, var)], axis=-1).astype(self.dtype)
+
+			for kwargs in [dict(), dict(use_matmul=False), dict(use_sk_learn=True)]:
+				log_ps, _ = layer.log_proba(self.X, **kwargs)
+				self.assertClose(log_ps.array.reshape(log_ref.shape), log_ref,
+					f"{covariance_type} ({kwargs}): Log-Likelihood was not the same")
+
+			gmm = layer.as_sklearn_gmm()
+			_, log_resp = gmm._e_step(x)
+			log_gamma = layer.log_soft_assignment(self.X)
+			self.assertClose(log_gamma.array.reshape(log_resp.shape), log_resp,
+				f"{covariance_type}: Log soft assignment was not the same as of the mixture")
+
+			with chainer.using_config("train", True):
+				layer(self.X)
+			self.assertEqual(layer.sig.shape, init_sig.shape,
+				f"{covariance_type}: Shape of the variances changed after the update")
+
+		with self.assertRaises(ValueError):
+			self._new_layer(covariance_type="full")
+
+	def test_covariance_m_step(self):
+		x = self.X.array.reshape(-1, self.in_size).astype(np.float64)
+
+		for covariance_type in ["spherical", "tied_diag"]:
+			layer = self._new_layer(covariance_type=covariance_type,
+				init_sig=1)
+			gmm = layer.as_sklearn_gmm(reg_covar=1e-6)
+			_, log_resp = gmm._e_step(x)
+			nk, means, cov = gmm._gaussian_params(x, log_resp, xp=np)
+
+			resp = np.exp(log_resp)
+			diag = np.stack([resp[:, k] @ (x - means[k])**2 / nk[k]
+				for k in range(self.n_components)])
+
+			if covariance_type == "spherical":
+				ref = diag.mean(axis=1)
+			else:
+				ref = np.broadcast_to(nk @ diag / nk.sum(), diag.shape)
+
+			self.assertClose(cov, ref,
+				f"{covariance_type}: M-step estimated wrong covariances")
+
+		# the shared diagonal is fitted directly, also by the initialization
+		layer = self._new_layer(covariance_type="tied_diag", init_sig=1)
+		gmm = layer.new_gmm(max_iter=1, random_state=0)
+		self.assertEqual(gmm.covariance_type, "diag")
+		for max_iter in [0, 1]:
+			gmm.max_iter = max_iter
+			gmm.fit(x)
+			self.assertEqual(gmm.covariances_.shape, (self.n_components, self.in_size))
+			self.assertTrue((gmm.covariances_ == gmm.covariances_[0]).all(),
+				f"Variances were not shared (max_iter={max_iter})")
+			del gmm.means_, gmm.covariances_, gmm.weights_
+
+	def _pruned_layer(self, **kwargs):
+		""" layer with a third component far away from the data """
+		self.n_components = 3
+		init_mu = self.rnd.randn(self.in_size, self.n_components).astype(self.dtype)
+		init_mu[:, 2] += 50
+		layer = self._new_layer(init_mu=init_mu, init_sig=1, prune_eps=1e-3, **kwargs)
+		# start the EM steps from the parameters of the layer
+		layer.sk_gmm = layer.as_sklearn_gmm(**layer.sk_learn_kwargs)
+
+		with chainer.using_config("train", True):
+			layer(self.X)
+		return layer
+
+	def test_pruning(self):
+		layer = self._pruned_layer()
+
+		self.assertEqual(layer.active.tolist(), [True, True, False])
+		self.assertEqual(layer.n_active, 2)
+		self.assertEqual(layer.w[2], 0)
+		self.assertClose(layer.w.sum(), 1, "Weights were not normalized")
+
+		active = layer.param_snapshot().active
+		self.assertEqual(active.mu.shape, (self.in_size, 2))
+		self.assertTrue(active.mu.flags.c_contiguous)
+
+		log_gamma = layer.log_soft_assignment(self.X).array
+		self.assertEqual(log_gamma.shape, (self.n, self.t, self.n_components))
+		self.assertTrue(np.isneginf(log_gamma[..., 2]).all(),
+			"Pruned component should not be assigned")
+		self.assertClose(np.exp(log_gamma).sum(axis=-1), 1,
+			"Soft assignment was not normalized")
+
+		log_ps, _ = layer.log_proba(self.X)
+		self.assertTrue(np.isneginf(log_ps.array[..., 2]).all())
+
+		with chainer.using_config("train", True):
+			layer(self.X)
+		self.assertEqual(layer.active.tolist(), [True, True, False],
+			"Pruned component should stay pruned without respawning")
+
+	def test_respawn(self):
+		layer = self._pruned_layer(respawn_interval=1)
+
+		self.assertTrue(layer.active.all(),
+			"Pruned component was not respawned")
+		self.assertIsNone(layer.param_snapshot().active)
+		self.assertClose(layer.w.sum(), 1, "Weights were not normalized")
+
+		# the respawned component is a split of another one
+		heavy = [k for k in range(2) if layer.w[k] == layer.w[2]]
+		self.assertTrue(heavy, "Respawned component does not share the weight")
+		self.assertTrue(np.all(layer.sig[:, 2] == layer.sig[:, heavy[0]]))
+
+		with chainer.using_config("train", True):
+			layer(self.X)
+		self.assertEqual(layer.sk_gmm.n_components, self.n_components)
+
+	def test_component_index(self):
+		self.n_components = 16
+		init_mu = self.rnd.randn(self.in_size, self.n_components).astype(self.dtype) * 4
+		comps = self.rnd.randint(self.n_components, size=(self.n, self.t))
+		X = init_mu.T[comps] + self.rnd.randn(self.n, self.t, self.in_size).astype(self.dtype)
+		X = chainer.Variable(X)
+
+		layer = self._new_layer(init_mu=init_mu, init_sig=1,
+			index_kwargs=dict(n_cells=4, n_probe=1, random_state=0))
+		ref = layer.log_soft_assignment(X, use_index=False).array
+		with chainer.no_backprop_mode():
+			log_gamma = layer.log_soft_assignment(X).array
+
+		self.assertEqual(log_gamma.shape, ref.shape)
+		self.assertClose(np.exp(log_gamma).sum(axis=-1), 1,
+			"Soft assignment was not normalized")
+		self.assertTrue((log_gamma.argmax(axis=-1) == ref.argmax(axis=-1)).all(),
+			"Nearest components differ")
+
+		# features, that are not close to a single cell, are assigned exactly
+		index = layer.component_index()
+		index.fallback_ratio = np.inf
+		with chainer.no_backprop_mode():
+			self.assertClose(layer.log_soft_assignment(X).array, ref,
+				"Exact fallback differs from the full soft assignment")
+		index.fallback_ratio = None
+
+		# the index is not differentiable, hence the exact soft assignment
+		# is used, if a gradient is required
+		log_gamma = layer.log_soft_assignment(X)
+		self.assertClose(log_gamma, ref,
+			"Soft assignment with a gradient differs from the full soft assignment")
+		F.sum(log_gamma).backward()
+		self.assertIsNotNone(X.grad, "Gradient was not propagated to the input")
+
+		with self.assertWarns(UserWarning):
+			layer.log_soft_assignment(X, use_index=True)
+
+		# the index is rebuilt after the parameters have changed
+		self.assertIs(layer.component_index(), index)
+		with chainer.using_config("train", True):
+			layer(X)
+		self.assertIsNot(layer.component_index(), index)
+		self.assertClose(layer.component_index().params.mu, layer.mu,
+			"Index was not built from the updated parameters")
+
+	def _train(self, layer, n_iterations):
+		""" runs the training iterations and returns the sizes of the EM updates """
+		sizes = []
+		get_new_params = layer.get_new_params
+		def _get_new_params(x):
+			sizes.append(len(x))
+			return get_new_params(x)
+		layer.get_new_params = _get_new_params
+
+		with chainer.using_config("train", True):
+			for _ in range(n_iterations):
+				layer(self.X)
+		return sizes
+
+	def test_update_schedule(self):
+		layer = self._new_layer(update_interval=3)
+		self.assertEqual(len(self._train(layer, 7)), 3)
+		self.assertEqual(layer.t, 4)
+
+		# the interval is doubled after every (small) change
+		layer = self._new_layer(decay_threshold=np.inf, max_update_interval=4)
+		self._train(layer, 10)
+		self.assertEqual(layer.t, 4, "Updates should be at the iterations 1, 3 and 7")
+		self.assertEqual((layer.interval, layer.next_update), (4, 11))
+
+		layer = self._new_layer(decay_threshold=0)
+		self._train(layer, 3)
+		self.assertEqual(layer.t, 4, "Interval should be reset after large changes")
+		self.assertTrue(np.isfinite(layer.last_change))
+
+		# the schedule is restored with the other persistents
+		with tempfile.TemporaryDirectory() as folder:
+			path = os.path.join(folder, "layer.npz")
+			layer = self._new_layer(decay_threshold=np.inf)
+			self._train(layer, 4)
+			chainer.serializers.save_npz(path, layer)
+			loaded = self._new_layer(decay_threshold=np.inf)
+			chainer.serializers.load_npz(path, loaded)
+
+		for name in ["t", "iteration", "interval", "next_update", "last_change"]:
+			self.assertEqual(getattr(loaded, name), getattr(layer, name),
+				f"Schedule state \"{name}\" was not restored")
+
+	def test_update_subsampling(self):
+		n_feats = self.n * self.t
+		for subsampling in ["uniform", "norm"]:
+			layer = self._new_layer(max_update_features=n_feats // 4,
+				subsampling=subsampling, subsampling_seed=0)
+			self.assertEqual(self._train(layer, 2), [n_feats // 4] * 2)
+
+		# the features with the larger norm are preferred
+		layer = self._new_layer(max_update_features=2, subsampling="norm", subsampling_seed=0)
+		x = np.ones((20, self.in_size), dtype=self.dtype)
+		x[:2] *= 100
+		counts = np.zeros(2)
+		for _ in range(20):
+			selected = layer.subsample(x)
+			counts += [(selected[:, 0] == 100).sum(), (selected[:, 0] == 1).sum()]
+		self.assertGreater(counts[0], counts[1])
+
+		with self.assertRaises(AssertionError):
+			self._new_layer(subsampling="random")
+
+	def test_checkpoint(self):
+		sigs = dict(
+			diag=self.init_sig,
+			spherical=self.init_sig.mean(axis=0, keepdims=True),
+			tied_diag=self.init_sig.mean(axis=1, keepdims=True),
+		)
+		for covariance_type, init_sig in sigs.items():
+			self._check_checkpoint(covariance_type, init_sig)
+
+	def _check_checkpoint(self, covariance_type, init_sig):
+		kwargs = dict(max_update_features=self.n * self.t // 2, subsampling_seed=0,
+			decay_threshold=np.inf, covariance_type=covariance_type, init_sig=init_sig)
+		layer = self._new_layer(**kwargs)
+		self._train(layer, 3)
+
+		with tempfile.TemporaryDirectory() as folder:
+			layer.save_state(folder)
+			loaded = self._new_layer(**kwargs).load_state(folder)
+
+			self.assertIsInstance(loaded.mu, np.memmap, "Parameters were not memory-mapped")
+			for name in ["mu", "sig", "w", "t", "iteration", "interval", "next_update"]:
+				self.assertTrue(np.all(getattr(loaded, name) == getattr(layer, name)),
+					f"{covariance_type}: \"{name}\" was not restored")
+
+			self.assertIsInstance(loaded.sk_gmm, type(layer.sk_gmm))
+			self.assertTrue(np.all(loaded.sk_gmm.means_ == layer.sk_gmm.means_))
+			self.assertEqual(loaded.sk_gmm.tied_diag, covariance_type == "tied_diag",
+				f"{covariance_type}: shared diagonal of the mixture was not restored")
+
+			# the training is resumed with the same state
+			for _layer in [layer, loaded]:
+				self._train(_layer, 4)
+			for name in ["mu", "sig", "w"]:
+				self.assertClose(getattr(loaded, name), getattr(layer, name),
+					f"{covariance_type}: Resumed training differs in \"{name}\"")
+
+			other = GMMLayer(self.in_size, self.n_components + 1)
+			with self.assertRaises(ValueError):
+				other.load_state(folder)
+
+			manifest = os.path.join(folder, "manifest.json")
+			with open(manifest) as f:
+				content = f.read()
+			with open(manifest, "w") as f:
+				f.write(content.replace('"version": 1', '"version": 1000'))
+			with self.assertRaises(ValueError):
+				self._new_layer(**kwargs).load_state(folder)
+
+	def test_sampling(self):
+		layer = self._new_layer()
+		n_samples = 20000
+		X, y = layer.sample(n_samples, random_state=0)
+
+		self.assertEqual(X.shape, (n_samples, self.in_size))
+		self.assertEqual(X.dtype, layer.mu.dtype)
+		self.assertTrue(np.all(np.diff(y) >= 0), "Samples should be ordered by their component")
+
+		for k in range(self.n_components):
+			_X = X[y == k]
+			self.assertTrue(np.allclose(_X.mean(axis=0), layer.mu[:, k], atol=0.1),
+				f"Mean of the samples of component {k} was not correct")
+			self.assertTrue(np.allclose(_X.var(axis=0), layer.sig[:, k], rtol=0.1, atol=0.1),
+				f"Variance of the samples of component {k} was not correct")
+
+		# seeded, chunked and into a preallocated array
+		out = np.empty_like(X)
+		X1, y1 = layer.sample(n_samples, random_state=0, chunk_size=999, out=out)
+		self.assertIs(X1, out)
+		self.assertTrue(np.all(X1 == X) and np.all(y1 == y),
+			"Chunked samples differ from the samples at once")
+
+		gmm = layer.as_sklearn_gmm()
+		X2, y2 = gmm.sample(n_samples, random_state=0)
+		self.assertTrue(np.all(y2 == y))
+		self.assertClose(X2, X, "Samples of the mixture differ from the ones of the layer")
+
+	def test_scoring(self):
+		layer = self._new_layer()
+		ref_ll, _ = layer.log_proba(self.X, weighted=True)
+		ref_ll = ref_ll.array.ravel()
+		ref_dist = layer.mahalanobis_dist(self.X).array.reshape(-1, self.n_components)
+		x = self.X.array.reshape(-1, self.in_size)
+
+		with tempfile.TemporaryDirectory() as folder:
+			X = np.memmap(os.path.join(folder, "feats.npy"), mode="w+",
+				dtype=x.dtype, shape=x.shape)
+			X[:] = x
+			scores = layer.score(X, top_k=5, chunk_size=7, n_threads=2)
+			del X
+
+		self.assertClose(scores.log_likelihood, ref_ll, "Log-likelihoods were not correct")
+		self.assertTrue(np.all(scores.nearest == ref_dist.argmin(axis=1)))
+		self.assertClose(scores.distance, ref_dist.min(axis=1), "Distances were not correct")
+
+		idxs, log_likelihood = scores.top_k
+		self.assertEqual(idxs.tolist(), np.argsort(scores.log_likelihood)[:5].tolist())
+		self.assertClose(log_likelihood, scores.log_likelihood[idxs],
+			"Log-likelihoods of the top-k were not correct")
+
+		# only the top-k is kept
+		scores = layer.score(x, top_k=5, per_feature=False, chunk_size=3)
+		self.assertIsNone(scores.log_likelihood)
+		self.assertEqual(scores.top_k[0].tolist(), idxs.tolist())
+
+		# features close to the means, far from the origin and with small variances
+		mu = self.init_mu + 100
+		sig = np.full_like(self.init_sig, 1e-2)
+		x = mu.T[self.rnd.randint(self.n_components, size=50)]
+		x = x + 1e-3 * self.rnd.randn(*x.shape).astype(self.dtype)
+		layer = self._new_layer(init_mu=mu, init_sig=sig)
+		scores = layer.score(x, chunk_size=7)
+		ref_dist = np.sqrt(((x[:, :, None].astype(np.float64) - mu)**2 / sig).sum(axis=1))
+		self.assertClose(scores.distance, ref_dist.min(axis=1),
+			"Distances of the features close to the means were not correct")
+
+	def test_autotune(self):
+		calls = dict(slow=0, fast=0)
+		def impl(name, delay):
+			def inner(x):
+				calls[name] += 1
+				time.sleep(delay)
+			return inner
+		impls = dict(slow=impl("slow", 1e-2), fast=impl("fast", 0))
+
+		with tempfile.TemporaryDirectory() as folder:
+			path = os.path.join(folder, "autotune.json")
+			tuner = autotune.Autotuner(path, n_runs=2)
+			self.assertEqual(tuner.choose("op", (1, "float32"), impls, None), "fast")
+			# a warm-up and two timed runs
+			self.assertEqual(calls, dict(slow=3, fast=3))
+
+			# the choice is cached per bucket (in memory and on the disk)
+			self.assertEqual(tuner.choose("op", (1, "float32"), impls, None), "fast")
+			tuner = autotune.Autotuner(path)
+			self.assertEqual(tuner.choose("op", (1, "float32"), impls, None), "fast")
+			self.assertEqual(calls, dict(slow=3, fast=3))
+			self.assertIn("disk", tuner.report())
+
+		tuner.set_override("op", "slow")
+		self.assertEqual(tuner.choose("op", (1, "float32"), impls, None), "slow")
+		self.assertIn("override", tuner.report())
+
+		# the approximate implementations are only chosen on request
+		approx = dict(fast=impls["fast"], exact=impls["slow"])
+		self.assertEqual(autotune.Autotuner().choose("op", (1,), approx, None, approximate=["fast"]), "exact")
+		tuner = autotune.Autotuner(approximate=True)
+		self.assertEqual(tuner.choose("op", (1,), approx, None, approximate=["fast"]), "fast")
+		tuner.set_override("op", "fast")
+		self.assertEqual(autotune.Autotuner(overrides=tuner.overrides).choose(
+			"op", (1,), approx, None, approximate=["fast"]), "fast")
+
+		# the matrix products are no candidates of the diagonal covariances
+		tuner = autotune.Autotuner()
+		layer = self._new_layer(autotuner=tuner)
+		with chainer.using_config("train", False), chainer.no_backprop_mode():
+			layer.log_proba(self.X)
+		self.assertEqual(len(tuner.choices), 0)
+
+		# the dispatched implementations compute the same results
+		tuner = autotune.Autotuner(approximate=True)
+		layer, ref = self._new_layer(autotuner=tuner), self._new_layer()
+		with chainer.using_config("train", False):
+			for backprop in [True, False]:
+				with chainer.using_config("enable_backprop", backprop):
+					self.assertClose(layer.log_proba(self.X)[0], ref.log_proba(self.X)[0],
+						f"Log-likelihoods were not correct (backprop={backprop})")
+					self.assertClose(layer.soft_assignment(self.X), ref.soft_assignment(self.X),
+						f"Soft assignment was not correct (backprop={backprop})")
+
+		# the input is differentiated only by some of the implementations
+		self.assertEqual(len(tuner.choices), 2)
+		self.assertTrue(all(entry["op"] == "dist" for entry in tuner.choices.values()))
+
+	def test_visualization(self):
+		from fve_layer.common import visualization
+
+		labels = np.repeat(np.arange(4), [1, 10, 100, 1000])
+		idxs = visualization.stratified_sample(labels, 5, random_state=0)
+		self.assertEqual(np.bincount(labels[idxs]).tolist(), [1, 5, 5, 5])
+
+		with tempfile.TemporaryDirectory() as folder:
+			layer = self._new_layer(visualization_interval=2,
+				visualization_folder=folder)
+			self._train(layer, 4)
+			self.assertEqual(sorted(os.listdir(folder)),
+				["000001.png", "000003.png"])
+
+		layer = GMMLayer(2, self.n_components)
+		x = np.random.randn(10_000, 2).astype(self.dtype)
+		ax = layer.plot(x=x, label=False, density_bins=32, n_per_component=10)
+		self.assertEqual(len(ax.collections[-1].get_offsets()), self.n_components)
+		ax.figure.clf()
+
+	def test_concurrent_readers(self):
+		layer = self._new_layer()
+		x = np.zeros_like(self.X.array)
+		n_versions, n_readers = 200, 4
+
+		def params(k):
+			mu = np.full_like(layer.mu, k)
+			sig = np.full_like(layer.sig, 1 + k)
+			w = np.arange(1, self.n_components + 1, dtype=layer.w.dtype) + k
+			return mu, sig, w / w.sum()
+
+		# for x = 0, the log-likelihood is equal for all components and
+		# mixes the distance (mu and sig) with the determinant (sig only)
+		ks = np.arange(n_versions + 1)
+		valid = -0.5 * self.in_size * (layer._LOG_2PI + ks**2 / (1 + ks) + np.log(1 + ks))
+
+		layer.set_params(*params(0))
+		stop, errors = threading.Event(), []
+
+		def reader():
+			try:
+				while not stop.is_set():
+					log_proba, _ = layer.log_proba(x)
+					values = np.unique(_as_array(log_proba))
+					if len(values) != 1 or not np.isclose(valid, values[0], rtol=1e-4).any():
+						errors.append(values)
+
+					layer.soft_assignment(x)
+			except Exception as e:
+				errors.append(e)
+
+		switch_interval = sys.getswitchinterval()
+		sys.setswitchinterval(1e-6)
+		try:
+			readers = [threading.Thread(target=reader) for _ in range(n_readers)]
+			for r in readers:
+				r.start()
+
+			for k in range(1, n_versions + 1):
+				layer.set_params(*params(k))
+
+			stop.set()
+			for r in readers:
+				r.join()
+		finally:
+			sys.setswitchinterval(switch_interval)
+
+		self.assertEqual(layer.param_snapshot().version, n_versions + 1)
+		self.assertEqual(len(errors), 0,
+			f"Readers saw inconsistent parameters: {errors[:5]}")
+
+	def test_concurrent_updates(self):
+		layer = self._new_layer()
+		stop, errors = threading.Event(), []
+
+		def reader():
+			try:
+				while not stop.is_set():
+					with layer.pinned_params() as params:
+						gamma = _as_array(layer.soft_assignment(self.X))
+						if layer._current_params() is not params:
+							errors.append("Pinned snapshot was replaced!")
+
+					if not np.allclose(gamma.sum(axis=-1), 1, atol=self.atol):
+						errors.append(gamma.sum(axis=-1))
+			except Exception as e:
+				errors.append(e)
+
+		readers = [threading.Thread(target=reader) for _ in range(2)]
+		for r in readers:
+			r.start()
+
+		with chainer.using_config("train", True):
+			for _ in range(10):
+				layer(self.X)
+
+		stop.set()
+		for r in readers:
+			r.join()
+
+		self.assertEqual(len(errors), 0,
+			f"Readers failed during the updates: {errors[:5]}")
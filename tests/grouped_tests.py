@@ -0,0 +1,181 @@
+import chainer
+import numpy as np
+
+from chainer import functions as F
+
+from fve_layer.backends.chainer.links import FVELayer
+from fve_layer.backends.chainer.links import GroupedFVELayer
+from fve_layer.backends.chainer.links import GroupedGMMLayer
+from fve_layer.common.mixtures import GMM
+from tests.base import BaseFVEncodingTest
+
+class GroupedLayerTest(BaseFVEncodingTest):
+
+	def setUp(self):
+		super(GroupedLayerTest, self).setUp()
+		self.n_groups = 3
+		self.in_size = 16
+		self.X = self.rnd.randn(self.n, self.n_groups, self.t, self.in_size).astype(self.dtype)
+
+	def _new_layer(self, layer_cls=GroupedFVELayer, **kwargs):
+		return layer_cls(self.in_size, self.n_components, self.n_groups,
+			alpha=self.alpha, **kwargs)
+
+	def _single_layers(self, shift=0, params=None, **kwargs):
+		layers = []
+		for g in range(self.n_groups):
+			if params is None:
+				init_mu = self.rnd.randn(self.in_size, self.n_components).astype(self.dtype) + shift
+				init_sig = (self.rnd.rand(self.in_size, self.n_components) + .5).astype(self.dtype)
+			else:
+				init_mu, init_sig = [p[g] for p in params]
+			layers.append(FVELayer(self.in_size, self.n_components,
+				init_mu=init_mu, init_sig=init_sig, alpha=self.alpha, **kwargs))
+		return layers
+
+	def _separated(self):
+		""" means (n_groups, in_size, n_components), that are far apart
+			relative to their variances, and features (n, n_groups, t,
+			in_size) drawn from these components
+		"""
+		shape = (self.n_groups, self.in_size, self.n_components)
+		mu = (200 * self.rnd.randn(*shape)).astype(self.dtype)
+		sig = ((self.rnd.rand(*shape) + 1) * 2e-2).astype(self.dtype)
+
+		comps = self.rnd.randint(self.n_components, size=(self.n, self.n_groups, self.t))
+		groups = np.arange(self.n_groups)[None, :, None]
+		means, variances = [p.transpose(0, 2, 1)[groups, comps] for p in (mu, sig)]
+		X = means + np.sqrt(variances) * self.rnd.randn(*means.shape)
+		return mu, sig, X.astype(self.dtype)
+
+	def test_shapes(self):
+		layer = self._new_layer()
+		self.assertEqual(layer.mu.shape, (self.n_groups, self.in_size, self.n_components))
+		self.assertEqual(layer.w.shape, (self.n_groups, self.n_components))
+
+		gamma = layer.soft_assignment(self.X)
+		self.assertEqual(gamma.shape, (self.n, self.n_groups, self.t, self.n_components))
+		self.assertClose(gamma.array.sum(axis=-1), 1, "Soft assignment should sum up to 1")
+
+		with chainer.using_config("train", False):
+			output = layer(self.X)
+		self.assertEqual(output.shape, (self.n, self.n_groups, layer.output_size))
+
+		with self.assertRaises(AssertionError):
+			layer(self.X[:, :-1])
+
+	def test_equivalence(self):
+		kwargs = dict(power=0.5, l2_norm=True)
+		# a common offset of the features and the means must not matter
+		cases = [(f"shift={shift}", self._single_layers(shift, **kwargs), self.X + shift)
+			for shift in [0, 100]]
+		# neither do distant components with small variances
+		mu, sig, X = self._separated()
+		cases.append(("separated", self._single_layers(params=(mu, sig), **kwargs), X))
+
+		for case, layers, X in cases:
+			grouped = GroupedFVELayer.from_layers(layers, alpha=self.alpha, **kwargs)
+
+			for use_mask in [False, True]:
+				with chainer.using_config("train", False):
+					output = grouped(X, use_mask=use_mask).array
+					refs = [layer(X[:, g], use_mask=use_mask).array
+						for g, layer in enumerate(layers)]
+
+				for g, ref in enumerate(refs):
+					self.assertClose(output[:, g], ref,
+						f"Encoding of group {g} was not correct (use_mask={use_mask}, {case})")
+
+		layers = self._single_layers(**kwargs)
+		grouped = GroupedFVELayer.from_layers(layers, alpha=self.alpha, **kwargs)
+
+		log_proba = grouped.log_proba(self.X).array
+		for g, layer in enumerate(layers):
+			ref_gamma = layer.soft_assignment(self.X[:, g]).array
+			self.assertClose(grouped.soft_assignment(self.X).array[:, g], ref_gamma,
+				f"Soft assignment of group {g} was not correct")
+
+			ref_ll, _ = layer.log_proba(self.X[:, g], weighted=True)
+			self.assertClose(log_proba[:, g], ref_ll.array,
+				f"Log-likelihood of group {g} was not correct")
+
+	def _check_em_step(self, layer, X, case):
+		params = [p.copy() for p in layer.param_snapshot()[:3]]
+		x = X.transpose(1, 0, 2, 3).reshape(self.n_groups, -1, self.in_size)
+
+		new_params = layer.get_new_params(x)
+		for g in range(self.n_groups):
+			# one EM step of the same mixture (see GMMLayer.get_new_params)
+			gmm = GMM(self.n_components, covariance_type="diag",
+				reg_covar=layer.eps, max_iter=1, warm_start=True)
+			gmm.means_ = params[0][g].T.astype(np.float64)
+			gmm.covariances_ = params[1][g].T.astype(np.float64)
+			gmm.weights_ = params[2][g].astype(np.float64)
+			gmm.fit(x[g].astype(np.float64))
+
+			refs = [gmm.means_.T, gmm.covariances_.T, gmm.weights_]
+			for name, param, ref in zip(["mu", "sig", "w"], new_params, refs):
+				self.assertClose(param[g], ref, f"{name} of group {g} was not correct ({case})")
+		return x, new_params
+
+	def test_update(self):
+		# distant components with small variances must not cancel out
+		mu, sig, X = self._separated()
+		self._check_em_step(self._new_layer(GroupedGMMLayer, init_mu=mu, init_sig=sig),
+			X, "separated")
+
+		layer = self._new_layer(GroupedGMMLayer)
+		x, new_params = self._check_em_step(layer, self.X, "default")
+
+		with chainer.using_config("train", True):
+			layer(self.X)
+
+		self.assertEqual(layer.t, 2)
+		self.assertEqual(layer.param_snapshot().version, 1)
+		# the bias-corrected EMA of the first update is the EM step itself
+		for name, new in zip(["mu", "sig", "w"], new_params):
+			self.assertClose(getattr(layer, name), new, f"{name} was not updated correctly")
+
+		# the selected features only
+		layer = self._new_layer(GroupedGMMLayer)
+		selected = layer.get_mask(self.X, use_mask=True)
+		self.assertEqual(selected.shape, (self.n, self.n_groups, self.t))
+		_selected = selected.transpose(1, 0, 2).reshape(self.n_groups, -1)
+		mu, _, w = layer.get_new_params(x, _selected)
+		for g in range(self.n_groups):
+			x_g = x[g][_selected[g]]
+			ref, _, ref_w = layer.get_new_params(np.broadcast_to(x_g, (self.n_groups,) + x_g.shape))
+			self.assertClose(mu[g], ref[g], f"mu of the selected features of group {g} was not correct")
+			self.assertClose(w[g], ref_w[g], f"w of the selected features of group {g} was not correct")
+
+	def test_init_from_data(self):
+		layer = self._new_layer(GroupedGMMLayer, init_from_data=True, random_state=0)
+		x = self.X.transpose(1, 0, 2, 3).reshape(self.n_groups, -1, self.in_size)
+		layer.init_from_data(x)
+		for g in range(self.n_groups):
+			# the means are distinct features of the group
+			dists = ((x[g][:, :, None] - layer.mu[g][None])**2).sum(axis=1)
+			self.assertTrue(np.allclose(dists.min(axis=0), 0))
+			self.assertEqual(len(set(dists.argmin(axis=0).tolist())), self.n_components)
+
+			self.assertClose(layer.sig[g], np.broadcast_to(x[g].var(axis=0)[:, None], layer.sig[g].shape),
+				f"Variances of group {g} were not initialized correctly")
+		self.assertClose(layer.w, 1 / self.n_components, "Weights should be uniform")
+
+		# the first update initializes the mixtures
+		layer = self._new_layer(GroupedGMMLayer, init_from_data=True)
+		with chainer.using_config("train", True):
+			layer(self.X)
+		self.assertEqual(layer.t, 2)
+		self.assertTrue(np.isfinite(layer.mu).all())
+
+	def test_gradient(self):
+		layer = self._new_layer(l2_norm=True)
+		X = chainer.Variable(self.X)
+		with chainer.using_config("train", False):
+			y = layer(X)
+		F.sum(y**2).backward()
+
+		self.assertIsNotNone(X.grad)
+		self.assertEqual(X.grad.shape, X.shape)
+		self.assertTrue(np.isfinite(X.grad).all())
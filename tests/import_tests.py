@@ -0,0 +1,51 @@
+import json
+import subprocess
+import sys
+import unittest
+
+from pathlib import Path
+
+# measures the import of the package in a fresh interpreter, after its
+# (unavoidable) dependencies chainer and numpy were imported
+_SCRIPT = """
+import json, sys, time
+import chainer, numpy
+
+t0 = time.perf_counter()
+import {module}
+duration = time.perf_counter() - t0
+
+print(json.dumps(dict(duration=duration, modules=sorted(sys.modules))))
+"""
+
+class ImportTest(unittest.TestCase):
+	MODULE = "fve_layer.backends.chainer.links"
+	# seconds for the import of the package (without chainer)
+	BUDGET = 0.25
+	N_RUNS = 3
+	LAZY_MODULES = ["matplotlib", "sklearn", "fve_layer.common.visualization"]
+
+	def _import(self):
+		root = Path(__file__).parent.parent
+		output = subprocess.check_output(
+			[sys.executable, "-c", _SCRIPT.format(module=self.MODULE)],
+			cwd=root, stderr=subprocess.DEVNULL)
+		return json.loads(output.decode().strip().splitlines()[-1])
+
+	def test_lazy_modules(self):
+		modules = set(self._import()["modules"])
+		for name in self.LAZY_MODULES:
+			self.assertNotIn(name, modules,
+				f"\"{name}\" should only be imported on the first use")
+
+	def test_import_time(self):
+		duration = min(self._import()["duration"] for _ in range(self.N_RUNS))
+		self.assertLess(duration, self.BUDGET,
+			f"Import of {self.MODULE} exceeded the budget")
+
+
+if __name__ == '__main__':
+	test = ImportTest()
+	durations = [test._import()["duration"] for _ in range(5)]
+	print(f"import {test.MODULE}: {min(durations) * 1000:.1f}ms "
+		f"(budget: {test.BUDGET * 1000:.0f}ms)")